@@ -1,19 +1,69 @@
-import sys
+import argparse
 import pygame
 import os.path
+import numpy as np
 from pygame_gl_code import PygameGLWindow
 from imgui_rendering import ImguiUI
 from application import Application
 from list_viewer import ListViewer
 from image_viewer import ImageViewer
-from image_plotter import ImagePlotter
+from image_plotter import ImagePlotter, PositionGenerator, ContstantAnimation
 from hilbert_plotter import HilbertPlotter
+from similarity_plotter import SimilarityPlotter
+from burst_plotter import BurstPlotter
+from duplicate_viewer import DuplicateViewer
+from timeline_viewer import TimelineViewer
+from query_viewer import MetadataQueryViewer
+from burst_viewer import BurstViewer
+from compare_viewer import CompareViewer
+from plot_poster import create_headless_context
+from frame_timings import FrameTimings
 
 TRACKED_KEYS = [
-    pygame.K_LCTRL, pygame.K_s, pygame.K_RIGHT, pygame.K_LEFT, pygame.K_SPACE
+    pygame.K_LCTRL, pygame.K_s, pygame.K_RIGHT, pygame.K_LEFT, pygame.K_SPACE, pygame.K_g, pygame.K_k,
+    pygame.K_UP, pygame.K_DOWN, pygame.K_PAGEUP, pygame.K_PAGEDOWN, pygame.K_TAB, pygame.K_f, pygame.K_a, pygame.K_x,
+    pygame.K_o
 ]
 
+def create_generators() -> list[PositionGenerator]:
+    return [HilbertPlotter(), SimilarityPlotter(), BurstPlotter()]
+
+
+def render_poster(args):
+    # no window and no ui, the plot is drawn in a standalone gl context, which mesa can run in software
+    plotter = ImagePlotter(create_generators())
+    app = Application(None, None, [plotter])
+    app.open_file(args.file)
+    app.reload_features()
+    generators = [generator for generator in plotter.generators if args.layout in (None, generator.name)]
+    if not generators:
+        raise SystemExit(f"unknown layout {args.layout}, choose from: "
+                         + ", ".join(generator.name for generator in plotter.generators))
+    plotter.animation = ContstantAnimation(generators[0], generators[0].get_layout(app.store))
+    job = plotter.start_poster(app, create_headless_context(), args.poster, args.poster_width, fit_all=True)
+    print(f"Rendering a {job.width}x{job.height} poster...")
+    job.run()
+    if job.error is not None:
+        raise SystemExit(f"could not write the poster: {job.error}")
+
+
 def main():
+    parser = argparse.ArgumentParser(prog="picsel")
+    parser.add_argument("file", nargs="?", help="selection file to open")
+    parser.add_argument("--record", metavar="INPUTS", help="record the inputs of this session to a file")
+    parser.add_argument("--replay", metavar="INPUTS", help="replay recorded inputs in a hidden window and time them")
+    parser.add_argument("--report", metavar="JSON", help="where to write the frame times of a replay")
+    parser.add_argument("--poster", metavar="IMAGE", help="render the plot of the selection file to a png or tiff "
+                                                          "without opening a window")
+    parser.add_argument("--poster-width", type=int, default=8000, help="width of the poster in pixels")
+    parser.add_argument("--layout", help="name of the plot layout of the poster, the first one by default")
+    args = parser.parse_args()
+    if args.poster is not None:
+        if args.file is None:
+            parser.error("--poster needs a selection file")
+        render_poster(args)
+        return
+
     window = PygameGLWindow(
         size=(1900, 900),
         caption="picsel - new file",
@@ -21,15 +71,28 @@ def main():
         background_color=(0, 0, 0),
         resizable=True,
         open_maximized=True,
-        tracked_keys=TRACKED_KEYS, check_for_close=False
+        tracked_keys=TRACKED_KEYS, track_digits=True, check_for_close=False,
+        record_file=args.record,
+        replay_file=args.replay
     )
 
     with window:
         ui = ImguiUI(window, ini_file=os.path.join(os.path.dirname(__file__), "imgui.ini"))
-        app = Application(window, ui, [ListViewer(), ImageViewer(), ImagePlotter([HilbertPlotter()])])
-        if len(sys.argv) >= 2:
-            app.open_file(sys.argv[1])
+        app = Application(window, ui, [
+            ListViewer(), ImageViewer(), ImagePlotter(create_generators()),
+            DuplicateViewer(), TimelineViewer(), MetadataQueryViewer(), BurstViewer(), CompareViewer()
+        ])
+        if args.replay is not None:
+            # random layouts should come out the same on every replay
+            np.random.seed(0)
+            app.timings = FrameTimings()
+        if args.file is not None:
+            app.open_file(args.file)
         app.main_loop()
+        if app.timings is not None:
+            app.timings.print_summary()
+            if args.report is not None:
+                app.timings.save(args.report)
 
 
 if __name__ == '__main__':
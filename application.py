@@ -2,20 +2,37 @@ from __future__ import annotations
 import functools
 import json
 import os
-import shutil
 import abc
+import contextlib
+import itertools
+import time
+from typing import Callable, Iterable
 import pygame
 from pygame_gl_code import PygameGLWindow
 from imgui_rendering import ImguiUI
+from feature_store import FeatureStore, FeatureExtractor
+from image_catalog import ImageCatalog
+from export_presets import ExportJob, ExportPreset, DEFAULT_PRESETS, COPY_MODE_NAMES, WRITE_COPIES, SKIP_COPIES
+from content_hash import ContentHashExtractor
+from shared_cache import SharedCache, CLAIM_POLL_INTERVAL
+from selection_algebra import combine_selection_files, OPERATION_NAMES, UNION
+from frame_timings import FrameTimings
+from folder_listings import ListingValidator, scan_folder, load_listings, save_listings, remove_listings
+from memory_budget import MemoryBudget, MemoryConsumer, MeasuredMemory, collection_bytes, resident_bytes
+import numpy as np
+from PIL import Image
 import imgui
 import easygui
 
 
 class Source:
-    def __init__(self, absolute_path: str, is_folder: bool, image_paths: list[str]):
+    def __init__(self, absolute_path: str, is_folder: bool, image_paths: list[str],
+                 listing_mtime_ns: int | None = None):
         self.absolute_path = absolute_path
         self.is_folder = is_folder
         self.image_paths = image_paths
+        # modification time of the folder when it was listed, to tell whether a saved listing is still current
+        self.listing_mtime_ns = listing_mtime_ns
 
     @property
     def relative_to_dir(self) -> str:
@@ -23,11 +40,9 @@ class Source:
 
     @classmethod
     def from_folder(cls, path: str) -> Source:
-        image_paths = []
-        for file in os.listdir(path):
-            if os.path.isfile(os.path.join(path, file)) and os.path.splitext(file)[1].lower() in IMAGE_EXTENSIONS:
-                image_paths.append(file)
-        return Source(path, True, image_paths)
+        # sorted, so the order of the images does not depend on the file system
+        image_paths, mtime_ns = scan_folder(path, IMAGE_EXTENSIONS)
+        return Source(path, True, image_paths, mtime_ns)
 
     @classmethod
     def from_selection_file(cls, path: str) -> Source:
@@ -42,6 +57,12 @@ class Source:
         # noinspection PyTypeChecker
         return Source(path, False, image_paths)
 
+    def rescan(self):
+        if self.is_folder:
+            self.image_paths, self.listing_mtime_ns = scan_folder(self.absolute_path, IMAGE_EXTENSIONS)
+        else:
+            self.image_paths = Source.from_selection_file(self.absolute_path).image_paths
+
     @property
     def absolute_image_paths(self):
         for image_path in self.image_paths:
@@ -57,39 +78,100 @@ class Source:
 
 
 
+# shared by all selections, so a version number is never seen twice even when the selection is replaced
+_selection_versions = itertools.count(1)
+
+
 class Selection:
     def __init__(self):
         self.sources: list[Source] = []
         self.subsets: list[set[int]] = []
+        self.catalog = ImageCatalog()
+        # folders whose images were read from a saved listing that has not been checked against the disk yet
+        self.unchecked_sources: list[Source] = []
+        # changes whenever the sources or subsets change, so viewers can cache what they derive from them
+        self.version = next(_selection_versions)
 
     @classmethod
-    def from_file(cls, path: str):
+    def from_file(cls, path: str, use_listings: bool = True):
+        """
+        Reads a selection file. With `use_listings', folders are not listed when the file has saved listings of them:
+        those are used as they are and the folders show up in `unchecked_sources', to be checked in the background.
+        """
         base_dir = os.path.dirname(path)
         result = Selection()
         with open(path) as file:
             data = json.load(file)
+        listings = load_listings(path) if use_listings else {}
         for source_path, source_data in data["sources"].items():
-            if source_data["type"] == "folder":
+            if source_data["type"] == "folder" and source_path in listings:
+                image_paths, mtime_ns = listings[source_path]
+                source = Source(os.path.join(base_dir, source_path), True, image_paths, mtime_ns)
+                result.unchecked_sources.append(source)
+            elif source_data["type"] == "folder":
                 source = Source.from_folder(os.path.join(base_dir, source_path))
             else:
                 source = Source.from_selection_file(os.path.join(base_dir, source_path))
             result.sources.append(source)
             source_set = set(source_data["selection"])
             result.subsets.append(set(i for i, image_path in enumerate(source.image_paths) if image_path in source_set))
+        result.catalog.update(result.sources)
+        result.mark_modified()
         return result
 
     def add_source(self, source: Source):
         self.sources.append(source)
         self.subsets.append(set())
+        self.catalog.update(self.sources)
+        self.mark_modified()
 
     def remove_source(self, index: int):
         self.sources.pop(index)
         self.subsets.pop(index)
-
-    def save(self, path: str):
+        self.catalog.update(self.sources)
+        self.mark_modified()
+
+    def rescan(self):
+        # selections are carried over by catalog id, so they stay with their files when others are added or removed
+        selected_ids = np.array([self.catalog.image_id(source, i) for source, subset in zip(self.sources, self.subsets)
+                                 for i in subset], dtype=np.int64)
+        for source in self.sources:
+            source.rescan()
+        self.unchecked_sources.clear()
+        self.catalog.update(self.sources)
+        self.subsets = [set(np.flatnonzero(np.isin(self.catalog.source_ids(source), selected_ids)).tolist())
+                        for source in self.sources]
+        self.mark_modified()
+
+    def update_listing(self, source_index: int, image_paths: list[str], mtime_ns: int):
+        # like a rescan of a single source, with the listing already read
+        source = self.sources[source_index]
+        selected_ids = self.catalog.source_ids(source)[sorted(self.subsets[source_index])]
+        source.image_paths = image_paths
+        source.listing_mtime_ns = mtime_ns
+        self.catalog.update(self.sources)
+        self.subsets[source_index] = set(np.flatnonzero(np.isin(self.catalog.source_ids(source),
+                                                                selected_ids)).tolist())
+        self.mark_modified()
+
+    def mark_modified(self):
+        self.version = next(_selection_versions)
+
+    def set_selected(self, source_index: int, indices: Iterable[int], selected: bool):
+        if selected:
+            self.subsets[source_index].update(indices)
+        else:
+            self.subsets[source_index].difference_update(indices)
+        self.mark_modified()
+
+    def save(self, path: str, with_listings: bool = True):
         base_dir = os.path.dirname(path)
         sources = {}
+        listings = {}
         for source, subset in zip(self.sources, self.subsets):
+            if source.is_folder and source.listing_mtime_ns is not None:
+                listings[os.path.relpath(source.absolute_path, base_dir)] = (source.image_paths,
+                                                                             source.listing_mtime_ns)
             sources[os.path.relpath(source.absolute_path, base_dir)] = {
                 "type": "folder" if source.is_folder else "selection",
                 "selection": [
@@ -99,17 +181,14 @@ class Selection:
         result = {"sources": sources}
         with open(path, "w") as file:
             json.dump(result, file, indent=2)
+        if with_listings and listings:
+            save_listings(path, listings)
+        else:
+            remove_listings(path)
 
-    def export(self, folder: str):
-        print("")
-        for source, subset in zip(self.sources, self.subsets):
-            n = 0
-            for i, file in enumerate(source.image_paths):
-                if i in subset:
-                    print(f"\rcopying files {n+1}/{len(subset)} from {source.name}...", end="")
-                    n += 1
-                    # noinspection PyTypeChecker
-                    shutil.copy2(os.path.join(source.relative_to_dir, file), folder)
+    def selected_paths(self) -> list[str]:
+        return [os.path.join(source.relative_to_dir, file) for source, subset in zip(self.sources, self.subsets)
+                for i, file in enumerate(source.image_paths) if i in subset]
 
 
 
@@ -118,6 +197,13 @@ class Viewer(abc.ABC):
     def handle_inputs(self, app: Application) -> None:
         pass
 
+    def get_extractors(self) -> list[FeatureExtractor]:
+        return []
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        # caches and large structures of the viewer, by name, for the memory panel and budget
+        return {}
+
     @abc.abstractmethod
     def draw_ui(self, app: Application) -> None:
         pass
@@ -139,9 +225,31 @@ class Application:
         self.current_file: str | None = None
         self.changed = False
         self.selection = Selection()
+        self.store = FeatureStore()
         self.after_popup = None
         self.viewers = viewers
         self.open_changes_popup = False
+        self.export_job: ExportJob | None = None
+        self.export_presets = list(DEFAULT_PRESETS)
+        self.copy_mode = SKIP_COPIES
+        # finds files with the same content over all sources, for the viewers and for exports
+        self.content_hashes = ContentHashExtractor()
+        # first copy of every image by feature store id, with the number of copies, and what they were computed from
+        self.copies: tuple[np.ndarray, np.ndarray] | None = None
+        self.copies_key: tuple | None = None
+        # per viewer frame times, only collected when set
+        self.timings: FrameTimings | None = None
+        self.memory = MemoryBudget()
+        # folder listings are saved next to the selection file, so large folders open without listing them first
+        self.save_listings = True
+        self.listing_validator = ListingValidator()
+        # previews and claims shared with the other picsel processes on this machine
+        self.shared_cache = SharedCache()
+        # selection files to combine with set operations, with the operation in front of every file after the first
+        self.show_combine = False
+        self.combine_files: list[str] = []
+        self.combine_operations: list[int] = []
+        self.combine_result: str | None = None
 
     def draw_menu_items(self):
         with imgui.begin_menu("File") as file_menu:
@@ -154,13 +262,146 @@ class Application:
                     self.save()
                 if imgui.menu_item("Save as...")[0]:
                     self.save_as()
-                if imgui.menu_item("Export")[0]:
-                    self.export()
+                with imgui.begin_menu("Export", self.export_job is None or not self.export_job.is_running) as menu:
+                    if menu.opened:
+                        self.draw_export_menu()
+                if imgui.menu_item("Rescan sources")[0]:
+                    self.rescan_sources()
+                _, self.save_listings = imgui.menu_item("Save folder listings", selected=self.save_listings)
+                if imgui.menu_item("Combine selection files...")[0]:
+                    self.show_combine = True
         with imgui.begin_menu("Tools") as view_menu:
             if view_menu.opened:
                 for viewer in self.viewers:
                     if imgui.menu_item(viewer.name)[0]:
                         viewer.open()
+        with imgui.begin_menu("Memory") as memory_menu:
+            if memory_menu.opened:
+                self.draw_memory_usage()
+
+    def memory_consumers(self) -> dict[str, MemoryConsumer]:
+        consumers = {
+            "source image lists": MeasuredMemory(lambda: sum(collection_bytes(source.image_paths)
+                                                             for source in self.selection.sources)),
+            "selected image sets": MeasuredMemory(lambda: sum(collection_bytes(subset)
+                                                              for subset in self.selection.subsets)),
+            "image catalog": MeasuredMemory(lambda: self.selection.catalog.nbytes),
+            # memory mapped, the system can page these out without swapping
+            "feature store columns": MeasuredMemory(lambda: self.store.nbytes),
+            "textures": self.window.textures,
+            "texture staging buffers": MeasuredMemory(lambda: self.window.uploads.nbytes, on_gpu=True),
+        }
+        for viewer in self.viewers:
+            consumers.update(viewer.get_memory_consumers())
+        return consumers
+
+    def draw_memory_usage(self):
+        consumers = self.memory_consumers()
+        resident = resident_bytes()
+        if resident is not None:
+            imgui.text(f"process, resident: {resident/MEGABYTE:.1f} MB")
+        imgui.text(f"caches: {self.memory.cache_bytes(consumers.values())/MEGABYTE:.1f} MB of "
+                   f"{self.memory.budget/MEGABYTE:.0f} MB, {self.memory.evicted_bytes/MEGABYTE:.1f} MB evicted")
+        for on_gpu in (False, True):
+            imgui.separator()
+            imgui.text("gpu" if on_gpu else "cpu")
+            for name, consumer in consumers.items():
+                if consumer.on_gpu == on_gpu:
+                    imgui.text(f"  {name}{' (cache)' if consumer.is_cache else ''}: {consumer.nbytes/MEGABYTE:.1f} MB")
+        imgui.separator()
+        textures = self.window.textures
+        imgui.text("textures by owner")
+        for owner, nbytes in sorted(textures.usage_by_owner().items()):
+            imgui.text(f"  {owner}: {nbytes/MEGABYTE:.1f} MB")
+        imgui.text(f"  pooled, unused: {textures.free_bytes/MEGABYTE:.1f} MB")
+        imgui.separator()
+        _, budget = imgui.input_int("cache budget (MB)", self.memory.budget//MEGABYTE)
+        self.memory.budget = max(64, budget)*MEGABYTE
+        if imgui.menu_item("Release unused textures")[0]:
+            textures.trim()
+
+    def draw_export_menu(self):
+        for mode, mode_name in enumerate(COPY_MODE_NAMES):
+            if imgui.menu_item(mode_name, selected=self.copy_mode == mode)[0]:
+                self.copy_mode = mode
+        imgui.separator()
+        for preset in self.export_presets:
+            with imgui.begin_menu(preset.name) as preset_menu:
+                if preset_menu.opened:
+                    if imgui.menu_item("To folder...")[0]:
+                        self.export(preset)
+                    if imgui.menu_item("To zip or tar archive...")[0]:
+                        self.export(preset, to_archive=True)
+
+    def draw_export_progress(self):
+        job = self.export_job
+        with imgui.begin("Export", True, imgui.WINDOW_ALWAYS_AUTO_RESIZE) as export_window:
+            if not export_window.opened:
+                job.cancel()
+                self.export_job = None
+                return
+            imgui.text(f"{job.preset.name} to {job.archive or job.folder}")
+            if job.finding_copies:
+                imgui.text("Looking for identical files...")
+            imgui.progress_bar(job.done/max(1, job.total), (300, 0), f"{job.done}/{job.total}")
+            imgui.text(f"{job.images_per_second:.1f} images/s, {job.megabytes_per_second:.1f} MB/s")
+            if job.skipped or job.linked:
+                imgui.text(f"identical files: {job.skipped} skipped, {job.linked} hard linked")
+            if job.failed:
+                imgui.text(f"{len(job.failed)} failed, first: {job.failed[0][0]}: {job.failed[0][1]}")
+            if job.is_running:
+                if imgui.button("Cancel"):
+                    job.cancel()
+            elif imgui.button("Close"):
+                self.export_job = None
+
+    def draw_combine_window(self):
+        with imgui.begin("Combine selection files", True, imgui.WINDOW_ALWAYS_AUTO_RESIZE) as combine_window:
+            if not combine_window.opened:
+                self.show_combine = False
+                return
+            removed = None
+            for i, file in enumerate(self.combine_files):
+                imgui.push_id(f"combine {i}")
+                if i > 0:
+                    imgui.push_item_width(160)
+                    _, self.combine_operations[i-1] = imgui.combo("", self.combine_operations[i-1], OPERATION_NAMES)
+                    imgui.pop_item_width()
+                    imgui.same_line()
+                imgui.text(os.path.basename(file))
+                if imgui.is_item_hovered():
+                    imgui.set_tooltip(file)
+                imgui.same_line()
+                if imgui.small_button("-"):
+                    removed = i
+                imgui.pop_id()
+            if removed is not None:
+                self.combine_files.pop(removed)
+                # a single file has no operation to go with it
+                if self.combine_operations:
+                    self.combine_operations.pop(max(0, removed-1))
+            if imgui.button("Add selection file..."):
+                file = easygui.fileopenbox(filetypes=["*.json"], default=self.current_file)
+                if file is not None:
+                    if self.combine_files:
+                        self.combine_operations.append(UNION)
+                    self.combine_files.append(file)
+            imgui.same_line()
+            if imgui.button("Combine and save as...") and self.combine_files:
+                self.combine_result = easygui.filesavebox(filetypes=["*.json"], default="combined.json")
+                if self.combine_result is not None:
+                    try:
+                        _, result = combine_selection_files(self.combine_files, self.combine_operations,
+                                                            self.combine_result)
+                        print(f"Saved {len(result)} images to {self.combine_result}.")
+                    except (OSError, ValueError, KeyError) as e:
+                        print(f"Could not combine the selection files: {e}")
+                        self.combine_result = None
+            if self.combine_result is not None:
+                imgui.text(f"saved to {os.path.basename(self.combine_result)}")
+                imgui.same_line()
+                if imgui.small_button("open"):
+                    self.open(file=self.combine_result)
 
     def draw_changes_pop_up(self):
         imgui.text("Do you want to save your current changes?")
@@ -182,6 +423,9 @@ class Application:
         imgui.same_line()
         if imgui.button("+ selection"):
             self.add_json_source()
+        if self.listing_validator.pending:
+            imgui.same_line()
+            imgui.text(f"checking {len(self.listing_validator)} folders...")
         with imgui.begin_child("sources_list", 0., 0., True):
             for i, source in enumerate(self.selection.sources):
                 imgui.text(source.name)
@@ -189,11 +433,153 @@ class Application:
                 if imgui.button("-"):
                     self.selection.remove_source(i)
 
-    def export(self):
-        directory = easygui.diropenbox()
-        if directory is None:
-            return
-        self.selection.export(directory)
+    def reload_features(self):
+        """
+        Runs every feature extractor of every viewer over the images of the current selection. Images are only opened
+        when some extractor is still missing data for them, so this is cheap when everything is cached already.
+        """
+        print("Reloading...")
+        extractors = [self.content_hashes] + [extractor for viewer in self.viewers
+                                              for extractor in viewer.get_extractors()]
+        self.store.open(self.selection.sources)
+        # the bulk work of the extractors, like reading capture times, is done by one process at a time, the others
+        # wait and find it done
+        with self.shared_cache.claimed(f"{self.store.directory}:reset"):
+            for extractor in extractors:
+                extractor.reset(self, self.store)
+        needed = [extractor.needs_image(self.store) for extractor in extractors]
+
+        def process(image_id: int, image_path: str):
+            image_extractors = [extractor for extractor, mask in zip(extractors, needed) if mask[image_id]]
+            if image_extractors:
+                pil_image = Image.open(image_path)
+                for extractor in image_extractors:
+                    extractor.process(self, self.store, image_id, pil_image)
+
+        # images that another process with the same sources is reading right now, the columns are shared with it
+        deferred = []
+        for source in self.selection.sources:
+            print(f"Loading source {source.name}...", end="")
+            for i, image_path in enumerate(source.absolute_image_paths):
+                image_id = self.store.image_id(source, i)
+                if not any(mask[image_id] for mask in needed):
+                    continue
+                claim = f"{self.store.directory}:{image_id}"
+                if not self.shared_cache.claim(claim):
+                    deferred.append((image_id, image_path, claim))
+                    continue
+                print(f"\rLoading source {source.name}, image {i}/{len(source.image_paths)}...", end="")
+                try:
+                    process(image_id, image_path)
+                finally:
+                    self.shared_cache.release(claim)
+            print()
+        if deferred:
+            print(f"Waiting for another process to load {len(deferred)} images...")
+            for _, _, claim in deferred:
+                while self.shared_cache.is_claimed(claim):
+                    time.sleep(CLAIM_POLL_INTERVAL)
+            # only what the other process did not get to is left
+            needed = [extractor.needs_image(self.store) for extractor in extractors]
+            for image_id, image_path, _ in deferred:
+                process(image_id, image_path)
+        self.store.flush()
+
+    def selected_mask(self) -> np.ndarray:
+        # which images are selected, by feature store id
+        mask = np.zeros(len(self.store), dtype=bool)
+        for source, subset in zip(self.selection.sources, self.selection.subsets):
+            if source in self.store.offsets and subset:
+                mask[self.store.offsets[source]+np.fromiter(subset, dtype=int, count=len(subset))] = True
+        return mask
+
+    def set_selected_ids(self, image_ids: np.ndarray, selected: bool):
+        # selects or deselects images by feature store id, with one update per source
+        image_ids = np.sort(image_ids)
+        for source_index, source in enumerate(self.selection.sources):
+            if source not in self.store.offsets:
+                continue
+            source_slice = self.store.source_slice(source)
+            start, end = np.searchsorted(image_ids, [source_slice.start, source_slice.stop])
+            if end > start:
+                self.selection.set_selected(source_index, (image_ids[start:end]-source_slice.start).tolist(),
+                                            selected)
+        if len(image_ids) > 0:
+            self.changed = True
+
+    def first_copies(self) -> tuple[np.ndarray, np.ndarray] | None:
+        """
+        For every image by feature store id the id of the first image with the same content, and for every id how many
+        images have it as first copy. None before the contents were hashed.
+        """
+        if self.content_hashes.generation == 0 or not self.store.sources:
+            return None
+        key = (self.store.directory, len(self.store), self.content_hashes.generation)
+        if key != self.copies_key:
+            labels = self.content_hashes.first_copies(self.store)
+            self.copies = labels, np.bincount(labels, minlength=len(labels))
+            self.copies_key = key
+        return self.copies
+
+    def identical_files(self, source: Source, index: int) -> int:
+        # the number of other files with the same content as this image
+        copies = self.first_copies()
+        if copies is None or source not in self.store.offsets:
+            return 0
+        labels, counts = copies
+        return int(counts[labels[self.store.image_id(source, index)]])-1
+
+    def export_copies(self) -> Callable[[], list[int]] | None:
+        """
+        A function that gives for every selected image the index of an earlier selected image with the same content,
+        or -1. It hashes the files that could have a copy, so the export job calls it in its background thread.
+        """
+        if self.copy_mode == WRITE_COPIES or not self.selection.sources:
+            return None
+        # a snapshot of the sources, the selection and the store can change while the export thread hashes
+        sources = [Source(source.absolute_path, source.is_folder, list(source.image_paths), source.listing_mtime_ns)
+                   for source in self.selection.sources]
+        offsets = np.cumsum([0] + [len(source.image_paths) for source in sources])
+        image_ids = np.concatenate([np.zeros(0, dtype=np.int64)] + [
+            offset+np.sort(np.fromiter(subset, dtype=np.int64, count=len(subset)))
+            for offset, subset in zip(offsets, self.selection.subsets)])
+        if len(image_ids) < 2:
+            return None
+        cache_dir = self.store.cache_dir
+
+        def find_copies() -> list[int]:
+            # a store of its own on the same cache directory, the hashes end up where the application finds them
+            store, content_hashes = FeatureStore(cache_dir), ContentHashExtractor()
+            store.open(sources)
+            content_hashes.reset(self, store)
+            labels = content_hashes.first_copies(store)
+            store.flush()
+            _, firsts, inverse = np.unique(labels[image_ids], return_index=True, return_inverse=True)
+            copy_of = firsts[inverse]
+            copy_of[copy_of == np.arange(len(copy_of))] = -1
+            return copy_of.tolist()
+        return find_copies
+
+    def rescan_sources(self):
+        self.selection.rescan()
+        if self.store.sources:
+            # keep the feature store in line with the new image lists
+            self.reload_features()
+
+    def export(self, preset: ExportPreset, to_archive: bool = False):
+        if to_archive:
+            archive = easygui.filesavebox(default="export.zip", filetypes=["*.zip", "*.tar", "*.tar.gz"])
+            if archive is None:
+                return
+            self.export_job = ExportJob(self.selection.selected_paths(), preset, archive=archive,
+                                        copy_mode=self.copy_mode, find_copies=self.export_copies())
+        else:
+            directory = easygui.diropenbox()
+            if directory is None:
+                return
+            self.export_job = ExportJob(self.selection.selected_paths(), preset, folder=directory,
+                                        copy_mode=self.copy_mode, find_copies=self.export_copies())
+        self.export_job.start()
 
     def new_file(self, allow_popup=True):
         if allow_popup and self.changed:
@@ -205,16 +591,36 @@ class Application:
         self.changed = False
 
     def open_file(self, file: str):
-        self.selection = Selection.from_file(file)
+        self.listing_validator.cancel()
+        self.selection = Selection.from_file(file, use_listings=self.save_listings)
+        for source in self.selection.unchecked_sources:
+            self.listing_validator.submit(source.absolute_path, source.listing_mtime_ns, IMAGE_EXTENSIONS)
         self.current_file = file
         self.changed = False
 
-    def open(self, allow_popup=True):
+    def reconcile_listings(self):
+        # folders that changed since their listing was saved get their new listing, the selection follows the files
+        updated = False
+        for path, image_paths, mtime_ns in self.listing_validator.finished():
+            for source_index, source in enumerate(self.selection.sources):
+                if source.is_folder and source.absolute_path == path and source in self.selection.unchecked_sources:
+                    print(f"The folder {source.name} changed since it was saved, "
+                          f"{len(image_paths)-len(source.image_paths):+d} images.")
+                    self.selection.update_listing(source_index, image_paths, mtime_ns)
+                    updated = True
+        if not self.listing_validator.pending:
+            self.selection.unchecked_sources.clear()
+        if updated and self.store.sources:
+            # the store ids follow the image lists, like after a rescan
+            self.reload_features()
+
+    def open(self, allow_popup=True, file: str | None = None):
         if allow_popup and self.changed:
             self.open_changes_popup = True
-            self.after_popup = functools.partial(self.open, allow_popup=False)
+            self.after_popup = functools.partial(self.open, allow_popup=False, file=file)
             return
-        file = easygui.fileopenbox(filetypes=["*.json"])
+        if file is None:
+            file = easygui.fileopenbox(filetypes=["*.json"])
         if file is None:
             return
         self.open_file(file)
@@ -223,14 +629,14 @@ class Application:
         if self.current_file is None:
             self.save_as()
             return
-        self.selection.save(self.current_file)
+        self.selection.save(self.current_file, self.save_listings)
         self.changed = False
 
     def save_as(self):
         new_file = easygui.filesavebox(filetypes=["*.json"], default=self.current_file)
         if new_file is None:
             return
-        self.selection.save(new_file)
+        self.selection.save(new_file, self.save_listings)
         self.current_file = new_file
         self.changed = False
 
@@ -248,11 +654,17 @@ class Application:
         self.selection.add_source(Source.from_folder(directory))
         self.changed = True
 
+    def measure(self, name: str):
+        return contextlib.nullcontext() if self.timings is None else self.timings.measure(name)
+
     def main_loop(self):
         for _ in self.window.loop():
+            if self.timings is not None:
+                self.timings.next_frame()
             self.window.caption = (f"picsel - {'new file' if self.current_file is None else self.current_file}"
                                    f"{'*' if self.changed else ''}")
             self.ui.process_events()
+            self.reconcile_listings()
 
             if self.window.is_key_down(pygame.K_LCTRL) and self.window.on_key_down(pygame.K_s):
                 self.save()
@@ -263,7 +675,10 @@ class Application:
                 else:
                     self.window.quit()
             for viewer in self.viewers:
-                viewer.handle_inputs(self)
+                with self.measure(viewer.name):
+                    viewer.handle_inputs(self)
+            # before any textures are drawn this frame, so none of them is released while in use
+            self.memory.enforce(self.memory_consumers().values())
 
             self.ui.new_frame()
 
@@ -287,9 +702,16 @@ class Application:
                 self.draw_source_window()
 
             for viewer in self.viewers:
-                viewer.draw_ui(self)
+                with self.measure(viewer.name):
+                    viewer.draw_ui(self)
+            if self.export_job is not None:
+                self.draw_export_progress()
+            if self.show_combine:
+                self.draw_combine_window()
 
-            self.ui.render()
+            with self.measure("ui render"):
+                self.ui.render()
 
 SOURCES_WINDOW_WIDTH = 200.
+MEGABYTE = 1 << 20
 IMAGE_EXTENSIONS = {".png", ".jpeg", ".jpg"}
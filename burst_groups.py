@@ -0,0 +1,75 @@
+from __future__ import annotations
+import numpy as np
+from perceptual_hash import hamming_distances
+
+
+# images taken closer together than this belong to the same burst, in seconds
+DEFAULT_BURST_GAP = 2.
+# and closer together than this to the same session
+DEFAULT_SESSION_GAP = 30*60.
+
+
+class TimeGroups:
+    """
+    Partition of the images with a capture time into runs of consecutive images in time order, like bursts or
+    sessions. Images without a capture time are not part of a group, every other image is, even when it is alone.
+    """
+    def __init__(self, order: np.ndarray, starts: np.ndarray, size: int):
+        # image ids in time order, and where every group starts in it
+        self.order = order
+        self.starts = starts
+        self.sizes = np.diff(np.r_[starts, len(order)])
+        # the group of every image id and its rank in time order, -1 for images without a capture time
+        self.group_of = np.full(size, -1, dtype=np.int64)
+        self.group_of[order] = np.repeat(np.arange(len(starts)), self.sizes)
+        self.rank_of = np.full(size, -1, dtype=np.int64)
+        self.rank_of[order] = np.arange(len(order))
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def nbytes(self) -> int:
+        return self.order.nbytes + self.starts.nbytes + self.sizes.nbytes + self.group_of.nbytes + self.rank_of.nbytes
+
+    def members(self, group: int) -> np.ndarray:
+        start = self.starts[group]
+        return self.order[start:start+self.sizes[group]]
+
+    def groups_within(self, other: TimeGroups) -> np.ndarray:
+        # for groups that are nested in the groups of `other', like bursts in sessions, the outer group of each
+        return other.group_of[self.order[self.starts]]
+
+
+def group_starts(times: np.ndarray, gap: int, splits: np.ndarray | None = None) -> np.ndarray:
+    # start of every run of sorted times without a gap larger than `gap', also starting runs where `splits' is set
+    breaks = np.diff(times) > gap
+    if splits is not None:
+        breaks |= splits
+    return np.flatnonzero(np.r_[len(times) > 0, breaks])
+
+
+def content_splits(order: np.ndarray, hashes: np.ndarray, hash_valid: np.ndarray, max_distance: int) -> np.ndarray:
+    # between consecutive images in time order, whether their perceptual hashes show a different scene
+    a, b = order[:-1], order[1:]
+    return (hash_valid[a] & hash_valid[b]) & (hamming_distances(hashes[a], hashes[b]) > max_distance)
+
+
+def bursts_and_sessions(times: np.ndarray, valid: np.ndarray, burst_gap: float = DEFAULT_BURST_GAP,
+                        session_gap: float = DEFAULT_SESSION_GAP, hashes: np.ndarray | None = None,
+                        hash_valid: np.ndarray | None = None, max_distance: int = 12) -> tuple[TimeGroups, TimeGroups]:
+    """
+    Groups images by the gaps between their capture times, in microseconds, with one sort and one difference over all
+    images. Bursts are split further where consecutive images look different when perceptual hashes are given.
+    Sessions use the larger gap and are never split by content, so every burst lies within one session.
+    """
+    ids = np.flatnonzero(valid)
+    times = np.asarray(times[ids], dtype=np.int64)
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    order = ids[order]
+    splits = None if hashes is None else content_splits(order, hashes, hash_valid, max_distance)
+    size = len(valid)
+    bursts = TimeGroups(order, group_starts(times, int(burst_gap*10**6), splits), size)
+    sessions = TimeGroups(order, group_starts(times, int(max(session_gap, burst_gap)*10**6)), size)
+    return bursts, sessions
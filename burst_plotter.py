@@ -0,0 +1,94 @@
+import imgui
+import numpy as np
+from application import Application
+from image_plotter import PositionGenerator, Layout
+from feature_store import FeatureStore
+from exif_reader import CaptureTimeExtractor
+from burst_groups import TimeGroups, bursts_and_sessions, DEFAULT_BURST_GAP, DEFAULT_SESSION_GAP
+
+
+GOLDEN_ANGLE = np.pi*(3-np.sqrt(5))
+
+
+def sunflower(ranks: np.ndarray) -> np.ndarray:
+    # evenly packed points on a spiral, the first n of them fill a disk of radius about sqrt(n)
+    radii = np.sqrt(ranks+.5)
+    angles = ranks*GOLDEN_ANGLE
+    return np.stack([radii*np.cos(angles), radii*np.sin(angles)], axis=1)
+
+
+def hsv_to_rgb(hues: np.ndarray, saturation: float, values: np.ndarray) -> np.ndarray:
+    sector = np.floor(hues*6).astype(int) % 6
+    fraction = hues*6 - np.floor(hues*6)
+    p = values*(1-saturation)
+    q = values*(1-saturation*fraction)
+    t = values*(1-saturation*(1-fraction))
+    channels = np.array([[values, t, p], [q, values, p], [p, values, t], [p, q, values], [t, p, values], [values, p, q]])
+    return channels[sector, :, np.arange(len(hues))]
+
+
+def ranks_in_groups(groups: TimeGroups) -> np.ndarray:
+    # the rank of every image within its group, in the time order of `groups.order'
+    return np.arange(len(groups.order)) - np.repeat(groups.starts, groups.sizes)
+
+
+class BurstPlotter(PositionGenerator):
+    """
+    Lays out every session of images in a cell of a grid, in time order, with the bursts of the session as small
+    clusters spiraling out from its center. Sessions alternate in hue and bursts in brightness.
+    """
+    def __init__(self):
+        self.times = CaptureTimeExtractor()
+        self.burst_gap = DEFAULT_BURST_GAP
+        self.session_gap = DEFAULT_SESSION_GAP/60
+        self.log_point_radius = -9
+        self.alpha = 1.
+
+    @property
+    def name(self) -> str:
+        return "Burst clusters"
+
+    def draw_ui(self) -> bool:
+        burst_changed, self.burst_gap = imgui.input_float("burst gap (s)", self.burst_gap)
+        self.burst_gap = max(0., self.burst_gap)
+        session_changed, self.session_gap = imgui.input_float("session gap (min)", self.session_gap)
+        self.session_gap = max(0., self.session_gap)
+        radius_changed, self.log_point_radius = imgui.slider_float("point radius", self.log_point_radius, -15, -4)
+        alpha_changed, self.alpha = imgui.slider_float("point alpha", self.alpha, 0., 1.)
+        return burst_changed or session_changed or radius_changed or alpha_changed
+
+    def reset(self, app: Application, store: FeatureStore):
+        self.times.reset(app, store)
+
+    def get_layout(self, store: FeatureStore) -> Layout:
+        times, valid, _ = self.times.time_columns(store)
+        result = Layout(np.zeros((len(store), 2), dtype=float), np.ones(len(store), dtype=float),
+                        np.tile(np.array([1., 0., 0., 0.]), (len(store), 1)))
+        if not valid.any():
+            return result
+        bursts, sessions = bursts_and_sessions(times, valid, self.burst_gap, self.session_gap*60)
+        # images spiral around their burst center, bursts around the session center
+        burst_of = bursts.group_of[bursts.order]
+        burst_sessions = bursts.groups_within(sessions)
+        # both are in time order, so the bursts of a session are consecutive
+        first_bursts = np.searchsorted(burst_sessions, np.arange(len(sessions)))
+        burst_ranks = np.arange(len(bursts)) - first_bursts[burst_sessions]
+        # bursts of a session are spaced by its largest burst, so clusters do not overlap
+        session_spacing = np.maximum.reduceat(np.sqrt(bursts.sizes)+1., first_bursts)
+        offsets = (sunflower(ranks_in_groups(bursts).astype(float))
+                   + sunflower(burst_ranks.astype(float))[burst_of]*2*session_spacing[burst_sessions[burst_of], None])
+        # every session is scaled to fit its cell of the grid, but never enlarged beyond the point size
+        columns = int(np.ceil(np.sqrt(len(sessions))))
+        cell = 2./columns
+        point = 2**self.log_point_radius
+        session_of = sessions.group_of[bursts.order]
+        extents = np.maximum.reduceat(np.linalg.norm(offsets, axis=1)+1., sessions.starts)
+        scales = np.minimum(2.2*point, .45*cell/extents)
+        cell_centers = np.stack([session_of % columns, session_of // columns], axis=1)*cell - 1. + cell/2
+        result.centers[bursts.order] = cell_centers + offsets*scales[session_of, None]
+        result.radii[bursts.order] = np.minimum(point, scales[session_of]/2.2)
+        hues = (session_of*GOLDEN_ANGLE/(2*np.pi)) % 1.
+        values = np.where(burst_of % 2 == 0, .9, .6)
+        result.colors[bursts.order, :3] = hsv_to_rgb(hues, .7, values)
+        result.colors[bursts.order, 3] = self.alpha
+        return result
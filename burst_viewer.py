@@ -0,0 +1,173 @@
+from __future__ import annotations
+import imgui
+import numpy as np
+import pygame
+from application import Application, Source, Viewer
+from feature_store import FeatureExtractor
+from image_viewer import ImageViewer
+from list_viewer import ListViewer
+from exif_reader import CaptureTimeExtractor, from_microseconds
+from perceptual_hash import PerceptualHashExtractor
+from memory_budget import MemoryConsumer, MeasuredMemory
+from burst_groups import TimeGroups, bursts_and_sessions, DEFAULT_BURST_GAP, DEFAULT_SESSION_GAP
+
+
+MAX_LISTED_SESSIONS = 500
+
+
+class BurstViewer(Viewer):
+    """
+    Groups the images of all sources into bursts and sessions by the gaps between their capture times, optionally
+    splitting bursts where the perceptual hashes of consecutive images differ. With grouped navigation on, left and
+    right step through the current burst, up and down jump to the next or previous burst and page up and page down
+    to the next or previous session.
+    """
+    def __init__(self):
+        self.is_shown = False
+        self.image_viewer: ImageViewer | None = None
+        self.times = CaptureTimeExtractor()
+        self.hashes = PerceptualHashExtractor()
+        self.burst_gap = DEFAULT_BURST_GAP
+        self.session_gap = DEFAULT_SESSION_GAP/60
+        self.split_by_content = False
+        self.max_distance = 12
+        self.bursts: TimeGroups | None = None
+        self.sessions: TimeGroups | None = None
+        self.group_sources: list[Source] = []
+        self.grouped_navigation = False
+        # the burst the image viewer steps through, and the catalog positions it was given for it
+        self.navigated_burst = -1
+        self.navigation_positions: np.ndarray | None = None
+
+    @property
+    def name(self) -> str:
+        return "Bursts and sessions"
+
+    def open(self):
+        self.is_shown = True
+
+    def get_extractors(self) -> list[FeatureExtractor]:
+        # the hashes need every image decoded once, so they are only computed when asked for
+        return [self.times, self.hashes] if self.split_by_content else [self.times]
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        return {"burst and session groups": MeasuredMemory(
+            lambda: sum(groups.nbytes for groups in (self.bursts, self.sessions) if groups is not None))}
+
+    def find_groups(self, app: Application):
+        app.reload_features()
+        times, valid, _ = self.times.time_columns(app.store)
+        hashes, hash_valid = self.hashes.hash_columns(app.store) if self.split_by_content else (None, None)
+        self.bursts, self.sessions = bursts_and_sessions(times, valid, self.burst_gap, self.session_gap*60,
+                                                         hashes, hash_valid, self.max_distance)
+        self.group_sources = list(app.store.sources)
+        self.navigated_burst = -1
+        print(f"Found {len(self.bursts)} bursts in {len(self.sessions)} sessions.")
+
+    def is_grouped(self, app: Application) -> bool:
+        # the groups are by feature store id, which are catalog positions when the store has the current sources
+        return (self.bursts is not None and app.store.sources == self.group_sources
+                and ListViewer.store_matches(app))
+
+    def current_id(self, app: Application) -> int | None:
+        if self.image_viewer is None or self.image_viewer.current_source not in app.store.offsets:
+            return None
+        return app.store.image_id(self.image_viewer.current_source, self.image_viewer.current_image)
+
+    def jump(self, app: Application, groups: TimeGroups, image_id: int, step: int):
+        # to the first image of the next or previous group in time order
+        group = int(groups.group_of[image_id])
+        if group < 0:
+            # images without a capture time jump to the first or last group
+            group = -1 if step > 0 else 0
+        target = (group+step) % len(groups)
+        self.image_viewer.set_image(app, *app.store.image_from_id(int(groups.order[groups.starts[target]])))
+
+    def follow_burst(self, app: Application, image_id: int):
+        # left and right step through the current burst, wrapping around at its ends
+        burst = int(self.bursts.group_of[image_id])
+        catalog = app.selection.catalog
+        if burst == self.navigated_burst and self.image_viewer.navigation_order is self.navigation_positions:
+            return
+        self.navigated_burst = burst
+        self.navigation_positions = None if burst < 0 else self.bursts.members(burst)
+        self.image_viewer.set_navigation_order(catalog, self.navigation_positions)
+
+    def stop_following(self, app: Application):
+        if self.navigation_positions is not None and self.image_viewer.navigation_order is self.navigation_positions:
+            self.image_viewer.set_navigation_order(app.selection.catalog, None)
+        self.navigated_burst = -1
+        self.navigation_positions = None
+
+    def handle_inputs(self, app: Application) -> None:
+        if self.image_viewer is None:
+            for viewer in app.viewers:
+                if isinstance(viewer, ImageViewer):
+                    self.image_viewer = viewer
+                    break
+        if self.image_viewer is None:
+            return
+        image_id = self.current_id(app)
+        if not self.grouped_navigation or not self.is_grouped(app) or image_id is None:
+            self.stop_following(app)
+            return
+        self.follow_burst(app, image_id)
+        if app.ui.want_capture_keyboard or len(self.bursts) == 0:
+            return
+        for key, groups, step in ((pygame.K_DOWN, self.bursts, 1), (pygame.K_UP, self.bursts, -1),
+                                  (pygame.K_PAGEDOWN, self.sessions, 1), (pygame.K_PAGEUP, self.sessions, -1)):
+            if app.window.on_key_down(key):
+                self.jump(app, groups, image_id, step)
+                break
+
+    def draw_position(self, app: Application):
+        image_id = self.current_id(app)
+        if image_id is None or self.bursts.group_of[image_id] < 0:
+            imgui.text("The shown image has no capture time.")
+            return
+        burst = int(self.bursts.group_of[image_id])
+        session = int(self.sessions.group_of[image_id])
+        rank = int(self.bursts.rank_of[image_id]-self.bursts.starts[burst])
+        imgui.text(f"image {rank+1}/{self.bursts.sizes[burst]} of burst {burst+1}/{len(self.bursts)}, "
+                   f"session {session+1}/{len(self.sessions)}")
+
+    def draw_ui(self, app: Application) -> None:
+        if not self.is_shown:
+            return
+        with imgui.begin("Bursts and sessions", True, imgui.WINDOW_NO_COLLAPSE) as window:
+            if not window.opened:
+                self.is_shown = False
+            if imgui.button("Group"):
+                self.find_groups(app)
+            imgui.push_item_width(120)
+            _, self.burst_gap = imgui.input_float("burst gap (s)", self.burst_gap)
+            self.burst_gap = max(0., self.burst_gap)
+            _, self.session_gap = imgui.input_float("session gap (min)", self.session_gap)
+            self.session_gap = max(0., self.session_gap)
+            _, self.split_by_content = imgui.checkbox("split bursts by content", self.split_by_content)
+            if self.split_by_content:
+                imgui.same_line()
+                _, x = imgui.input_int("max hash distance", self.max_distance)
+                self.max_distance = min(64, max(0, x))
+            imgui.pop_item_width()
+            if not self.is_grouped(app):
+                imgui.text("Press 'Group' to group the current sources.")
+                return
+            _, self.grouped_navigation = imgui.checkbox("grouped navigation", self.grouped_navigation)
+            imgui.text("left/right: within burst, up/down: bursts, page up/down: sessions")
+            imgui.text(f"{len(self.bursts)} bursts in {len(self.sessions)} sessions, "
+                       f"{len(self.bursts.order)} images with a capture time")
+            self.draw_position(app)
+            times, _, _ = self.times.time_columns(app.store)
+            session_bursts = np.bincount(self.bursts.groups_within(self.sessions), minlength=len(self.sessions))
+            with imgui.begin_child("sessions", 0., 0., True):
+                for session in range(min(len(self.sessions), MAX_LISTED_SESSIONS)):
+                    first = int(self.sessions.order[self.sessions.starts[session]])
+                    imgui.push_id(f"session {session}")
+                    if imgui.small_button(">") and self.image_viewer is not None:
+                        self.image_viewer.set_image(app, *app.store.image_from_id(first))
+                    imgui.pop_id()
+                    imgui.same_line()
+                    start = from_microseconds(int(times[first]))
+                    imgui.text(f"{start:%Y-%m-%d %H:%M}: {self.sessions.sizes[session]} images in "
+                               f"{session_bursts[session]} bursts")
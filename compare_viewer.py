@@ -0,0 +1,301 @@
+from __future__ import annotations
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+import imgui
+import numpy as np
+import pygame
+from application import Application, Source, Viewer
+from image_viewer import ImageViewer, ZOOM_FACTOR, MAX_ZOOM
+from image_pyramid import ImagePyramid, TileCache
+from duplicate_viewer import DuplicateViewer
+from burst_viewer import BurstViewer
+from memory_budget import MemoryConsumer, MeasuredMemory
+
+
+MIN_CANDIDATES = 2
+MAX_CANDIDATES = 8
+# one worker per candidate, so a whole group decodes at once
+COMPARE_WORKERS = max(2, min(MAX_CANDIDATES, os.cpu_count() or 2))
+# the decoded tiles of the open group stay in memory up to this size, whatever the shared budget says
+COMPARE_CACHE_BYTES = 1 << 30
+AREA_TOP_LEFT_OFFSET = (15, 85)
+AREA_BOTTOM_RIGHT_OFFSET = (15, 15)
+TILE_GAP = 8.
+OUTLINE_THICKNESS = 4
+FOCUS_COLOR = (1., 1., 1., 1.)
+SELECTED_COLOR = (0., .7, 0., 1.)
+REJECTED_COLOR = (.7, 0., 0., 1.)
+KEY_HELP = "1-8/tab: focus, F: only focused, A: select, X: reject, O: keep only focused"
+
+
+def grid_shape(count: int, available_size: np.ndarray) -> tuple[int, int]:
+    # columns and rows that leave the tiles closest to square
+    best = (count, 1)
+    best_ratio = float("inf")
+    for columns in range(1, count+1):
+        rows = math.ceil(count/columns)
+        ratio = abs(math.log((available_size[0]/columns)/(available_size[1]/rows)))
+        if ratio < best_ratio:
+            best, best_ratio = (columns, rows), ratio
+    return best
+
+
+class CompareViewer(Viewer):
+    """
+    Shows two to eight candidate images side by side with one zoom and pan for all of them, to pick the best of a
+    burst or a group of near duplicates. Zoom and pan are kept relative to the size of every image, so they line up
+    even when the sizes differ. All candidates are decoded in parallel at the resolution of the whole compare area
+    and stay decoded while the group is open, so switching focus or showing only the focused image never waits for a
+    decode.
+    """
+    def __init__(self):
+        self.is_shown = False
+        self.image_viewer: ImageViewer | None = None
+        self.burst_viewer: BurstViewer | None = None
+        self.duplicate_viewer: DuplicateViewer | None = None
+        self.executor = ThreadPoolExecutor(COMPARE_WORKERS)
+        self.tile_cache = TileCache(COMPARE_CACHE_BYTES)
+        self.candidates: list[tuple[Source, int]] = []
+        self.pyramids: list[ImagePyramid] = []
+        self.focus = 0
+        self.only_focused = False
+        # zoom relative to fitting the image in its tile, and the shown point as a fraction of the image size
+        self.zoom = 1.
+        self.view_center = np.full(2, .5)
+        self.is_focused = False
+
+    @property
+    def name(self) -> str:
+        return "Compare"
+
+    def open(self):
+        self.is_shown = True
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        # not a cache for the shared budget, the tiles of the open group have to stay
+        return {"compared image tiles": MeasuredMemory(lambda: self.tile_cache.nbytes)}
+
+    def set_candidates(self, app: Application, candidates: list[tuple[Source, int]]):
+        # candidates that stay keep their decoded levels and textures
+        candidates = candidates[:MAX_CANDIDATES]
+        pyramids = dict(zip(self.candidates, self.pyramids))
+        for candidate, pyramid in pyramids.items():
+            if candidate not in candidates:
+                self.release_pyramid(app, pyramid)
+        self.candidates = candidates
+        self.pyramids = [pyramids[candidate] if candidate in pyramids else self.open_pyramid(*candidate)
+                         for candidate in candidates]
+        self.focus = min(self.focus, max(0, len(candidates)-1))
+
+    def open_pyramid(self, source: Source, index: int) -> ImagePyramid:
+        pyramid = ImagePyramid(os.path.join(source.relative_to_dir, source.image_paths[index]), self.executor,
+                               self.tile_cache)
+        pyramid.request_level(pyramid.coarsest_level)
+        return pyramid
+
+    def release_pyramid(self, app: Application, pyramid: ImagePyramid):
+        pyramid.release(app.window.textures)
+        self.tile_cache.remove_image(pyramid.path)
+
+    def close_group(self, app: Application):
+        for pyramid in self.pyramids:
+            pyramid.release(app.window.textures)
+        self.pyramids = []
+        self.candidates = []
+        self.tile_cache.clear()
+
+    def add_candidate(self, app: Application, source: Source, index: int):
+        if (source, index) not in self.candidates and len(self.candidates) < MAX_CANDIDATES:
+            self.set_candidates(app, self.candidates + [(source, index)])
+
+    def remove_focused(self, app: Application):
+        if self.candidates:
+            self.set_candidates(app, self.candidates[:self.focus] + self.candidates[self.focus+1:])
+
+    def candidates_from_ids(self, app: Application, image_ids: np.ndarray) -> list[tuple[Source, int]]:
+        return [app.store.image_from_id(int(image_id)) for image_id in image_ids[:MAX_CANDIDATES]]
+
+    def shown_group(self, app: Application) -> list[tuple[Source, int]]:
+        # the burst or near duplicate group of the image in the image viewer
+        if self.burst_viewer is not None and self.burst_viewer.is_grouped(app):
+            image_id = self.burst_viewer.current_id(app)
+            if image_id is not None and self.burst_viewer.bursts.group_of[image_id] >= 0:
+                burst = self.burst_viewer.bursts.members(int(self.burst_viewer.bursts.group_of[image_id]))
+                if len(burst) > 1:
+                    return self.candidates_from_ids(app, burst)
+        if self.duplicate_viewer is not None:
+            group = self.duplicate_viewer.current_group(app)
+            if group is not None:
+                return self.candidates_from_ids(app, group)
+        return []
+
+    def set_focused_selected(self, app: Application, selected: bool):
+        self.set_selected(app, self.candidates[self.focus], selected)
+
+    @staticmethod
+    def set_selected(app: Application, candidate: tuple[Source, int], selected: bool):
+        source, index = candidate
+        if source in app.selection.sources:
+            app.selection.set_selected(app.selection.sources.index(source), [index], selected)
+            app.changed = True
+
+    def is_selected(self, app: Application, candidate: tuple[Source, int]) -> bool:
+        source, index = candidate
+        return source in app.selection.sources and index in app.selection.subsets[app.selection.sources.index(source)]
+
+    def handle_inputs(self, app: Application) -> None:
+        if not self.is_shown or not self.is_focused or not self.candidates or app.ui.want_capture_keyboard:
+            return
+        for digit in app.window.digit_presses:
+            if 1 <= digit <= len(self.candidates):
+                self.focus = digit-1
+        if app.window.on_key_down(pygame.K_TAB):
+            self.focus = (self.focus+1) % len(self.candidates)
+        if app.window.on_key_down(pygame.K_f):
+            self.only_focused = not self.only_focused
+        if app.window.on_key_down(pygame.K_a):
+            self.set_focused_selected(app, True)
+        elif app.window.on_key_down(pygame.K_x):
+            self.set_focused_selected(app, False)
+        elif app.window.on_key_down(pygame.K_o):
+            for i, candidate in enumerate(self.candidates):
+                self.set_selected(app, candidate, i == self.focus)
+
+    def fit_scale(self, pyramid: ImagePyramid, tile_size: np.ndarray) -> float:
+        return float(min(tile_size/np.array(pyramid.size, dtype=float)))
+
+    def view_transform(self, pyramid: ImagePyramid, tile_size: np.ndarray) -> tuple[float, np.ndarray]:
+        # the scale and the image pixel in the middle of the tile
+        size = np.array(pyramid.size, dtype=float)
+        scale = self.fit_scale(pyramid, tile_size)*self.zoom
+        if self.zoom <= 1.:
+            return scale, size/2
+        return scale, self.view_center*size
+
+    def zoom_at(self, pyramid: ImagePyramid, cursor_offset: np.ndarray, factor: float, tile_size: np.ndarray):
+        # zooms all tiles alike, keeping the point under the cursor in place in the tile it is over
+        size = np.array(pyramid.size, dtype=float)
+        scale, center = self.view_transform(pyramid, tile_size)
+        point = center + cursor_offset/scale
+        fit = self.fit_scale(pyramid, tile_size)
+        self.zoom = max(1., min(MAX_ZOOM/fit, self.zoom*factor))
+        self.view_center = np.clip((point - cursor_offset/(fit*self.zoom))/size, 0., 1.)
+
+    def handle_tile_inputs(self, app: Application, i: int, origin: np.ndarray, tile_size: np.ndarray):
+        pyramid = self.pyramids[i]
+        imgui.set_cursor_screen_pos(tuple(origin))
+        imgui.invisible_button(f"compare tile {i}", *tile_size)
+        if imgui.is_item_clicked(0):
+            self.focus = i
+        if imgui.is_item_hovered():
+            cursor_offset = app.window.cur_pos - origin - tile_size/2
+            if app.window.get_scroll_wheel_y() != 0:
+                self.zoom_at(pyramid, cursor_offset, ZOOM_FACTOR**app.window.get_scroll_wheel_y(), tile_size)
+            if imgui.is_mouse_double_clicked(0) and self.image_viewer is not None:
+                self.image_viewer.set_image(app, *self.candidates[i])
+        if imgui.is_item_active() and self.zoom > 1.:
+            scale, _ = self.view_transform(pyramid, tile_size)
+            delta = app.window.delta_cur/scale/np.array(pyramid.size, dtype=float)
+            self.view_center = np.clip(self.view_center - delta, 0., 1.)
+
+    def draw_tile(self, app: Application, i: int, origin: np.ndarray, tile_size: np.ndarray):
+        pyramid = self.pyramids[i]
+        scale, center = self.view_transform(pyramid, tile_size)
+        image_origin = origin + tile_size/2 - center*scale
+        visible_min = np.maximum(center - tile_size/2/scale, 0.)
+        visible_max = np.minimum(center + tile_size/2/scale, pyramid.size)
+        # the decoded tiles of the levels up to the one for the current zoom, over the coarsest one
+        target = pyramid.request_view(scale, center, tile_size)
+        levels = range(pyramid.coarsest_level, target-1, -1)
+        draw_list = imgui.get_window_draw_list()
+        draw_list.push_clip_rect(*origin, *(origin+tile_size), True)
+        for level in levels:
+            for x, y in pyramid.tiles_in_rect(level, *visible_min, *visible_max):
+                tile = pyramid.tile_texture(level, x, y, app.window.textures, app.window.uploads)
+                if tile is None:
+                    continue
+                x0, y0, x1, y1 = pyramid.tile_rect(level, x, y)
+                draw_list.add_image(tile.glo, tuple(image_origin + np.array([x0, y0])*scale),
+                                    tuple(image_origin + np.array([x1, y1])*scale), (0, 0), tile.uv_max)
+        draw_list.pop_clip_rect()
+        top_left = np.round(image_origin + visible_min*scale)
+        bottom_right = np.round(image_origin + visible_max*scale)
+        color = SELECTED_COLOR if self.is_selected(app, self.candidates[i]) else REJECTED_COLOR
+        draw_list.add_rect(*top_left, *bottom_right, imgui.get_color_u32_rgba(*color), thickness=OUTLINE_THICKNESS)
+        if i == self.focus and not self.only_focused:
+            draw_list.add_rect(*(origin-2), *(origin+tile_size+2), imgui.get_color_u32_rgba(*FOCUS_COLOR),
+                               thickness=2)
+        source, index = self.candidates[i]
+        draw_list.add_text(origin[0]+4, origin[1]+4, imgui.get_color_u32_rgba(1., 1., 1., 1.),
+                           f"{i+1}: {os.path.basename(source.image_paths[index])}")
+
+    def prefetch(self, available_size: np.ndarray):
+        # every candidate at the resolution of the whole area, so showing only the focused one needs no decode
+        for pyramid in self.pyramids:
+            pyramid.request_view(*self.view_transform(pyramid, available_size), available_size)
+
+    def draw_controls(self, app: Application):
+        if imgui.button("Compare shown group"):
+            group = self.shown_group(app)
+            if group:
+                self.set_candidates(app, group)
+                self.focus = 0
+                self.zoom = 1.
+        imgui.same_line()
+        if imgui.button("Add shown image") and self.image_viewer is not None \
+                and self.image_viewer.current_source is not None:
+            self.add_candidate(app, self.image_viewer.current_source, self.image_viewer.current_image)
+        imgui.same_line()
+        if imgui.button("Remove focused"):
+            self.remove_focused(app)
+        imgui.same_line()
+        if imgui.button("Close group"):
+            self.close_group(app)
+        imgui.same_line()
+        if imgui.small_button("fit"):
+            self.zoom = 1.
+        imgui.same_line()
+        _, self.only_focused = imgui.checkbox("only focused", self.only_focused)
+        imgui.text(KEY_HELP)
+
+    def draw_ui(self, app: Application) -> None:
+        if self.image_viewer is None:
+            for viewer in app.viewers:
+                if isinstance(viewer, ImageViewer):
+                    self.image_viewer = viewer
+                elif isinstance(viewer, BurstViewer):
+                    self.burst_viewer = viewer
+                elif isinstance(viewer, DuplicateViewer):
+                    self.duplicate_viewer = viewer
+        if not self.is_shown:
+            if self.candidates:
+                self.close_group(app)
+            return
+        with imgui.begin("Compare", True, imgui.WINDOW_NO_COLLAPSE) as window:
+            if not window.opened:
+                self.is_shown = False
+            self.is_focused = imgui.is_window_focused(imgui.FOCUS_ROOT_AND_CHILD_WINDOWS)
+            if any(source not in app.selection.sources for source, _ in self.candidates):
+                # a source was removed, the candidates from it are gone
+                self.set_candidates(app, [candidate for candidate in self.candidates
+                                          if candidate[0] in app.selection.sources])
+            self.draw_controls(app)
+            if len(self.candidates) < MIN_CANDIDATES:
+                imgui.text("Compare the burst or near duplicate group of the shown image, "
+                           "or add at least two images one by one.")
+                return
+            window_size = np.array(imgui.get_window_size(), dtype=float)
+            area_origin = np.array(imgui.get_window_position(), dtype=float) + AREA_TOP_LEFT_OFFSET
+            available_size = np.maximum(100., window_size - AREA_TOP_LEFT_OFFSET - AREA_BOTTOM_RIGHT_OFFSET)
+            self.prefetch(available_size)
+            if self.only_focused:
+                self.handle_tile_inputs(app, self.focus, area_origin, available_size)
+                self.draw_tile(app, self.focus, area_origin, available_size)
+                return
+            columns, rows = grid_shape(len(self.candidates), available_size)
+            tile_size = (available_size - TILE_GAP*np.array([columns-1, rows-1]))/np.array([columns, rows])
+            for i in range(len(self.candidates)):
+                origin = area_origin + np.array([i % columns, i // columns])*(tile_size+TILE_GAP)
+                self.handle_tile_inputs(app, i, origin, tile_size)
+                self.draw_tile(app, i, origin, tile_size)
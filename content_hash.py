@@ -0,0 +1,134 @@
+from __future__ import annotations
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+import typing
+from typing import Callable
+import numpy as np
+from feature_store import FeatureStore, FeatureExtractor
+if typing.TYPE_CHECKING:
+    from application import Application
+
+
+DIGEST_SIZE = 16
+# bytes hashed at the start and at the end of a file for the partial hash, which tells most same size files apart
+PARTIAL_BYTES = 64 << 10
+READ_CHUNK = 1 << 20
+# hashlib releases the GIL for large buffers, so threads hash and read in parallel
+HASH_WORKERS = min(16, 2*(os.cpu_count() or 2))
+
+
+def partial_hash(path: str) -> bytes:
+    with open(path, "rb") as file:
+        digest = hashlib.blake2b(file.read(PARTIAL_BYTES), digest_size=DIGEST_SIZE)
+        file.seek(0, os.SEEK_END)
+        if file.tell() > PARTIAL_BYTES:
+            file.seek(max(PARTIAL_BYTES, file.tell()-PARTIAL_BYTES))
+            digest.update(file.read(PARTIAL_BYTES))
+    return digest.digest()
+
+
+def full_hash(path: str) -> bytes:
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    with open(path, "rb") as file:
+        while chunk := file.read(READ_CHUNK):
+            digest.update(chunk)
+    return digest.digest()
+
+
+def _hash_all(function: Callable[[str], bytes], paths: list[str]) -> list[bytes | None]:
+    def safe(path: str) -> bytes | None:
+        try:
+            return function(path)
+        except OSError:
+            return None
+    if len(paths) < 2*HASH_WORKERS:
+        return [safe(path) for path in paths]
+    with ThreadPoolExecutor(HASH_WORKERS) as executor:
+        return list(executor.map(safe, paths, chunksize=16))
+
+
+def shared_keys(keys: list[np.ndarray], ids: np.ndarray) -> np.ndarray:
+    # the ids whose combination of keys occurs more than once among `ids'
+    if len(ids) == 0:
+        return ids
+    order = np.lexsort([key[ids] for key in reversed(keys)])
+    sorted_ids = ids[order]
+    same = np.ones(len(ids)-1, dtype=bool)
+    for key in keys:
+        same &= key[sorted_ids[1:]] == key[sorted_ids[:-1]]
+    shared = np.zeros(len(ids), dtype=bool)
+    shared[1:] |= same
+    shared[:-1] |= same
+    return np.sort(sorted_ids[shared])
+
+
+def first_copies(keys: list[np.ndarray], ids: np.ndarray, size: int) -> np.ndarray:
+    # for every image the smallest id with the same keys among `ids', the image itself when it is not among them
+    labels = np.arange(size)
+    if len(ids) == 0:
+        return labels
+    # lexsort is stable, so the first of every run of equal keys is the smallest id
+    order = np.lexsort([key[ids] for key in reversed(keys)])
+    sorted_ids = ids[order]
+    same = np.ones(len(ids)-1, dtype=bool)
+    for key in keys:
+        same &= key[sorted_ids[1:]] == key[sorted_ids[:-1]]
+    run_starts = np.flatnonzero(np.r_[True, ~same])
+    labels[sorted_ids] = np.repeat(sorted_ids[run_starts], np.diff(np.r_[run_starts, len(ids)]))
+    return labels
+
+
+class ContentHashExtractor(FeatureExtractor):
+    """
+    Finds files with exactly the same bytes over all sources. Only files that share their size with another file can
+    have a copy, so only those get a partial hash of their first and last bytes, and only files that still share
+    size and partial hash are read completely for a BLAKE2 hash. The hashes are kept in the feature store, which
+    drops them when the modification time or size of a file changes.
+    """
+    def __init__(self):
+        # changes after every reset, so derived results know to be computed again
+        self.generation = 0
+
+    @staticmethod
+    def hash_columns(store: FeatureStore, kind: str) -> tuple[np.ndarray, np.ndarray]:
+        # the digests as two uint64 halves, and whether they were computed
+        return store.column(f"{kind}_hash", np.uint64, (2,)), store.column(f"{kind}_hash_valid", bool)
+
+    @staticmethod
+    def keys(store: FeatureStore, kind: str | None = None) -> list[np.ndarray]:
+        keys = [np.asarray(store.column("file_size", np.int64))]
+        if kind is not None:
+            digests = np.asarray(ContentHashExtractor.hash_columns(store, kind)[0])
+            keys += [digests[:, 0], digests[:, 1]]
+        return keys
+
+    def update_hashes(self, store: FeatureStore, kind: str, candidates: np.ndarray,
+                      function: Callable[[str], bytes]) -> np.ndarray:
+        # computes the missing hashes of the candidates, returns the candidates that have one
+        digests, valid = self.hash_columns(store, kind)
+        missing = candidates[~valid[candidates]]
+        if len(missing) > 0:
+            print(f"Computing {kind} content hashes of {len(missing)} files...")
+            for image_id, digest in zip(missing, _hash_all(function, store.paths(missing))):
+                if digest is not None:
+                    digests[image_id] = np.frombuffer(digest, dtype=np.uint64)
+                    valid[image_id] = True
+        return candidates[valid[candidates]]
+
+    def reset(self, app: Application, store: FeatureStore):
+        candidates = shared_keys(self.keys(store), np.arange(len(store)))
+        candidates = self.update_hashes(store, "partial", candidates, partial_hash)
+        candidates = shared_keys(self.keys(store, "partial"), candidates)
+        self.update_hashes(store, "full", candidates, full_hash)
+        # only once all hashes are in, this can run in the background of an export while viewers read the results
+        self.generation += 1
+
+    def first_copies(self, store: FeatureStore) -> np.ndarray:
+        """
+        For every image the id of the first image with the same content, which is the image itself for images without
+        a copy or that were not hashed.
+        """
+        keys = self.keys(store, "full")
+        _, valid = self.hash_columns(store, "full")
+        return first_copies(keys, np.flatnonzero(valid), len(store))
@@ -0,0 +1,110 @@
+from __future__ import annotations
+import os
+import imgui
+import numpy as np
+import pygame
+from application import Application, Source, Viewer
+from feature_store import FeatureExtractor
+from image_viewer import ImageViewer
+from memory_budget import MemoryConsumer, MeasuredMemory
+from perceptual_hash import PerceptualHashExtractor, DuplicateGroups, connected_labels, near_duplicate_pairs
+
+
+MAX_LISTED_GROUPS = 500
+
+
+class DuplicateViewer(Viewer):
+    """
+    Finds groups of near duplicate images over all sources by their perceptual hashes. While an image of a group is
+    shown in the image viewer, G jumps to the next image of the group and K keeps only that image selected.
+    """
+    def __init__(self):
+        self.is_shown = False
+        self.image_viewer: ImageViewer | None = None
+        self.extractor = PerceptualHashExtractor()
+        self.radius = 4
+        self.groups: DuplicateGroups | None = None
+        self.group_sources: list[Source] = []
+
+    @property
+    def name(self) -> str:
+        return "Near duplicates"
+
+    def open(self):
+        self.is_shown = True
+
+    def get_extractors(self) -> list[FeatureExtractor]:
+        return [self.extractor]
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        return {"duplicate groups": MeasuredMemory(lambda: 0 if self.groups is None else self.groups.nbytes)}
+
+    def find_groups(self, app: Application):
+        app.reload_features()
+        hashes, valid = self.extractor.hash_columns(app.store)
+        ids = np.flatnonzero(valid)
+        a, b = near_duplicate_pairs(hashes[ids], self.radius)
+        self.groups = DuplicateGroups(connected_labels(len(app.store), ids[a], ids[b]))
+        self.group_sources = list(app.store.sources)
+        print(f"Found {len(self.groups)} groups of near duplicates.")
+
+    def current_group(self, app: Application) -> np.ndarray | None:
+        if (self.groups is None or self.image_viewer is None or app.store.sources != self.group_sources
+                or self.image_viewer.current_source not in app.store.offsets):
+            return None
+        image_id = app.store.image_id(self.image_viewer.current_source, self.image_viewer.current_image)
+        members = self.groups.members_of(image_id)
+        return members if len(members) > 1 else None
+
+    def handle_inputs(self, app: Application) -> None:
+        if self.image_viewer is None:
+            for viewer in app.viewers:
+                if isinstance(viewer, ImageViewer):
+                    self.image_viewer = viewer
+                    break
+        if app.ui.want_capture_keyboard:
+            return
+        group = self.current_group(app)
+        if group is None:
+            return
+        image_id = app.store.image_id(self.image_viewer.current_source, self.image_viewer.current_image)
+        if app.window.on_key_down(pygame.K_g):
+            position = int(np.searchsorted(group, image_id))
+            self.image_viewer.set_image(app, *app.store.image_from_id(int(group[(position+1) % len(group)])))
+        elif app.window.on_key_down(pygame.K_k):
+            self.keep_only(app, group, image_id)
+
+    @staticmethod
+    def keep_only(app: Application, group: np.ndarray, keep: int):
+        source_indices = {source: i for i, source in enumerate(app.selection.sources)}
+        for image_id in group:
+            source, index = app.store.image_from_id(int(image_id))
+            if source in source_indices:
+                app.selection.set_selected(source_indices[source], [index], image_id == keep)
+        app.changed = True
+
+    def draw_ui(self, app: Application) -> None:
+        if not self.is_shown:
+            return
+        with imgui.begin("Near duplicates", True, imgui.WINDOW_NO_COLLAPSE) as window:
+            if not window.opened:
+                self.is_shown = False
+            if imgui.button("Find duplicates"):
+                self.find_groups(app)
+            _, x = imgui.input_int("max hash distance", self.radius)
+            self.radius = min(16, max(0, x))
+            if self.groups is None or app.store.sources != self.group_sources:
+                imgui.text("Press 'Find duplicates' to group the current sources.")
+                return
+            imgui.text(f"{len(self.groups)} groups, {int(self.groups.sizes.sum())} images")
+            imgui.text("G: next image in group, K: keep shown image, deselect rest")
+            with imgui.begin_child("duplicate_groups", 0., 0., True):
+                for group in range(min(len(self.groups), MAX_LISTED_GROUPS)):
+                    members = self.groups.members(group)
+                    source, index = app.store.image_from_id(int(members[0]))
+                    imgui.push_id(f"duplicate group {group}")
+                    if imgui.small_button(">") and self.image_viewer is not None:
+                        self.image_viewer.set_image(app, source, index)
+                    imgui.pop_id()
+                    imgui.same_line()
+                    imgui.text(f"{os.path.basename(source.image_paths[index])} ({len(members)} images)")
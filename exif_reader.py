@@ -0,0 +1,329 @@
+from __future__ import annotations
+import datetime
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+import numpy as np
+from application import Application
+from feature_store import FeatureStore, FeatureExtractor
+
+
+EXIF_IFD_POINTER = 0x8769
+GPS_IFD_POINTER = 0x8825
+MAKE, MODEL = 0x010F, 0x0110
+EXPOSURE_TIME, F_NUMBER, ISO_SPEED = 0x829A, 0x829D, 0x8827
+FOCAL_LENGTH, FOCAL_LENGTH_35MM, LENS_MODEL = 0x920A, 0xA405, 0xA434
+METADATA_TAGS = {MAKE, MODEL, EXPOSURE_TIME, F_NUMBER, ISO_SPEED, FOCAL_LENGTH, FOCAL_LENGTH_35MM, LENS_MODEL}
+# tags of the GPS IFD, which has its own numbering
+GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE = 1, 2, 3, 4
+THUMBNAIL_OFFSET = 0x0201
+THUMBNAIL_LENGTH = 0x0202
+# (date time tag, sub second tag) pairs in order of preference, see doi.org/10.3189/2013JoG12J126, sect. 2.2, 2.3
+TIME_TAGS = [(36867, 37521),  # (DateTimeOriginal, SubsecTimeOriginal)
+             (36868, 37522),  # (DateTimeDigitized, SubsecTimeDigitized)
+             (306, 37520)]    # (DateTime, SubsecTime)
+TIME_TAG_SET = {tag for pair in TIME_TAGS for tag in pair}
+READ_AHEAD = 1 << 16
+MAX_IFD_ENTRIES = 1024
+BULK_WORKERS = 16
+EPOCH = datetime.datetime(1970, 1, 1)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+
+
+T = TypeVar("T")
+
+
+class ExifError(Exception):
+    pass
+
+
+class TiffReader:
+    """
+    Minimal reader for the IFDs of a TIFF structure, which is also how EXIF data is stored inside JPEG and PNG files.
+    Only the bytes that are needed are read through `read_at', which takes an offset relative to the TIFF header.
+    """
+    def __init__(self, read_at: Callable[[int, int], bytes]):
+        self.read_at = read_at
+        header = read_at(0, 8)
+        if len(header) < 8 or header[:2] not in (b"II", b"MM"):
+            raise ExifError("no TIFF header")
+        self.endian = "<" if header[:2] == b"II" else ">"
+        if struct.unpack(self.endian + "H", header[2:4])[0] != 42:
+            raise ExifError("bad TIFF magic number")
+        self.first_ifd = struct.unpack(self.endian + "I", header[4:8])[0]
+
+    def read_ifd(self, offset: int) -> dict[int, tuple[int, int, bytes]]:
+        # returns a mapping from tag to (type, count, raw value or offset bytes)
+        count_data = self.read_at(offset, 2)
+        if len(count_data) < 2:
+            raise ExifError("truncated IFD")
+        count = min(struct.unpack(self.endian + "H", count_data)[0], MAX_IFD_ENTRIES)
+        data = self.read_at(offset+2, 12*count)
+        entries = {}
+        for i in range(len(data)//12):
+            tag, value_type, value_count = struct.unpack(self.endian + "HHI", data[12*i:12*i+8])
+            entries[tag] = (value_type, value_count, data[12*i+8:12*i+12])
+        return entries
+
+    def next_ifd(self, offset: int) -> int:
+        # offset of the IFD that follows the one at `offset', 0 if there is none
+        count_data = self.read_at(offset, 2)
+        if len(count_data) < 2:
+            raise ExifError("truncated IFD")
+        data = self.read_at(offset+2+12*struct.unpack(self.endian + "H", count_data)[0], 4)
+        return struct.unpack(self.endian + "I", data)[0] if len(data) == 4 else 0
+
+    def value(self, entry: tuple[int, int, bytes]) -> bytes:
+        value_type, count, raw = entry
+        size = TYPE_SIZES.get(value_type, 1)*count
+        if size <= 4:
+            return raw[:size]
+        return self.read_at(struct.unpack(self.endian + "I", raw)[0], size)
+
+    def int_value(self, entry: tuple[int, int, bytes]) -> int:
+        value_type, _, raw = entry
+        return struct.unpack(self.endian + ("H" if value_type == 3 else "I"), raw[:2 if value_type == 3 else 4])[0]
+
+    def rationals(self, entry: tuple[int, int, bytes]) -> list[float]:
+        # unsigned (type 5) or signed (type 10) fractions, nan where the denominator is zero
+        value_type, count, _ = entry
+        if value_type not in (5, 10):
+            raise ExifError("not a rational")
+        numbers = struct.unpack(self.endian + ("I" if value_type == 5 else "i")*(2*count), self.value(entry))
+        return [a/b if b != 0 else float("nan") for a, b in zip(numbers[::2], numbers[1::2])]
+
+    def number(self, entry: tuple[int, int, bytes]) -> float:
+        # the first value of an integer or rational entry
+        if entry[0] in (5, 10):
+            return self.rationals(entry)[0]
+        return float(self.int_value(entry))
+
+    def string(self, entry: tuple[int, int, bytes]) -> str:
+        return self.value(entry).split(b"\0", 1)[0].decode("ascii", errors="replace").strip()
+
+    def entries(self, tags: set[int]) -> dict[int, tuple[int, int, bytes]]:
+        # looks for the given tags in the first IFD and in the EXIF IFD it points to
+        ifd0 = self.read_ifd(self.first_ifd)
+        result = {tag: entry for tag, entry in ifd0.items() if tag in tags}
+        if EXIF_IFD_POINTER in ifd0:
+            exif_ifd = self.read_ifd(self.int_value(ifd0[EXIF_IFD_POINTER]))
+            result.update({tag: entry for tag, entry in exif_ifd.items() if tag in tags})
+        return result
+
+    def gps_entries(self) -> dict[int, tuple[int, int, bytes]]:
+        ifd0 = self.read_ifd(self.first_ifd)
+        if GPS_IFD_POINTER not in ifd0:
+            return {}
+        return self.read_ifd(self.int_value(ifd0[GPS_IFD_POINTER]))
+
+
+def _bytes_reader(data: bytes) -> Callable[[int, int], bytes]:
+    return lambda offset, size: data[offset:offset+size]
+
+
+def _file_reader(file, prefix: bytes) -> Callable[[int, int], bytes]:
+    # serves reads from the bytes that were already read ahead and only goes back to the file for the rest
+    def read_at(offset: int, size: int) -> bytes:
+        if offset+size <= len(prefix):
+            return prefix[offset:offset+size]
+        file.seek(offset)
+        return file.read(size)
+    return read_at
+
+
+def _jpeg_exif(file, prefix: bytes) -> TiffReader | None:
+    position = 2
+    while True:
+        if position+4 > len(prefix):
+            file.seek(position)
+            header = file.read(4)
+        else:
+            header = prefix[position:position+4]
+        if len(header) < 4 or header[0] != 0xFF:
+            return None
+        marker = header[1]
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            position += 2
+            continue
+        if marker in (0xDA, 0xD9):
+            # start of scan or end of image, all metadata comes before this
+            return None
+        length = struct.unpack(">H", header[2:4])[0]
+        if marker == 0xE1:
+            if position+2+length <= len(prefix):
+                segment = prefix[position+4:position+2+length]
+            else:
+                file.seek(position+4)
+                segment = file.read(length-2)
+            if segment.startswith(b"Exif\0\0"):
+                return TiffReader(_bytes_reader(segment[6:]))
+        position += 2+length
+
+
+def _png_exif(file, prefix: bytes) -> TiffReader | None:
+    position = len(PNG_SIGNATURE)
+    while True:
+        file.seek(position)
+        header = file.read(8)
+        if len(header) < 8:
+            return None
+        length, chunk_type = struct.unpack(">I4s", header)
+        if chunk_type == b"eXIf":
+            return TiffReader(_bytes_reader(file.read(length)))
+        if chunk_type in (b"IDAT", b"IEND"):
+            return None
+        position += 12+length
+
+
+def read_exif(path: str, read: Callable[[TiffReader], T]) -> T | None:
+    """
+    Finds the EXIF data of a JPEG, TIFF or PNG file and calls `read' on it while the file is open. Returns None when
+    the file has no EXIF data.
+    """
+    with open(path, "rb", buffering=READ_AHEAD) as file:
+        prefix = file.read(READ_AHEAD)
+        if prefix[:2] == b"\xFF\xD8":
+            reader = _jpeg_exif(file, prefix)
+        elif prefix[:4] in (b"II*\0", b"MM\0*"):
+            reader = TiffReader(_file_reader(file, prefix))
+        elif prefix.startswith(PNG_SIGNATURE):
+            reader = _png_exif(file, prefix)
+        else:
+            reader = None
+        return None if reader is None else read(reader)
+
+
+def parse_exif_time(date_time: str | None, sub_second: str | None) -> datetime.datetime | None:
+    if not date_time:
+        return None
+    try:
+        result = datetime.datetime.strptime(date_time[:19], "%Y:%m:%d %H:%M:%S")
+    except ValueError:
+        return None
+    digits = "".join(c for c in (sub_second or "") if c.isdigit())[:6]
+    if digits:
+        result += datetime.timedelta(microseconds=int(digits.ljust(6, "0")))
+    return result
+
+
+def read_capture_time(path: str) -> datetime.datetime | None:
+    """
+    Reads the capture time of an image from its EXIF data, reading only the first few kilobytes of the file. Returns
+    None for files without (valid) EXIF time stamps or that cannot be read.
+    """
+    try:
+        tags = read_exif(path, lambda reader: {tag: reader.string(entry)
+                                               for tag, entry in reader.entries(TIME_TAG_SET).items()})
+    except (OSError, ExifError, struct.error):
+        return None
+    if tags is None:
+        return None
+    for time_tag, sub_second_tag in TIME_TAGS:
+        result = parse_exif_time(tags.get(time_tag), tags.get(sub_second_tag))
+        if result is not None:
+            return result
+    return None
+
+
+def _thumbnail(reader: TiffReader) -> bytes | None:
+    # the thumbnail is described by the second IFD
+    offset = reader.next_ifd(reader.first_ifd)
+    if offset == 0:
+        return None
+    ifd = reader.read_ifd(offset)
+    if THUMBNAIL_OFFSET not in ifd or THUMBNAIL_LENGTH not in ifd:
+        return None
+    length = reader.int_value(ifd[THUMBNAIL_LENGTH])
+    data = reader.read_at(reader.int_value(ifd[THUMBNAIL_OFFSET]), length)
+    return data if len(data) == length and data.startswith(b"\xFF\xD8") else None
+
+
+def read_exif_thumbnail(path: str) -> bytes | None:
+    """
+    Returns the JPEG data of the thumbnail that most cameras embed in the EXIF data, or None if there is none.
+    """
+    try:
+        return read_exif(path, _thumbnail)
+    except (OSError, ExifError, struct.error):
+        return None
+
+
+def _gps_coordinate(reader: TiffReader, gps: dict, value_tag: int, reference_tag: int, negative: bytes) -> float:
+    # degrees, minutes and seconds to signed degrees
+    degrees, minutes, seconds = (reader.rationals(gps[value_tag]) + [0., 0.])[:3]
+    value = degrees + minutes/60 + seconds/3600
+    return -value if reader.value(gps[reference_tag])[:1] == negative else value
+
+
+def _metadata(reader: TiffReader) -> dict[str, float | str]:
+    entries = reader.entries(METADATA_TAGS)
+    result: dict[str, float | str] = {}
+    make = reader.string(entries[MAKE]) if MAKE in entries else ""
+    model = reader.string(entries[MODEL]) if MODEL in entries else ""
+    # most models already start with the name of the make
+    camera = model if model.lower().startswith(make.lower()) else f"{make} {model}".strip()
+    if camera:
+        result["camera"] = camera
+    if LENS_MODEL in entries and reader.string(entries[LENS_MODEL]):
+        result["lens"] = reader.string(entries[LENS_MODEL])
+    for name, tag in (("focal", FOCAL_LENGTH), ("focal35", FOCAL_LENGTH_35MM), ("iso", ISO_SPEED),
+                      ("shutter", EXPOSURE_TIME), ("aperture", F_NUMBER)):
+        if tag in entries:
+            result[name] = reader.number(entries[tag])
+    gps = reader.gps_entries()
+    if all(tag in gps for tag in (GPS_LATITUDE_REF, GPS_LATITUDE, GPS_LONGITUDE_REF, GPS_LONGITUDE)):
+        result["latitude"] = _gps_coordinate(reader, gps, GPS_LATITUDE, GPS_LATITUDE_REF, b"S")
+        result["longitude"] = _gps_coordinate(reader, gps, GPS_LONGITUDE, GPS_LONGITUDE_REF, b"W")
+    return result
+
+
+def read_metadata(path: str) -> dict[str, float | str]:
+    """
+    Reads the camera, lens, exposure settings and GPS position of an image from its EXIF data, by the names
+    "camera", "lens", "focal", "focal35", "iso", "shutter" (seconds), "aperture" (f-number), "latitude" and
+    "longitude" (degrees). Fields that are not present are left out, files that cannot be read give no fields.
+    """
+    try:
+        return read_exif(path, _metadata) or {}
+    except (OSError, ExifError, struct.error):
+        return {}
+
+
+def read_capture_times(paths: list[str], workers: int = BULK_WORKERS) -> list[datetime.datetime | None]:
+    # the work is almost all waiting on the disk, so many threads keep the reads in flight
+    if len(paths) < 2*workers:
+        return [read_capture_time(path) for path in paths]
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(read_capture_time, paths, chunksize=64))
+
+
+def to_microseconds(time: datetime.datetime) -> int:
+    return (time - EPOCH) // datetime.timedelta(microseconds=1)
+
+
+def from_microseconds(microseconds: int) -> datetime.datetime:
+    return EPOCH + datetime.timedelta(microseconds=int(microseconds))
+
+
+class CaptureTimeExtractor(FeatureExtractor):
+    """
+    Keeps the capture time of every image in the feature store as int64 microseconds since the epoch, with a mask of
+    the images that have a time stamp. The times are read straight from the files, without decoding any image.
+    """
+    @staticmethod
+    def time_columns(store: FeatureStore) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # capture times, whether a time was found and whether the file was read
+        return store.column("time", np.int64), store.column("time_valid", bool), store.column("time_read", bool)
+
+    def reset(self, app: Application, store: FeatureStore):
+        times, valid, read = self.time_columns(store)
+        missing = np.flatnonzero(~read)
+        if len(missing) == 0:
+            return
+        print(f"Reading capture times of {len(missing)} images...")
+        for image_id, time in zip(missing, read_capture_times(store.paths(missing))):
+            if time is not None:
+                times[image_id] = to_microseconds(time)
+                valid[image_id] = True
+        read[missing] = True
@@ -0,0 +1,324 @@
+from __future__ import annotations
+import io
+import multiprocessing
+import os
+import shutil
+import tarfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, Future, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from typing import Callable
+from PIL import Image, ImageOps
+
+
+ORIENTATION_TAG = 0x0112
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+EXPORT_WORKERS = os.cpu_count() or 1
+# tasks in flight per worker, enough to keep every worker busy without holding many results in memory
+TASKS_PER_WORKER = 2
+# what happens to files with the same content as an earlier file of the export
+WRITE_COPIES, SKIP_COPIES, LINK_COPIES = range(3)
+COPY_MODE_NAMES = ["write every copy", "skip identical files", "hardlink identical files"]
+
+
+@dataclass(frozen=True)
+class ExportPreset:
+    name: str
+    # size of the longest edge of the exported images, None to keep the original size
+    long_edge: int | None = None
+    # "JPEG" or "WEBP", None to keep the format of the original
+    format: str | None = None
+    quality: int = 90
+    keep_exif: bool = True
+    # rotate the pixels according to the EXIF orientation, for viewers that ignore it
+    bake_orientation: bool = False
+
+    @property
+    def is_copy(self) -> bool:
+        return self.long_edge is None and self.format is None and self.keep_exif and not self.bake_orientation
+
+    def output_name(self, file_name: str) -> str:
+        if self.format is None:
+            return file_name
+        return os.path.splitext(file_name)[0] + FORMAT_EXTENSIONS[self.format]
+
+
+DEFAULT_PRESETS = [
+    ExportPreset("Original files"),
+    ExportPreset("Web (2048 px JPEG, no metadata)", long_edge=2048, format="JPEG", quality=85, keep_exif=False,
+                 bake_orientation=True),
+    ExportPreset("Client (3840 px JPEG)", long_edge=3840, format="JPEG", quality=92, bake_orientation=True),
+    ExportPreset("Previews (1024 px WebP)", long_edge=1024, format="WEBP", quality=80, keep_exif=False,
+                 bake_orientation=True),
+]
+
+
+def convert_image(path: str, preset: ExportPreset) -> bytes:
+    # runs in a worker process
+    with Image.open(path) as image:
+        image_format = preset.format or image.format
+        icc_profile = image.info.get("icc_profile")
+        if preset.long_edge is not None:
+            scale = preset.long_edge/max(image.size)
+            if scale < 1:
+                # jpeg images are decoded at a reduced scale directly when that is still larger than the target
+                image.draft("RGB", (round(image.width*scale), round(image.height*scale)))
+        exif = image.getexif()
+        if preset.bake_orientation:
+            image = ImageOps.exif_transpose(image)
+            exif[ORIENTATION_TAG] = 1
+        if preset.long_edge is not None:
+            image.thumbnail((preset.long_edge, preset.long_edge), Image.LANCZOS, reducing_gap=3.)
+        if image_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        options = {"quality": preset.quality} if image_format in ("JPEG", "WEBP") else {}
+        if preset.keep_exif and len(exif) > 0:
+            options["exif"] = exif.tobytes()
+        if icc_profile:
+            options["icc_profile"] = icc_profile
+        result = io.BytesIO()
+        image.save(result, image_format, **options)
+        return result.getvalue()
+
+
+def export_image(path: str, output_name: str, preset: ExportPreset,
+                 folder: str | None) -> tuple[int, int, bytes | None]:
+    """
+    Exports one image, straight into `folder' when it is given, otherwise the exported data is returned so it can be
+    added to an archive. Returns the number of bytes read, the number of bytes written and the data.
+    """
+    size_in = os.path.getsize(path)
+    if preset.is_copy and folder is not None:
+        shutil.copy2(path, os.path.join(folder, output_name))
+        return size_in, size_in, None
+    if preset.is_copy:
+        with open(path, "rb") as file:
+            data = file.read()
+    else:
+        data = convert_image(path, preset)
+    if folder is None:
+        return size_in, len(data), data
+    with open(os.path.join(folder, output_name), "wb") as file:
+        file.write(data)
+    return size_in, len(data), None
+
+
+def unique_names(names: list[str]) -> list[str]:
+    # images from different sources can have the same name, later ones get a number appended
+    seen = set()
+    result = []
+    for name in names:
+        stem, extension = os.path.splitext(name)
+        candidate, n = name, 1
+        while candidate.lower() in seen:
+            candidate = f"{stem} ({n}){extension}"
+            n += 1
+        seen.add(candidate.lower())
+        result.append(candidate)
+    return result
+
+
+class ArchiveWriter:
+    """
+    Adds files to a zip or tar archive as they come in, so the archive is written while the export is running.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        if path.lower().endswith(".zip"):
+            # the images are compressed already
+            self.zip = zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED)
+            self.tar = None
+        else:
+            self.zip = None
+            self.tar = tarfile.open(path, "w:gz" if path.lower().endswith((".tar.gz", ".tgz")) else "w")
+
+    def add(self, name: str, data: bytes):
+        if self.zip is not None:
+            self.zip.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            self.tar.addfile(info, io.BytesIO(data))
+
+    def add_link(self, name: str, target: str) -> bool:
+        # tar archives can store a file again as a hard link to an earlier member, zip archives cannot
+        if self.tar is None:
+            return False
+        info = tarfile.TarInfo(name)
+        info.type = tarfile.LNKTYPE
+        info.linkname = target
+        info.mtime = int(time.time())
+        self.tar.addfile(info)
+        return True
+
+    def close(self):
+        if self.zip is not None:
+            self.zip.close()
+        else:
+            self.tar.close()
+
+
+class ExportJob:
+    """
+    Exports a list of images with a preset in a pool of worker processes, to a folder or to an archive. The job runs
+    in a background thread, the ui reads the progress counters while it runs. `copy_of' gives for every path the
+    index of an earlier path with the same content, or -1. Those copies are exported only once: the others are
+    skipped or become hard links to the exported file, as `copy_mode' says. Finding the copies means reading the
+    files, so it can be left to the job with `find_copies', which computes `copy_of' in the background thread.
+    """
+    def __init__(self, paths: list[str], preset: ExportPreset, folder: str | None = None,
+                 archive: str | None = None, workers: int = EXPORT_WORKERS, copy_of: list[int] | None = None,
+                 copy_mode: int = WRITE_COPIES, find_copies: Callable[[], list[int]] | None = None):
+        self.paths = paths
+        self.copy_of = [-1]*len(paths) if copy_of is None or copy_mode == WRITE_COPIES else list(copy_of)
+        self.copy_mode = copy_mode
+        self.find_copies = None if copy_mode == WRITE_COPIES else find_copies
+        # true while the copies are being looked for, before anything is exported
+        self.finding_copies = False
+        self.preset = preset
+        self.folder = folder
+        self.archive = archive
+        self.workers = workers
+        self.names = unique_names([preset.output_name(os.path.basename(path)) for path in paths])
+        self.done = 0
+        self.failed: list[tuple[str, str]] = []
+        self.skipped = 0
+        self.linked = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.start_time = 0.
+        self.end_time: float | None = None
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._thread.start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def total(self) -> int:
+        return len(self.paths)
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread.is_alive()
+
+    @property
+    def elapsed(self) -> float:
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    @property
+    def images_per_second(self) -> float:
+        return self.done/max(self.elapsed, 1e-6)
+
+    @property
+    def megabytes_per_second(self) -> float:
+        # measured on the original files that were read
+        return self.bytes_in/(1 << 20)/max(self.elapsed, 1e-6)
+
+    def _run(self):
+        if self.find_copies is not None:
+            self.finding_copies = True
+            try:
+                self.copy_of = self.find_copies()
+            except Exception as e:
+                # every copy is exported then, which is slower but complete
+                self.failed.append(("looking for identical files", str(e)))
+            self.finding_copies = False
+            if self._cancelled.is_set():
+                self.end_time = time.perf_counter()
+                return
+            # the rates are about the export itself
+            self.start_time = time.perf_counter()
+        writer = None if self.archive is None else ArchiveWriter(self.archive)
+        # spawned workers do not inherit the window and gl state of this process
+        context = multiprocessing.get_context("spawn")
+        try:
+            originals = [index for index, copy_of in enumerate(self.copy_of) if copy_of < 0]
+            exported = set()
+            with ProcessPoolExecutor(self.workers, mp_context=context) as executor:
+                while originals and not self._cancelled.is_set():
+                    exported |= self._export_indices(executor, originals, writer)
+                    originals = self._promote_copies(set(originals)-exported)
+            if not self._cancelled.is_set():
+                self._export_copies(exported, writer)
+        finally:
+            if writer is not None:
+                writer.close()
+            self.end_time = time.perf_counter()
+
+    def _export_indices(self, executor: ProcessPoolExecutor, indices: list[int],
+                        writer: ArchiveWriter | None) -> set[int]:
+        # exports the given paths in the pool, returns the ones that succeeded
+        exported = set()
+        pending: dict[Future, int] = {}
+        next_index = 0
+        while (next_index < len(indices) or pending) and not self._cancelled.is_set():
+            while next_index < len(indices) and len(pending) < TASKS_PER_WORKER*self.workers:
+                index = indices[next_index]
+                future = executor.submit(export_image, self.paths[index], self.names[index], self.preset, self.folder)
+                pending[future] = index
+                next_index += 1
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index = pending.pop(future)
+                if self._finish(future, index, writer):
+                    exported.add(index)
+        for future in pending:
+            future.cancel()
+        return exported
+
+    def _promote_copies(self, failed: set[int]) -> list[int]:
+        # the first copy of a file that failed to export is exported from its own path instead, the others follow it
+        promoted: dict[int, int] = {}
+        for index, original in enumerate(self.copy_of):
+            if original not in failed:
+                continue
+            if original in promoted:
+                self.copy_of[index] = promoted[original]
+            else:
+                self.copy_of[index] = -1
+                promoted[original] = index
+        return list(promoted.values())
+
+    def _finish(self, future: Future, index: int, writer: ArchiveWriter | None) -> bool:
+        try:
+            size_in, size_out, data = future.result()
+        except Exception as e:
+            self.failed.append((self.paths[index], str(e)))
+            return False
+        if writer is not None:
+            writer.add(self.names[index], data)
+        self.bytes_in += size_in
+        self.bytes_out += size_out
+        self.done += 1
+        return True
+
+    def _export_copies(self, exported: set[int], writer: ArchiveWriter | None):
+        # the same input and preset give the same output, so a copy can point at the exported original
+        for index, original in enumerate(self.copy_of):
+            if original < 0:
+                continue
+            if original not in exported or self.copy_mode != LINK_COPIES:
+                self.skipped += 1
+            elif writer is not None:
+                if writer.add_link(self.names[index], self.names[original]):
+                    self.linked += 1
+                else:
+                    self.skipped += 1
+            else:
+                try:
+                    os.link(os.path.join(self.folder, self.names[original]),
+                            os.path.join(self.folder, self.names[index]))
+                except OSError as e:
+                    # file systems without hard links, like FAT on memory cards
+                    self.failed.append((self.paths[index], str(e)))
+                    continue
+                self.linked += 1
+            self.done += 1
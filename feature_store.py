@@ -0,0 +1,304 @@
+from __future__ import annotations
+import abc
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import threading
+import time
+import typing
+import numpy as np
+from PIL import Image
+if typing.TYPE_CHECKING:
+    from application import Application, Source
+
+
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "picsel")
+FEATURES_DIR = "features"
+MANIFEST_FILE = "columns.json"
+# the image of every row, to find the rows of images again in the store of another set of sources
+PATHS_FILE = "paths.json"
+# stores that are kept besides the most recently used ones, as long as they were used recently
+KEPT_STORES = 8
+PRUNE_AGE = 7*24*3600.
+# shared by all stores, so a version number is never seen twice
+_store_versions = itertools.count(1)
+
+
+class FeatureStore:
+    """
+    Columnar per-image storage shared by all feature extractors. Every column is a typed NumPy array indexed by the
+    global image id, which is the position of the image when all sources are concatenated. Columns are persisted as
+    memory-mapped `.npy' files in the cache directory, keyed by the list of image paths, so a restart maps the data
+    that was already computed instead of decoding every image again. A new list of paths, after adding a source or
+    a file, starts with the rows of its images copied from the stores of earlier lists, so only the new images are
+    computed. Stores that were not used for a while are removed.
+    """
+    def __init__(self, cache_dir: str = CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.directory: str | None = None
+        self.sources: list[Source] = []
+        self.offsets: dict[Source, int] = {}
+        self.size = 0
+        self.columns: dict[str, np.ndarray] = {}
+        self._column_specs: dict[str, tuple[str, tuple[int, ...]]] = {}
+        # changes on every open, so viewers can tell that the image ids they hold may no longer be valid
+        self.version = 0
+
+    def __len__(self):
+        return self.size
+
+    def open(self, sources: list[Source]):
+        self.flush()
+        self.version = next(_store_versions)
+        self.sources = list(sources)
+        self.offsets = {}
+        paths = []
+        for source in self.sources:
+            self.offsets[source] = len(paths)
+            paths.extend(source.absolute_image_paths)
+        self.size = len(paths)
+        self.columns = {}
+        self._column_specs = {}
+        digest = hashlib.blake2b("\n".join(paths).encode(), digest_size=16).hexdigest()
+        self.directory = os.path.join(self.cache_dir, FEATURES_DIR, digest)
+        if not os.path.isdir(self.directory):
+            self._create_directory(paths)
+        prune_stores(self.cache_dir, self.directory)
+
+        manifest_path = os.path.join(self.directory, MANIFEST_FILE)
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as file:
+                for name, (dtype, shape) in json.load(file).items():
+                    self.column(name, dtype, tuple(shape))
+
+        # drop everything that was computed for files that changed since
+        stats = np.array([_file_stat(path) for path in paths], dtype=np.int64).reshape(len(paths), 2)
+        stored_mtimes = self.column("mtime_ns", np.int64)
+        stored_sizes = self.column("file_size", np.int64)
+        changed = (stored_mtimes != stats[:, 0]) | (stored_sizes != stats[:, 1])
+        if changed.any():
+            for name, column in self.columns.items():
+                column[changed] = 0
+            stored_mtimes[changed] = stats[changed, 0]
+            stored_sizes[changed] = stats[changed, 1]
+
+    def column(self, name: str, dtype, shape: tuple[int, ...] = ()) -> np.ndarray:
+        """
+        Returns the column with the given name, creating it filled with zeros when it does not exist yet. Boolean
+        columns therefore start out as all False, which is what generators use to mark what still has to be computed.
+        """
+        if name in self.columns:
+            return self.columns[name]
+        dtype = np.dtype(dtype)
+        full_shape = (self.size,) + tuple(shape)
+        path = os.path.join(self.directory, f"{name}.npy")
+        if self.size == 0:
+            # numpy refuses to memory-map empty files
+            array = np.zeros(full_shape, dtype=dtype)
+        elif os.path.isfile(path):
+            array = np.load(path, mmap_mode="r+")
+            if array.dtype != dtype or array.shape != full_shape:
+                array = _create_column_file(path, dtype, full_shape, replace=True)
+        else:
+            array = _create_column_file(path, dtype, full_shape)
+        self.columns[name] = array
+        self._column_specs[name] = (dtype.str, tuple(shape))
+        self._write_manifest()
+        return array
+
+    def image_id(self, source: Source, index: int) -> int:
+        return self.offsets[source]+index
+
+    def image_from_id(self, image_id: int) -> tuple[Source, int]:
+        source_index = np.searchsorted(list(self.offsets.values()), image_id, side="right")-1
+        source = self.sources[source_index]
+        return source, image_id-self.offsets[source]
+
+    def paths(self, image_ids: np.ndarray) -> list[str]:
+        # absolute paths of the given (sorted) image ids
+        result = []
+        starts = np.array(list(self.offsets.values()), dtype=np.int64)
+        source_indices = np.searchsorted(starts, image_ids, side="right")-1
+        for source_index, image_id in zip(source_indices, image_ids):
+            source = self.sources[source_index]
+            result.append(os.path.join(source.relative_to_dir, source.image_paths[image_id-starts[source_index]]))
+        return result
+
+    def source_slice(self, source: Source) -> slice:
+        offset = self.offsets[source]
+        return slice(offset, offset+len(source.image_paths))
+
+    def flush(self):
+        for column in self.columns.values():
+            if isinstance(column, np.memmap):
+                column.flush()
+        if self.directory is not None:
+            # the modification time of the directory tells when the store was last used
+            with contextlib.suppress(OSError):
+                os.utime(self.directory)
+
+    def _create_directory(self, paths: list[str]):
+        """
+        Creates the store of a new list of paths, filled with the rows of the same images in earlier stores. It is
+        built under a temporary name and renamed into place, so another process that opens the same images at the
+        same time either finds it complete or not at all.
+        """
+        directory = self.directory
+        temporary = f"{directory}.{os.getpid()}-{threading.get_ident()}.tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        self.directory = temporary
+        try:
+            keys = [os.path.abspath(path) for path in paths]
+            with open(os.path.join(temporary, PATHS_FILE), "w") as file:
+                json.dump(keys, file)
+            self._copy_rows(keys, directory)
+            self.flush()
+        finally:
+            # the columns are mapped again from their final place
+            self.columns = {}
+            self._column_specs = {}
+            self.directory = directory
+        try:
+            os.rename(temporary, directory)
+        except OSError:
+            # another process was first
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    def _copy_rows(self, keys: list[str], directory: str):
+        # every image takes its row from the most recently used store that has it, files that changed since are
+        # found by their modification time and size like in any store
+        rows = {key: row for row, key in enumerate(keys)}
+        filled = np.zeros(len(keys), dtype=bool)
+        for other in stores_by_use(self.cache_dir)[:KEPT_STORES]:
+            if other == directory or filled.all():
+                continue
+            try:
+                with open(os.path.join(other, PATHS_FILE)) as file:
+                    other_keys = json.load(file)
+                with open(os.path.join(other, MANIFEST_FILE)) as file:
+                    specs = json.load(file)
+            except (OSError, ValueError):
+                continue
+            targets = np.fromiter((rows.get(key, -1) for key in other_keys), dtype=np.int64, count=len(other_keys))
+            take = targets >= 0
+            take[take] = ~filled[targets[take]]
+            if not take.any():
+                continue
+            for name, (dtype, shape) in specs.items():
+                try:
+                    values = np.load(os.path.join(other, f"{name}.npy"), mmap_mode="r")
+                except (OSError, ValueError):
+                    continue
+                column = self.column(name, dtype, tuple(shape))
+                if values.dtype == column.dtype and values.shape == (len(other_keys),)+column.shape[1:]:
+                    column[targets[take]] = values[take]
+            filled[targets[take]] = True
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self.columns.values())
+
+    def _write_manifest(self):
+        if self.directory is None:
+            return
+        # other processes with the same sources may have added columns of their own since
+        path = os.path.join(self.directory, MANIFEST_FILE)
+        specs = {}
+        with contextlib.suppress(OSError, ValueError):
+            with open(path) as file:
+                specs = json.load(file)
+        specs.update(self._column_specs)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(specs, file)
+        os.replace(temporary_path, path)
+
+
+class FeatureExtractor(abc.ABC):
+    """
+    Something that computes per-image data during the reload pipeline of the application and keeps it in the columns
+    of the feature store.
+    """
+    def reset(self, app: Application, store: FeatureStore):
+        pass
+
+    def needs_image(self, store: FeatureStore) -> np.ndarray:
+        # mask of the images that still have to be opened and passed to `process'
+        return np.zeros(len(store), dtype=bool)
+
+    def process(self, app: Application, store: FeatureStore, image_id: int, pil_image: Image.Image):
+        pass
+
+
+def stores_by_use(cache_dir: str) -> list[str]:
+    # the store directories, the most recently used first
+    features_dir = os.path.join(cache_dir, FEATURES_DIR)
+    with contextlib.suppress(OSError):
+        stores = []
+        for entry in os.scandir(features_dir):
+            if entry.is_dir() and not entry.name.endswith(".tmp"):
+                stores.append((entry.stat().st_mtime, entry.path))
+        return [path for _, path in sorted(stores, reverse=True)]
+    return []
+
+
+def prune_stores(cache_dir: str, current: str):
+    """
+    Removes the stores that are neither among the most recently used nor used within the prune age, and temporary
+    stores of processes that died while creating them. Another process may still have a store open, so none is
+    removed soon after it was used.
+    """
+    features_dir = os.path.join(cache_dir, FEATURES_DIR)
+    now = time.time()
+    with contextlib.suppress(OSError):
+        for entry in os.scandir(features_dir):
+            if entry.name.endswith(".tmp") and now-entry.stat().st_mtime > PRUNE_AGE:
+                shutil.rmtree(entry.path, ignore_errors=True)
+    for store in stores_by_use(cache_dir)[KEPT_STORES:]:
+        with contextlib.suppress(OSError):
+            if store != current and now-os.stat(store).st_mtime > PRUNE_AGE:
+                shutil.rmtree(store, ignore_errors=True)
+
+
+def _create_column_file(path: str, dtype: np.dtype, shape: tuple[int, ...], replace: bool = False) -> np.memmap:
+    """
+    Creates a zeroed column file under a temporary name and only then puts it in place, so another process never maps
+    a file that is still being created or truncated. Without `replace', a file that another process created first is
+    used instead, which keeps what that process already wrote. Processes that mapped a replaced file keep their
+    mapping of the old one, they write to it in vain but safely.
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    array = np.lib.format.open_memmap(temporary_path, mode="w+", dtype=dtype, shape=shape)
+    array.flush()
+    if replace:
+        os.replace(temporary_path, path)
+        return array
+    try:
+        # unlike a rename, a link fails when the name already exists
+        os.link(temporary_path, path)
+    except FileExistsError:
+        del array
+        os.remove(temporary_path)
+        existing = np.load(path, mmap_mode="r+")
+        if existing.dtype == dtype and existing.shape == shape:
+            return existing
+        return _create_column_file(path, dtype, shape, replace=True)
+    except OSError:
+        # file systems without hard links
+        os.replace(temporary_path, path)
+        return array
+    os.remove(temporary_path)
+    return array
+
+
+def _file_stat(path: str) -> tuple[int, int]:
+    # modification time and size, zeros for files that cannot be read
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0, 0
+    return stat.st_mtime_ns, stat.st_size
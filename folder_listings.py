@@ -0,0 +1,100 @@
+from __future__ import annotations
+import contextlib
+import json
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+# saved next to the selection file, so the selection file itself stays small and readable
+LISTINGS_SUFFIX = ".listings.json"
+# folders on network drives are mostly waiting on the server, a few run at once
+LISTING_WORKERS = 4
+
+
+def scan_folder(path: str, extensions: set[str]) -> tuple[list[str], int]:
+    """
+    Lists the image files of a folder, sorted, together with the modification time of the folder. The time is read
+    before listing, so a file added while listing makes the snapshot look outdated rather than complete. The file
+    type comes from the directory entry, which on most file systems saves a stat call per file.
+    """
+    mtime_ns = os.stat(path).st_mtime_ns
+    with os.scandir(path) as entries:
+        names = [entry.name for entry in entries
+                 if os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file()]
+    return sorted(names), mtime_ns
+
+
+def check_listing(path: str, mtime_ns: int, extensions: set[str]) -> tuple[list[str], int] | None:
+    # a fresh listing when the folder changed since the snapshot, None when it did not or cannot be reached, in which
+    # case the snapshot stays and a rescan reports the problem
+    try:
+        if os.stat(path).st_mtime_ns == mtime_ns:
+            return None
+        return scan_folder(path, extensions)
+    except OSError:
+        return None
+
+
+def listings_path(selection_path: str) -> str:
+    return selection_path + LISTINGS_SUFFIX
+
+
+def load_listings(selection_path: str) -> dict[str, tuple[list[str], int]]:
+    # folder path relative to the selection file -> (image files, modification time), empty when there is no snapshot
+    try:
+        with open(listings_path(selection_path)) as file:
+            data = json.load(file)
+        return {folder: (listing["files"], int(listing["mtime_ns"])) for folder, listing in data["folders"].items()}
+    except (OSError, ValueError, KeyError, TypeError):
+        return {}
+
+
+def save_listings(selection_path: str, listings: dict[str, tuple[list[str], int]]):
+    data = {"folders": {folder: {"mtime_ns": mtime_ns, "files": files}
+                        for folder, (files, mtime_ns) in listings.items()}}
+    # written to a temporary file first, a half written snapshot would hide files on the next open
+    temporary_path = listings_path(selection_path) + ".tmp"
+    with open(temporary_path, "w") as file:
+        json.dump(data, file)
+    os.replace(temporary_path, listings_path(selection_path))
+
+
+def remove_listings(selection_path: str):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(listings_path(selection_path))
+
+
+class ListingValidator:
+    """
+    Checks folder listings that were taken from a snapshot against the disk in worker threads. Folders whose
+    modification time still matches cost one stat, the others are listed again and returned by `finished', so the
+    selection can reconcile them while the application keeps running.
+    """
+    def __init__(self, workers: int = LISTING_WORKERS):
+        self.executor = ThreadPoolExecutor(workers)
+        self.pending: dict[str, Future] = {}
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, path: str, mtime_ns: int, extensions: set[str]):
+        self.pending[path] = self.executor.submit(check_listing, path, mtime_ns, extensions)
+
+    def finished(self) -> list[tuple[str, list[str], int]]:
+        # (folder path, image files, modification time) of the checked folders that changed
+        changed = []
+        for path, future in list(self.pending.items()):
+            if not future.done():
+                continue
+            del self.pending[path]
+            if future.cancelled() or future.exception() is not None:
+                continue
+            listing = future.result()
+            if listing is not None:
+                changed.append((path, *listing))
+        return changed
+
+    def cancel(self):
+        for future in self.pending.values():
+            future.cancel()
+        self.pending.clear()
@@ -0,0 +1,82 @@
+from __future__ import annotations
+import collections
+import contextlib
+import json
+import sys
+import time
+import numpy as np
+
+
+PERCENTILES = (50, 99)
+FRAME = "frame"
+
+
+class FrameTimings:
+    """
+    Collects how long every frame took, in total and split into named parts such as the viewers, for comparing
+    replays of the same recorded session on different versions of the code.
+    """
+    def __init__(self):
+        self.samples: collections.defaultdict[str, list[float]] = collections.defaultdict(list)
+        self._current: dict[str, float] = {}
+        self._frame_start: float | None = None
+
+    def next_frame(self):
+        now = time.perf_counter()
+        if self._frame_start is not None:
+            self._current[FRAME] = now - self._frame_start
+            for name, duration in self._current.items():
+                self.samples[name].append(duration)
+        self._current = {}
+        self._frame_start = now
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            # parts that are measured more than once per frame are added up
+            self._current[name] = self._current.get(name, 0.) + time.perf_counter() - start
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        result = {}
+        for name, samples in self.samples.items():
+            milliseconds = np.array(samples)*1000
+            result[name] = {f"p{p}": float(np.percentile(milliseconds, p)) for p in PERCENTILES}
+            result[name]["mean"] = float(milliseconds.mean())
+        return result
+
+    def save(self, path: str):
+        with open(path, "w") as file:
+            json.dump({"frames": len(self.samples[FRAME]), "summary": self.summary(),
+                       "samples": {name: samples for name, samples in self.samples.items()}}, file)
+
+    def print_summary(self):
+        for name, stats in sorted(self.summary().items()):
+            print(f"{name:30} " + " ".join(f"{key} {value:8.2f} ms" for key, value in stats.items()))
+
+
+def compare_reports(base_path: str, new_path: str):
+    # prints the percentiles of two saved reports side by side
+    with open(base_path) as file:
+        base = json.load(file)["summary"]
+    with open(new_path) as file:
+        new = json.load(file)["summary"]
+    for name in sorted(set(base) | set(new)):
+        parts = []
+        for p in PERCENTILES:
+            key = f"p{p}"
+            a, b = base.get(name, {}).get(key), new.get(name, {}).get(key)
+            if a is None or b is None:
+                parts.append(f"{key} {'-' if a is None else f'{a:.2f}'} -> {'-' if b is None else f'{b:.2f}'} ms")
+            else:
+                parts.append(f"{key} {a:.2f} -> {b:.2f} ms ({(b-a)/max(a, 1e-9)*100:+.0f}%)")
+        print(f"{name:30} " + "   ".join(parts))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("usage: python frame_timings.py <base report> <new report>")
+        sys.exit(1)
+    compare_reports(sys.argv[1], sys.argv[2])
@@ -1,88 +1,79 @@
 import imgui
 import numpy as np
-import datetime
 from PIL import Image
-from application import Source, Application
-from image_plotter import PositionGenerator, CircleData
+from application import Application
+from image_plotter import PositionGenerator, Layout
+from feature_store import FeatureStore
+from exif_reader import CaptureTimeExtractor
 from hilbertcurve.hilbertcurve import HilbertCurve
 
 
-# from https://stackoverflow.com/questions/765396/exif-manipulation-library-for-python/765403#765403
-def time_from_image(image: Image.Image) -> datetime.datetime | None:
-    std_fmt = '%Y:%m:%d %H:%M:%S.%f'
-    # for subsecond prec, see doi.org/10.3189/2013JoG12J126 , sect. 2.2, 2.3
-    tags = [(36867, 37521),  # (DateTimeOriginal, SubsecTimeOriginal)
-            (36868, 37522),  # (DateTimeDigitized, SubsecTimeDigitized)
-            (306, 37520), ]  # (DateTime, SubsecTime)
-    exif = image._getexif()
-
-    dat = None
-    sub = None
-    for t in tags:
-        dat = exif.get(t[0])
-        sub = exif.get(t[1], 0)
-
-        # PIL.PILLOW_VERSION >= 3.0 returns a tuple
-        dat = dat[0] if type(dat) == tuple else dat
-        sub = sub[0] if type(sub) == tuple else sub
-        if dat is not None:
-            break
-
-    if dat is None:
-        return None
-    full = '{}.{}'.format(dat, sub)
-    return datetime.datetime.strptime(full, std_fmt)
-
-
 class HilbertPlotter(PositionGenerator):
     def __init__(self):
-        self.times: dict[Source, list[datetime.datetime]] = {}
-        self.colors: dict[Source, list[tuple]] = {}
-        self.min_time = datetime.datetime.max
-        self.max_time = datetime.datetime.min
+        self.times = CaptureTimeExtractor()
         self.curve_iterations = 20
         self.log_point_radius = -9
         self.alpha = 1.
         self.load_colors = False
+        # the curve points of the images with a capture time, by the store version and number of iterations they
+        # were computed for, so the point radius and alpha sliders do not walk the curve again
+        self.points_key: tuple[int, int] | None = None
+        self.points = np.zeros((0, 2))
 
     @property
     def name(self) -> str:
         return "Hilbert curve plot"
 
-    def reset(self, app: Application):
-        self.times = {source: [] for source in app.selection.sources}
-        self.colors = {source: [] for source in app.selection.sources} if self.load_colors else None
-        self.min_time = datetime.datetime.max
-        self.max_time = datetime.datetime.min
-
-    def draw_ui(self) -> None:
-        _, x = imgui.input_int("curve iterations", self.curve_iterations)
+    def draw_ui(self) -> bool:
+        iterations_changed, x = imgui.input_int("curve iterations", self.curve_iterations)
         self.curve_iterations = min(30, max(1, x))
-        _, self.log_point_radius = imgui.slider_float("point radius", self.log_point_radius, -15, -4)
-        _, self.alpha = imgui.slider_float("point alpha", self.alpha, 0., 1.)
+        radius_changed, self.log_point_radius = imgui.slider_float("point radius", self.log_point_radius, -15, -4)
+        alpha_changed, self.alpha = imgui.slider_float("point alpha", self.alpha, 0., 1.)
+        # the colors are read on the next reload, the layout does not change before that
         _, self.load_colors = imgui.checkbox("read colors", self.load_colors)
+        return iterations_changed or radius_changed or alpha_changed
+
+    def reset(self, app: Application, store: FeatureStore):
+        self.times.reset(app, store)
+
+    @staticmethod
+    def color_columns(store: FeatureStore) -> tuple[np.ndarray, np.ndarray]:
+        return store.column("color", np.uint8, (3,)), store.column("color_valid", bool)
+
+    def needs_image(self, store: FeatureStore) -> np.ndarray:
+        # the capture times are read without decoding, only the colors need the image
+        if not self.load_colors:
+            return np.zeros(len(store), dtype=bool)
+        return ~self.color_columns(store)[1]
+
+    def process(self, app: Application, store: FeatureStore, image_id: int, pil_image: Image.Image):
+        if self.load_colors:
+            colors, color_valid = self.color_columns(store)
+            pixel = pil_image.convert("RGB").getpixel((pil_image.width//2, pil_image.height//2))
+            colors[image_id] = pixel
+            color_valid[image_id] = True
 
-    def process(self, app: Application, source: Source, index: int, pil_image: Image.Image):
-        time = time_from_image(pil_image)
-        if time is not None:
-            self.min_time = min(self.min_time, time)
-            self.max_time = max(self.max_time, time)
-        self.times[source].append(time)
-        if self.colors is not None:
-            pixels = pil_image.getpixel((round(pil_image.width/2), round(pil_image.height/2)))
-            self.colors[source].append(pixels)
+    def get_layout(self, store: FeatureStore) -> Layout:
+        times, valid, _ = self.times.time_columns(store)
+        result = Layout(np.zeros((len(store), 2), dtype=float), np.ones(len(store), dtype=float),
+                        np.tile(np.array([1., 0., 0., 0.]), (len(store), 1)))
+        if not valid.any():
+            return result
+        if self.points_key != (store.version, self.curve_iterations) or len(self.points) != np.count_nonzero(valid):
+            valid_times = times[valid]
+            min_time, max_time = valid_times.min(), valid_times.max()
+            t = (valid_times - min_time) / max(max_time - min_time, 1)
+            curve_size = 1 << self.curve_iterations*2
+            distances = np.minimum(np.round(t*curve_size).astype(np.int64), curve_size-1)
+            self.points = np.array(HilbertCurve(self.curve_iterations, 2).points_from_distances(distances.tolist()),
+                                   dtype=float).reshape(-1, 2) / (1 << self.curve_iterations)
+            self.points_key = store.version, self.curve_iterations
 
-    def get_circle_data(self, source: Source, index: int) -> CircleData:
-        time = self.times[source][index]
-        if time is None:
-            return CircleData(np.array([0., 0.]), 1, np.array([1., 0., 0., 0.]))
-        t = (time - self.min_time) / (self.max_time - self.min_time)
-        curve = HilbertCurve(self.curve_iterations, 2)
-        int_t = round(t*(1 << self.curve_iterations*2))
-        p = np.array(curve.point_from_distance(int_t), dtype=float) / (1 << self.curve_iterations)
-        if self.colors is None:
-            color = (.7, 0., 0.)
-        else:
-            color = tuple(np.array(self.colors[source][index], dtype=float)/255)
-        color = color + (self.alpha,)
-        return CircleData(np.array([-1., -1.]) + 2 * p, 2**self.log_point_radius, color)
+        result.centers[valid] = np.array([-1., -1.]) + 2 * self.points
+        result.radii[valid] = 2**self.log_point_radius
+        colors, color_valid = self.color_columns(store)
+        result.colors[valid, :3] = (.7, 0., 0.)
+        with_color = valid & color_valid
+        result.colors[with_color, :3] = colors[with_color]/255
+        result.colors[valid, 3] = self.alpha
+        return result
@@ -0,0 +1,106 @@
+from __future__ import annotations
+import array
+import itertools
+import sys
+import typing
+import numpy as np
+if typing.TYPE_CHECKING:
+    from application import Source
+
+
+# shared by all catalogs, so a version number is never seen twice even when the selection is replaced
+_versions = itertools.count(1)
+
+
+class ImageCatalog:
+    """
+    Flat table of all images of a selection. Every image gets a global id the first time it is seen, and keeps it for
+    as long as the catalog lives, also when its source is rescanned and files are added or removed around it.
+    Separately, images are numbered by position: the images of all sources one after the other, which is the order
+    used for navigation. Paths are interned in one byte buffer, so the table stays compact for large collections.
+    """
+    def __init__(self):
+        # (source path, image path within the source) -> id
+        self._ids: dict[tuple[str, str], int] = {}
+        self._path_data = bytearray()
+        self._path_ends = array.array("q")
+        self.sources: list[Source] = []
+        self._source_indices: dict[Source, int] = {}
+        # positions of the first image of every source, with the total number of images at the end
+        self.source_starts = np.zeros(1, dtype=np.int64)
+        self.position_ids = np.zeros(0, dtype=np.int64)
+        self.position_sources = np.zeros(0, dtype=np.int32)
+        # position of every id, -1 for ids of images that are no longer part of any source
+        self.id_positions = np.zeros(0, dtype=np.int64)
+        # changes on every update, so other objects can tell that positions may have moved
+        self.version = 0
+
+    def __len__(self):
+        return len(self.position_ids)
+
+    @property
+    def nbytes(self) -> int:
+        # the id dictionary shares its strings with the sources, only the table itself is counted
+        arrays = (self.source_starts, self.position_ids, self.position_sources, self.id_positions)
+        return (sys.getsizeof(self._ids) + len(self._path_data) + self._path_ends.itemsize*len(self._path_ends)
+                + sum(array.nbytes for array in arrays))
+
+    @property
+    def id_count(self) -> int:
+        return len(self._path_ends)
+
+    def intern(self, source: Source, image_path: str, absolute_path: str) -> int:
+        key = (source.absolute_path, image_path)
+        image_id = self._ids.get(key)
+        if image_id is None:
+            image_id = len(self._path_ends)
+            self._ids[key] = image_id
+            self._path_data += absolute_path.encode()
+            self._path_ends.append(len(self._path_data))
+        return image_id
+
+    def update(self, sources: list[Source]):
+        self.sources = list(sources)
+        self._source_indices = {source: i for i, source in enumerate(self.sources)}
+        ids = array.array("q")
+        for source in self.sources:
+            for image_path, absolute_path in zip(source.image_paths, source.absolute_image_paths):
+                ids.append(self.intern(source, image_path, absolute_path))
+        counts = np.array([len(source.image_paths) for source in self.sources], dtype=np.int64)
+        self.source_starts = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.position_ids = np.frombuffer(ids, dtype=np.int64).copy()
+        self.position_sources = np.repeat(np.arange(len(self.sources), dtype=np.int32), counts)
+        self.id_positions = np.full(self.id_count, -1, dtype=np.int64)
+        self.id_positions[self.position_ids] = np.arange(len(self.position_ids))
+        self.version = next(_versions)
+
+    def source_index(self, source: Source) -> int:
+        return self._source_indices[source]
+
+    def source_ids(self, source: Source) -> np.ndarray:
+        source_index = self._source_indices[source]
+        return self.position_ids[self.source_starts[source_index]:self.source_starts[source_index+1]]
+
+    def position(self, source: Source, index: int) -> int:
+        return int(self.source_starts[self._source_indices[source]])+index
+
+    def at(self, position: int) -> tuple[Source, int]:
+        source_index = int(self.position_sources[position])
+        return self.sources[source_index], position-int(self.source_starts[source_index])
+
+    def image_id(self, source: Source, index: int) -> int:
+        return int(self.position_ids[self.position(source, index)])
+
+    def locate(self, image_id: int) -> tuple[Source, int] | None:
+        # None when the image is no longer part of the selection
+        if image_id >= self.id_count or self.id_positions[image_id] < 0:
+            return None
+        return self.at(int(self.id_positions[image_id]))
+
+    def step(self, source: Source, index: int, offset: int) -> tuple[Source, int]:
+        # the image `offset' positions further, wrapping around from the last source to the first
+        return self.at((self.position(source, index)+offset) % len(self))
+
+    def path(self, image_id: int) -> str:
+        start = self._path_ends[image_id-1] if image_id > 0 else 0
+        return self._path_data[start:self._path_ends[image_id]].decode()
@@ -1,67 +1,83 @@
 from __future__ import annotations
+import easygui
 import imgui
+import moderngl
 import numpy as np
 from application import Application, Source, Viewer
 from pygame_gl_code import PygameGLWindow
 from image_viewer import ImageViewer
+from query_viewer import MetadataQueryViewer
+from feature_store import FeatureStore, FeatureExtractor
+from selection_tools import GridIndex, points_in_rect, points_in_polygon, extend_lasso
+from plot_renderer import PlotRenderer, VISIBLE_FLAG, SELECTED_FLAG, DIMMED_FLAG
+from memory_budget import MemoryConsumer, MeasuredMemory
+from plot_poster import PosterJob, POSTER_FILE_TYPES, fit_view
 import abc
-from PIL import Image
+import itertools
 from dataclasses import dataclass
 
 
 @dataclass
-class CircleData:
-    center: np.ndarray
-    radius: float
-    color: np.ndarray
+class Layout:
+    centers: np.ndarray
+    radii: np.ndarray
+    colors: np.ndarray
 
     @classmethod
-    def lerp(cls, a: CircleData, b: CircleData, t: float):
-        return CircleData(a.center*(1-t)+b.center*t,
-                          a.radius*(1-t)+b.radius*t,
-                          a.color*(1-t)+b.color*t)
+    def lerp(cls, a: Layout, b: Layout, t: float) -> Layout:
+        return Layout(a.centers*(1-t)+b.centers*t,
+                      a.radii*(1-t)+b.radii*t,
+                      a.colors*(1-t)+b.colors*t)
 
+    def __len__(self):
+        return len(self.radii)
 
-class PositionGenerator(abc.ABC):
-    def reset(self, app: Application):
-        pass
 
+class PositionGenerator(FeatureExtractor):
+    """
+    Generators keep all their per-image data in columns of the shared feature store, indexed by global image id.
+    """
     @property
     @abc.abstractmethod
     def name(self) -> str:
         pass
 
     @abc.abstractmethod
-    def process(self, app: Application, source: Source, index: int, pil_image: Image.Image):
-        pass
-
-    @abc.abstractmethod
-    def get_circle_data(self, source: Source, index: int) -> CircleData:
+    def get_layout(self, store: FeatureStore) -> Layout:
         pass
 
-    def draw_ui(self) -> None:
-        pass
+    def draw_ui(self) -> bool:
+        # whether a setting that changes the layout was changed
+        return False
 
 
 class RandomGenerator(PositionGenerator):
-    def __init__(self):
-        self.positions: dict[Source, list[np.ndarray]] | None = None
-
-    def reset(self, app: Application):
-        self.positions = {source: [] for source in app.selection.sources}
-
     @property
     def name(self) -> str:
         return "Random positions"
 
-    def process(self, app: Application, source: Source, index: int, pil_image: Image.Image):
-        self.positions[source].append(np.random.random(2))
+    def reset(self, app: Application, store: FeatureStore):
+        positions = store.column("random_position", np.float32, (2,))
+        valid = store.column("random_position_valid", bool)
+        missing = ~valid
+        positions[missing] = np.random.random((np.count_nonzero(missing), 2))
+        valid[:] = True
+
+    def get_layout(self, store: FeatureStore) -> Layout:
+        colors = np.zeros((len(store), 4), dtype=float)
+        colors[:, [0, 3]] = 1.
+        return Layout(store.column("random_position", np.float32, (2,)).astype(float),
+                      np.full(len(store), 5.), colors)
 
-    def get_circle_data(self, source: Source, index: int) -> CircleData:
-        return CircleData(self.positions[source][index], 5, np.array([1., 0., 0.]))
+
+# shared by all animations, so a new animation never has the version of an old one
+_layout_versions = itertools.count(1)
 
 
 class Animation(abc.ABC):
+    # changes whenever the layouts of `blend' change, so the plotter only uploads layouts it has not seen
+    version = 0
+
     @abc.abstractmethod
     def get_last_generator(self) -> PositionGenerator:
         pass
@@ -69,10 +85,26 @@ class Animation(abc.ABC):
     def step(self, app: Application):
         pass
 
+    @property
     @abc.abstractmethod
-    def get_circle_data(self, source: Source, index: int) -> CircleData:
+    def blend(self) -> tuple[Layout, Layout, float]:
+        # the layouts the circles move between and how far along they are, the gpu mixes them every frame
         pass
 
+    @property
+    def layout(self) -> Layout:
+        start, end, t = self.blend
+        return start if t == 0. else end if t == 1. else Layout.lerp(start, end, t)
+
+    def __len__(self):
+        return len(self.blend[0])
+
+    def circle(self, index: int) -> tuple[np.ndarray, float]:
+        # center and radius of one circle, without mixing the whole layout
+        start, end, t = self.blend
+        return (start.centers[index]*(1-t)+end.centers[index]*t,
+                float(start.radii[index]*(1-t)+end.radii[index]*t))
+
     @property
     @abc.abstractmethod
     def needs_replacement(self) -> bool:
@@ -81,50 +113,103 @@ class Animation(abc.ABC):
     def get_replacement(self) -> Animation:
         pass
 
+    def update_generator(self, generator: PositionGenerator, store: FeatureStore):
+        # the settings of the generator changed, the layouts it made are made again
+        pass
+
 
 def get_smooth_t(t: float):
     return max(0., min(1., 3*t**2-2*t**3))
 
 
 class ContstantAnimation(Animation):
-    def __init__(self, generator: PositionGenerator):
+    def __init__(self, generator: PositionGenerator, layout: Layout):
         self.generator = generator
+        self._layout = layout
+        self.version = next(_layout_versions)
 
     def get_last_generator(self) -> PositionGenerator:
         return self.generator
 
-    def get_circle_data(self, source: Source, index: int) -> CircleData:
-        return self.generator.get_circle_data(source, index)
+    @property
+    def blend(self) -> tuple[Layout, Layout, float]:
+        return self._layout, self._layout, 0.
 
     @property
     def needs_replacement(self) -> bool:
         return False
 
+    def update_generator(self, generator: PositionGenerator, store: FeatureStore):
+        if generator is self.generator:
+            self._layout = generator.get_layout(store)
+            self.version = next(_layout_versions)
+
 
 class LerpAnimation(Animation):
-    def __init__(self, start: PositionGenerator, end: PositionGenerator, length: float):
+    """
+    Interpolates between two layouts that are snapshotted once when the animation is created, so the generators are
+    not queried again while the animation runs, unless their settings change. Both layouts are uploaded once and
+    mixed on the gpu, only the position in time changes from frame to frame. Further targets can be chained with
+    `then'.
+    """
+    def __init__(self, start: Layout, end: Layout, generator: PositionGenerator, length: float):
         self.start = start
         self.end = end
-        self.t = 0
+        self.generator = generator
+        self.t = 0.
         self.length = length
+        self.queue: list[tuple[Layout, PositionGenerator, float]] = []
+        # the mixed layout of the last time it was asked for, selecting in the plot needs it but drawing does not
+        self._layout: tuple[float, Layout] | None = None
+        self.version = next(_layout_versions)
+
+    @classmethod
+    def retarget(cls, current: Animation, end: Layout, generator: PositionGenerator, length: float) -> LerpAnimation:
+        # start from wherever the circles are right now, which also works in the middle of another animation
+        return LerpAnimation(current.layout, end, generator, length)
+
+    def then(self, end: Layout, generator: PositionGenerator, length: float):
+        self.queue.append((end, generator, length))
 
     def get_last_generator(self) -> PositionGenerator:
-        return self.end
+        return self.queue[-1][1] if self.queue else self.generator
+
+    @property
+    def blend(self) -> tuple[Layout, Layout, float]:
+        progress = 1. if self.length <= 0. else self.t/self.length
+        return self.start, self.end, get_smooth_t(progress)
 
-    def get_circle_data(self, source: Source, index: int) -> CircleData:
-        return CircleData.lerp(self.start.get_circle_data(source, index),
-                               self.end.get_circle_data(source, index),
-                               get_smooth_t(self.t))
+    @property
+    def layout(self) -> Layout:
+        if self._layout is None or self._layout[0] != self.t:
+            self._layout = self.t, super().layout
+        return self._layout[1]
 
     def step(self, app: Application):
         self.t = min(self.t + app.window.delta_time, self.length)
 
     @property
     def needs_replacement(self) -> bool:
-        return self.t == 1.
+        return self.t >= self.length
+
+    def update_generator(self, generator: PositionGenerator, store: FeatureStore):
+        # the animation keeps going from where it is, towards the new layout
+        if generator is not self.generator and all(queued is not generator for _, queued, _ in self.queue):
+            return
+        layout = generator.get_layout(store)
+        if generator is self.generator:
+            self.end = layout
+            self._layout = None
+            self.version = next(_layout_versions)
+        self.queue = [(layout if queued is generator else end, queued, length) for end, queued, length in self.queue]
 
     def get_replacement(self) -> Animation:
-        return ContstantAnimation(self.end)
+        if not self.queue:
+            return ContstantAnimation(self.generator, self.end)
+        end, generator, length = self.queue[0]
+        result = LerpAnimation(self.end, end, generator, length)
+        result.queue = self.queue[1:]
+        return result
 
 
 ZOOM_FACTOR = 1.1
@@ -133,6 +218,11 @@ SELECTION_THICKNESS = 2
 ARROW_COLOR = (0/255, 158/255, 176/255)
 ARROW_HEIGHT = 10
 ARROW_WIDTH = 10
+PAN_TOOL, BOX_TOOL, LASSO_TOOL = range(3)
+DRAG_TOOLS = ["pan", "box", "lasso"]
+GESTURE_SELECT_COLOR = (0., .7, 0.)
+GESTURE_DESELECT_COLOR = (.7, 0., 0.)
+GESTURE_THICKNESS = 2
 
 
 class Camera:
@@ -140,19 +230,20 @@ class Camera:
         self.position = position
         self.scale = scale
 
-    def handle_inputs(self, app: Application):
+    def handle_inputs(self, app: Application, pan_button: int = 0):
         if app.ui.want_capture_mouse or app.ui.want_capture_keyboard:
             return
-        if app.window.is_mouse_button_down(0):
+        if app.window.is_mouse_button_down(pan_button):
             self.position += -app.window.delta_cur*self.scale
         self.position += (app.window.cur_pos-app.window.center)*self.scale
         self.scale /= pow(ZOOM_FACTOR, app.window.get_scroll_wheel_y())
         self.position -= (app.window.cur_pos-app.window.center)*self.scale
 
+    def screen_to_world(self, window: PygameGLWindow, points: np.ndarray) -> np.ndarray:
+        return (points-window.center)*self.scale+self.position
 
-    def world_circle_to_screen(self, window: PygameGLWindow, circle: CircleData) -> CircleData:
-        return CircleData((circle.center-self.position)/self.scale+window.center, circle.radius/self.scale, circle.color)
-
+    def world_layout_to_screen(self, window: PygameGLWindow, layout: Layout) -> Layout:
+        return Layout((layout.centers-self.position)/self.scale+window.center, layout.radii/self.scale, layout.colors)
 
 
 class ImagePlotter(Viewer):
@@ -160,12 +251,26 @@ class ImagePlotter(Viewer):
         self.is_shown = False
         self.is_initialised = False
         self.generators = generators
-        self.animation: Animation = ContstantAnimation(generators[0])
+        self.animation: Animation | None = None
         self.animation_time = 1
-        self.last_sources: set[Source] | None = None
+        self.layout_sources: list[Source] = []
         self.camera = Camera(np.zeros(2, float), 1.)
         self.image_viewer: None | ImageViewer = None
+        self.query_viewer: None | MetadataQueryViewer = None
         self.show_selection = True
+        self.drag_tool = PAN_TOOL
+        # screen space points of the box or lasso that is being dragged, and the mouse button that started it
+        self.gesture: list[np.ndarray] = []
+        self.gesture_button: int | None = None
+        self.spatial_index: GridIndex | None = None
+        self.indexed_layout: Layout | None = None
+        self.renderer: PlotRenderer | None = None
+        # what the renderer's buffers were last filled from
+        self.uploaded_layout = 0
+        self.uploaded_flags: tuple | None = None
+        self.layout_generation = 0
+        self.poster_width = 8000
+        self.poster_job: PosterJob | None = None
 
     @property
     def name(self) -> str:
@@ -174,59 +279,186 @@ class ImagePlotter(Viewer):
     def open(self):
         self.is_shown = True
 
-    def handle_inputs(self, app: Application) -> None:
-        self.camera.handle_inputs(app)
-        if (self.image_viewer is not None and not app.ui.want_capture_mouse and not app.ui.want_capture_keyboard
-                and app.window.on_double_left_click()):
-            closest_source = None
-            closest_image = None
-            closest_distance = None
-            for source, subset in zip(app.selection.sources, app.selection.subsets):
-                if source in self.last_sources:
-                    for i in range(len(source.image_paths)):
-                        world_circle = self.animation.get_circle_data(source, i)
-                        circle = self.camera.world_circle_to_screen(app.window, world_circle)
-                        d = np.linalg.norm(circle.center - app.window.cur_pos)
-                        if d <= circle.radius and (closest_distance is None or d < closest_distance):
-                            closest_source = source
-                            closest_image = i
-                            closest_distance = d
-            if closest_source is not None:
-                self.image_viewer.set_image(closest_source, closest_image)
+    def get_screen_layout(self, app: Application) -> Layout:
+        return self.camera.world_layout_to_screen(app.window, self.animation.layout)
+
+    def get_visible_mask(self, app: Application) -> np.ndarray:
+        # only sources that are still part of the selection are shown
+        mask = np.zeros(len(self.animation), dtype=bool)
+        for source in app.selection.sources:
+            if source in app.store.offsets:
+                mask[app.store.source_slice(source)] = True
+        return mask
 
+    def get_selected_mask(self, app: Application) -> np.ndarray:
+        return app.selected_mask()
+
+    def handle_inputs(self, app: Application) -> None:
+        self.camera.handle_inputs(app, pan_button=0 if self.drag_tool == PAN_TOOL else 1)
+        self.handle_gesture(app)
+        if (self.image_viewer is not None and self.is_initialised and not app.ui.want_capture_mouse
+                and not app.ui.want_capture_keyboard and app.window.on_double_left_click()):
+            layout = self.get_screen_layout(app)
+            distances = np.linalg.norm(layout.centers-app.window.cur_pos, axis=1)
+            distances[(distances > layout.radii) | ~self.get_visible_mask(app)] = np.inf
+            if len(distances) > 0 and np.isfinite(distances.min()):
+                self.image_viewer.set_image(app, *app.store.image_from_id(int(np.argmin(distances))))
+
+    def handle_gesture(self, app: Application):
+        if self.drag_tool == PAN_TOOL or not self.is_initialised:
+            self.gesture, self.gesture_button = [], None
+            return
+        if self.gesture_button is None:
+            if app.ui.want_capture_mouse or app.ui.want_capture_keyboard:
+                return
+            # left drags select, right drags deselect
+            for button in (0, 2):
+                if app.window.is_mouse_button_down(button):
+                    self.gesture, self.gesture_button = [app.window.cur_pos], button
+                    break
+            return
+        if app.window.is_mouse_button_down(self.gesture_button):
+            if self.drag_tool == BOX_TOOL:
+                self.gesture[1:] = [app.window.cur_pos]
+            else:
+                extend_lasso(self.gesture, app.window.cur_pos)
+            return
+        self.select_in_gesture(app, self.gesture_button == 0)
+        self.gesture, self.gesture_button = [], None
+
+    def select_in_gesture(self, app: Application, selected: bool):
+        layout = self.animation.layout
+        if self.indexed_layout is not layout:
+            # the index stays valid until the animation produces a new layout
+            self.spatial_index = GridIndex(layout.centers)
+            self.indexed_layout = layout
+        region = self.camera.screen_to_world(app.window, np.array(self.gesture))
+        if len(region) < 2:
+            return
+        if self.drag_tool == BOX_TOOL:
+            low, high = np.minimum(region[0], region[-1]), np.maximum(region[0], region[-1])
+            candidates = self.spatial_index.query_rect(low, high)
+            inside = points_in_rect(layout.centers[candidates], low, high)
+        else:
+            candidates = self.spatial_index.query_rect(region.min(axis=0), region.max(axis=0))
+            inside = points_in_polygon(layout.centers[candidates], region)
+        image_ids = candidates[inside]
+        app.set_selected_ids(image_ids[self.get_visible_mask(app)[image_ids]], selected)
+
+    def draw_circles(self, app: Application):
+        # the buffers are only refilled when the layout or the selection changed, the camera is a uniform
+        if self.renderer is None:
+            self.renderer = PlotRenderer(app.window.mgl)
+        start, end, t = self.animation.blend
+        if self.animation.version != self.uploaded_layout:
+            if len(start) != self.renderer.size:
+                # new buffers start without flags
+                self.uploaded_flags = None
+            self.renderer.update_layout(start.centers, start.radii, start.colors,
+                                        None if end is start else (end.centers, end.radii, end.colors))
+            self.uploaded_layout = self.animation.version
+        matches = self.get_matches(app)
+        flags_key = (app.selection.version, self.show_selection, self.layout_generation,
+                     None if matches is None else self.query_viewer.version)
+        if flags_key != self.uploaded_flags:
+            self.renderer.update_flags(self.get_flags(app, matches))
+            self.uploaded_flags = flags_key
+        self.renderer.render(self.camera.position, self.camera.scale, app.window.size,
+                             SELECTION_COLOR, SELECTION_THICKNESS, t)
+
+    def get_matches(self, app: Application) -> np.ndarray | None:
+        matches = None if self.query_viewer is None else self.query_viewer.plot_matches(app)
+        return None if matches is None or len(matches) != len(self.animation) else matches
+
+    def get_flags(self, app: Application, matches: np.ndarray | None) -> np.ndarray:
+        flags = np.where(self.get_visible_mask(app), VISIBLE_FLAG, 0)
+        if self.show_selection:
+            flags |= np.where(self.get_selected_mask(app), SELECTED_FLAG, 0)
+        if matches is not None:
+            flags |= np.where(matches, 0, DIMMED_FLAG)
+        return flags
+
+    def start_poster(self, app: Application, mgl: moderngl.Context, path: str, width: int, fit_all: bool = False) -> PosterJob:
+        """
+        Renders the current layout into an image file `width' pixels wide. The poster shows what the window shows,
+        with the selection rings scaled along, or with `fit_all' all visible circles.
+        """
+        layout = self.animation.layout
+        flags = self.get_flags(app, self.get_matches(app))
+        if fit_all:
+            visible = (flags & VISIBLE_FLAG) != 0
+            if not visible.any():
+                visible[:] = True
+            position, scale, height = fit_view(layout.centers[visible], layout.radii[visible], width)
+            thickness = SELECTION_THICKNESS*max(1., width/2000)
+        else:
+            scale = self.camera.scale*app.window.width/width
+            position = self.camera.position
+            height = max(1, round(width*app.window.height/app.window.width))
+            thickness = SELECTION_THICKNESS*width/app.window.width
+        background = (0, 0, 0) if app.window is None else app.window.background_color
+        return PosterJob(mgl, layout.centers, layout.radii, layout.colors, flags, position, scale, (width, height),
+                         path, SELECTION_COLOR, thickness, background)
+
+    def draw_poster_ui(self, app: Application):
+        job = self.poster_job
+        if job is not None and not job.is_finished:
+            imgui.text(f"poster: {job.progress*100:.0f}%")
+            imgui.same_line()
+            if imgui.small_button("cancel"):
+                job.cancel()
+                self.poster_job = None
+            return
+        if job is not None:
+            imgui.text(f"poster failed: {job.error}" if job.error is not None else f"poster saved to {job.path}")
+        imgui.push_item_width(120)
+        _, x = imgui.input_int("poster width", self.poster_width, 1000)
+        self.poster_width = min(100000, max(16, x))
+        imgui.pop_item_width()
+        imgui.same_line()
+        if imgui.button("Export poster...") and self.is_initialised and len(self.animation) > 0:
+            path = easygui.filesavebox(default="plot.png", filetypes=POSTER_FILE_TYPES)
+            if path is not None:
+                self.poster_job = self.start_poster(app, app.window.mgl, path, self.poster_width)
+
+    def get_extractors(self) -> list[FeatureExtractor]:
+        return list(self.generators)
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        return {
+            "plot spatial index": MeasuredMemory(
+                lambda: 0 if self.spatial_index is None else self.spatial_index.nbytes),
+            "plot buffers": MeasuredMemory(lambda: 0 if self.renderer is None else self.renderer.nbytes, on_gpu=True),
+        }
 
     def reload(self, app: Application):
-        print("Reloading...")
-        for generator in self.generators:
-            generator.reset(app)
-        for source in app.selection.sources:
-            print(f"Loading source {source.name}...", end="")
-            for i, image_path in enumerate(source.absolute_image_paths):
-                print(f"\rLoading source {source.name}, image {i}/{len(source.image_paths)}...", end="")
-                pil_image = Image.open(image_path)
-                for generator in self.generators:
-                    generator.process(app, source, i, pil_image)
-            print()
-        self.last_sources = set(app.selection.sources)
+        app.reload_features()
+        self.rebuild_layout(app)
         if not self.is_initialised:
             for viewer in app.viewers:
                 if isinstance(viewer, ImageViewer):
                     self.image_viewer = viewer
+                elif isinstance(viewer, MetadataQueryViewer):
+                    self.query_viewer = viewer
             self.camera.scale = 2./min(app.window.width, app.window.height)
         self.is_initialised = True
 
-    @staticmethod
-    def draw_circle(app: Application, circle: CircleData, selected: bool = False):
-        if (
-            circle.center[0] <= -circle.radius-SELECTION_THICKNESS or
-            circle.center[0] >= app.window.width+circle.radius+SELECTION_THICKNESS or
-            circle.center[1] <= -circle.radius - SELECTION_THICKNESS or
-            circle.center[1] >= app.window.height + circle.radius + SELECTION_THICKNESS
-        ):
-            return
-        if selected:
-            app.ui.draw_filled_circle(circle.center, circle.radius+SELECTION_THICKNESS, SELECTION_COLOR)
-        app.ui.draw_filled_circle(circle.center, circle.radius, circle.color)
+    def rebuild_layout(self, app: Application):
+        generator = self.generators[0] if self.animation is None else self.animation.get_last_generator()
+        self.animation = ContstantAnimation(generator, generator.get_layout(app.store))
+        self.layout_sources = list(app.store.sources)
+        self.layout_generation += 1
+
+    def layout_outdated(self, app: Application) -> bool:
+        # another viewer reloaded the features for a different set of sources, or the sources were rescanned
+        return app.store.sources != self.layout_sources or len(self.animation) != len(app.store)
+
+    def apply_generator(self, app: Application, generator: PositionGenerator, chain: bool = False):
+        end = generator.get_layout(app.store)
+        if chain and isinstance(self.animation, LerpAnimation):
+            self.animation.then(end, generator, self.animation_time)
+        else:
+            self.animation = LerpAnimation.retarget(self.animation, end, generator, self.animation_time)
 
     def draw_ui(self, app: Application) -> None:
         if not self.is_shown:
@@ -239,36 +471,55 @@ class ImagePlotter(Viewer):
             _, x = imgui.input_float("animation time", self.animation_time)
             self.animation_time = min(100., max(0., x))
             _, self.show_selection = imgui.checkbox("show selection", self.show_selection)
+            for tool, tool_name in enumerate(DRAG_TOOLS):
+                if tool > 0:
+                    imgui.same_line()
+                if imgui.radio_button(tool_name, self.drag_tool == tool):
+                    self.drag_tool = tool
+            if self.drag_tool != PAN_TOOL:
+                imgui.text("left drag selects, right drag deselects, middle drag pans")
+            self.draw_poster_ui(app)
 
             for generator in self.generators:
                 if imgui.tree_node(generator.name):
                     if imgui.button("Apply") and self.is_initialised:
-                        self.animation = LerpAnimation(self.animation.get_last_generator(), generator,
-                                                       self.animation_time)
-                    generator.draw_ui()
+                        self.apply_generator(app, generator)
+                    imgui.same_line()
+                    if imgui.button("Queue") and self.is_initialised:
+                        self.apply_generator(app, generator, chain=True)
+                    if generator.draw_ui() and self.is_initialised and not self.layout_outdated(app):
+                        # settings change the plot while they are edited, not only on apply
+                        self.animation.update_generator(generator, app.store)
                     imgui.tree_pop()
 
         if not self.is_initialised:
             return
+        if self.layout_outdated(app):
+            self.rebuild_layout(app)
         self.animation.step(app)
         if self.animation.needs_replacement:
             self.animation = self.animation.get_replacement()
 
-        # draw circles
-        arrow_circle = None
-        for source, subset in zip(app.selection.sources, app.selection.subsets):
-            if source in self.last_sources:
-                for i in range(len(source.image_paths)):
-                    world_circle = self.animation.get_circle_data(source, i)
-                    circle = self.camera.world_circle_to_screen(app.window, world_circle)
-                    if self.image_viewer is not None and source == self.image_viewer.current_source and i == self.image_viewer.current_image:
-                        arrow_circle = circle
-                    if self.show_selection and i in subset:
-                        app.ui.draw_filled_circle(circle.center, circle.radius+2, SELECTION_COLOR)
-                    app.ui.draw_filled_circle(circle.center, circle.radius, circle.color)
+        self.draw_circles(app)
+        if self.poster_job is not None:
+            # one band per frame, the plot stays responsive while a large poster renders
+            self.poster_job.step()
+        # draw the box or lasso that is being dragged
+        if len(self.gesture) >= 2:
+            color = GESTURE_SELECT_COLOR if self.gesture_button == 0 else GESTURE_DESELECT_COLOR
+            if self.drag_tool == BOX_TOOL:
+                (x0, y0), (x1, y1) = self.gesture[0], self.gesture[-1]
+                points = [np.array([x0, y0]), np.array([x1, y0]), np.array([x1, y1]), np.array([x0, y1])]
+            else:
+                points = self.gesture
+            app.ui.draw_polyline(points, color, GESTURE_THICKNESS, closed=True)
         # draw arrow to indicate where the image viewer is
-        if arrow_circle is not None:
-            offset = arrow_circle.center+np.array([0., -arrow_circle.radius-2])
+        if (self.image_viewer is not None and self.image_viewer.current_source in app.store.offsets
+                and self.image_viewer.current_source in app.selection.sources):
+            i = app.store.offsets[self.image_viewer.current_source]+self.image_viewer.current_image
+            center, radius = self.animation.circle(i)
+            center = (center-self.camera.position)/self.camera.scale+app.window.center
+            offset = center+np.array([0., -radius/self.camera.scale-SELECTION_THICKNESS])
             app.ui.draw_triangle_filled(
                 offset,
                 offset + np.array([-ARROW_WIDTH/2, -ARROW_HEIGHT]),
@@ -0,0 +1,228 @@
+from __future__ import annotations
+import functools
+import io
+import math
+from concurrent.futures import Executor, Future
+import numpy as np
+from PIL import Image
+from texture_pool import TexturePool, PooledTexture, TextureUploader
+from exif_reader import read_exif_thumbnail
+from memory_budget import LruCache
+from shared_cache import SharedCache, file_key
+
+
+TILE_SIZE = 512
+
+
+def decode_tiles(path: str, size: tuple[int, int],
+                 tiles: list[tuple[int, int]]) -> dict[tuple[int, int], np.ndarray]:
+    """
+    Decodes the given tiles of the pyramid level of `size' as contiguous RGB arrays. Runs in a worker thread, pillow
+    releases the GIL while decoding. Every tile is cut from the opened file and scaled on its own, so apart from the
+    decoded file itself only the requested tiles are ever in memory, never the whole level.
+    """
+    result = {}
+    with Image.open(path) as image:
+        # jpeg images can be decoded at 1/2, 1/4 or 1/8 scale directly, which is much faster for the coarse levels
+        image.draft("RGB", size)
+        scale_x, scale_y = image.width/size[0], image.height/size[1]
+        for x, y in tiles:
+            x0, y0 = x*TILE_SIZE, y*TILE_SIZE
+            x1, y1 = min(size[0], x0+TILE_SIZE), min(size[1], y0+TILE_SIZE)
+            if image.size == size:
+                result[(x, y)] = np.asarray(image.crop((x0, y0, x1, y1)).convert("RGB"))
+                continue
+            box = (x0*scale_x, y0*scale_y, x1*scale_x, y1*scale_y)
+            # a pixel more on every side, so the filter sees the same neighbours as when scaling the whole level
+            crop = (max(0, math.floor(box[0])-1), max(0, math.floor(box[1])-1),
+                    min(image.width, math.ceil(box[2])+1), min(image.height, math.ceil(box[3])+1))
+            region = image.crop(crop).convert("RGB")
+            region = region.resize((x1-x0, y1-y0), Image.BILINEAR, reducing_gap=2.,
+                                   box=(box[0]-crop[0], box[1]-crop[1], box[2]-crop[0], box[3]-crop[1]))
+            result[(x, y)] = np.asarray(region)
+    return result
+
+
+def decode_preview(path: str, size: int) -> tuple[np.ndarray, tuple[int, int]]:
+    """
+    Quickly produces a small version of an image as an RGB array, together with the size of the full image. The
+    thumbnail embedded in the EXIF data is used if there is one, which avoids decoding the image at all, otherwise
+    the image is decoded at reduced scale.
+    """
+    with Image.open(path) as image:
+        full_size = image.size
+        thumbnail = read_exif_thumbnail(path)
+        if thumbnail is not None:
+            try:
+                with Image.open(io.BytesIO(thumbnail)) as preview:
+                    return np.asarray(preview.convert("RGB")), full_size
+            except OSError:
+                pass
+        image.draft("RGB", (size, size))
+        preview = image.convert("RGB")
+    preview.thumbnail((size, size), Image.BILINEAR)
+    return np.asarray(preview), full_size
+
+
+def cached_preview(cache: SharedCache, path: str, size: int) -> tuple[np.ndarray, tuple[int, int]]:
+    # the preview from the cache shared with other processes, decoded by only one of them when it is missing
+    key = file_key(path, "preview", size)
+    if key is None:
+        return decode_preview(path, size)
+    return cache.single_flight(key, lambda: cache.load_thumbnail(key), lambda: decode_preview(path, size),
+                               lambda preview: cache.publish_thumbnail(key, *preview))
+
+
+class TileCache(LruCache[tuple[str, int, int, int], np.ndarray]):
+    """
+    Least recently used cache of decoded pyramid tiles by path, level and tile position, bounded by the number of
+    bytes of pixel data it holds, or only by the memory budget of the application when no maximum is given.
+    """
+    def __init__(self, max_bytes: int | None = None):
+        super().__init__(max_bytes, lambda tile: tile.nbytes)
+
+    def remove_image(self, path: str):
+        for key in [key for key in self._entries if key[0] == path]:
+            self.remove(key)
+
+
+class ImagePyramid:
+    """
+    Multi-resolution view of an image file. Level k is the image downscaled by 2^k and is cut into tiles of
+    TILE_SIZE x TILE_SIZE pixels. Tiles are decoded in worker threads on request, one job per level at a time that
+    takes all tiles requested in the meantime, and only the tiles that are asked for are uploaded to the gpu. So
+    images larger than the maximum texture size can be shown, and zooming in never needs one huge texture nor keeps
+    a whole level of a huge image in memory.
+    """
+    def __init__(self, path: str, executor: Executor, cache: TileCache):
+        self.path = path
+        self.executor = executor
+        self.cache = cache
+        with Image.open(path) as image:
+            # only reads the header
+            self.size: tuple[int, int] = image.size
+        self.level_count = max(1, math.ceil(math.log2(max(self.size)/TILE_SIZE))+1)
+        # per level the decode that runs and its tiles, and the tiles that wait for it to finish
+        self._futures: dict[int, tuple[Future, set[tuple[int, int]]]] = {}
+        self._pending: dict[int, set[tuple[int, int]]] = {}
+        # levels that could not be decoded are not tried again
+        self._failed: set[int] = set()
+        self._tiles: dict[tuple[int, int, int], PooledTexture] = {}
+
+    @property
+    def coarsest_level(self) -> int:
+        return self.level_count-1
+
+    def level_size(self, level: int) -> tuple[int, int]:
+        return max(1, math.ceil(self.size[0]/2**level)), max(1, math.ceil(self.size[1]/2**level))
+
+    def level_for_scale(self, scale: float) -> int:
+        # the coarsest level that still has at least one pixel per screen pixel
+        if scale <= 0:
+            return self.coarsest_level
+        return min(self.coarsest_level, max(0, math.floor(math.log2(1/scale))))
+
+    def request_tiles(self, level: int, tiles: list[tuple[int, int]]):
+        self._collect(level)
+        if level in self._failed:
+            return
+        running = self._futures[level][1] if level in self._futures else set()
+        missing = {tile for tile in tiles if tile not in running and (self.path, level, *tile) not in self.cache}
+        if missing:
+            self._pending.setdefault(level, set()).update(missing)
+        self._submit(level)
+
+    def request_level(self, level: int):
+        # all tiles of the level, meant for the coarse levels that are about the size of the screen or smaller
+        width, height = self.level_size(level)
+        self.request_tiles(level, self.tiles_in_rect(level, 0., 0., width*2**level, height*2**level))
+
+    def request_view(self, scale: float, center: np.ndarray, view_size: np.ndarray) -> int:
+        """
+        Requests the tiles of the level for `scale' that are visible in a view of `view_size' screen pixels around the
+        image pixel `center', and a ring of tiles around them so panning finds its tiles decoded. Returns the level.
+        """
+        level = self.level_for_scale(scale)
+        extent = np.asarray(view_size, dtype=float)/2/scale + TILE_SIZE*2**level
+        self.request_tiles(level, self.tiles_in_rect(level, *(center-extent), *(center+extent)))
+        return level
+
+    def _submit(self, level: int):
+        if level in self._futures or not self._pending.get(level):
+            return
+        tiles = self._pending.pop(level)
+        future = self.executor.submit(decode_tiles, self.path, self.level_size(level), sorted(tiles))
+        self._futures[level] = (future, tiles)
+
+    def _collect(self, level: int):
+        future, _ = self._futures.get(level, (None, None))
+        if future is None or not future.done():
+            return
+        del self._futures[level]
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self._failed.add(level)
+            self._pending.pop(level, None)
+            return
+        for (x, y), pixels in future.result().items():
+            self.cache.put((self.path, level, x, y), pixels)
+        self._submit(level)
+
+    def decoded_tile(self, level: int, x: int, y: int) -> np.ndarray | None:
+        self._collect(level)
+        return self.cache.get((self.path, level, x, y))
+
+    def tile_rect(self, level: int, x: int, y: int) -> tuple[float, float, float, float]:
+        # the area covered by a tile, in pixels of the full resolution image
+        width, height = self.level_size(level)
+        scale = 2**level
+        return (x*TILE_SIZE*scale, y*TILE_SIZE*scale,
+                min(width, (x+1)*TILE_SIZE)*scale, min(height, (y+1)*TILE_SIZE)*scale)
+
+    def tiles_in_rect(self, level: int, x0: float, y0: float, x1: float, y1: float) -> list[tuple[int, int]]:
+        width, height = self.level_size(level)
+        span = TILE_SIZE*2**level
+        tx0, ty0 = max(0, int(x0 // span)), max(0, int(y0 // span))
+        tx1 = min(math.ceil(width/TILE_SIZE), math.ceil(x1/span))
+        ty1 = min(math.ceil(height/TILE_SIZE), math.ceil(y1/span))
+        return [(x, y) for y in range(ty0, ty1) for x in range(tx0, tx1)]
+
+    def has_tile(self, level: int, x: int, y: int) -> bool:
+        return (level, x, y) in self._tiles
+
+    def tile_texture(self, level: int, x: int, y: int, textures: TexturePool,
+                     uploads: TextureUploader | None = None) -> PooledTexture | None:
+        """
+        The texture of a tile, uploaded through `uploads' when it is not on the gpu yet and the upload budget of the
+        frame allows it. Without `uploads' only tiles that were uploaded before are returned. Tiles that are not decoded
+        yet are not requested here, that is up to `request_tiles'.
+        """
+        key = (level, x, y)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            textures.touch(tile)
+            return tile
+        if uploads is None:
+            return None
+        pixels = self.decoded_tile(level, x, y)
+        if pixels is None or not uploads.can_upload(pixels.nbytes):
+            return None
+        tile = textures.acquire((pixels.shape[1], pixels.shape[0]), 3, owner="image tiles",
+                                evict=functools.partial(self._tiles.pop, key, None))
+        uploads.upload(tile, pixels)
+        self._tiles[key] = tile
+        return tile
+
+    def cancel(self):
+        # decodes that already started run to completion, their results are dropped
+        for future, _ in self._futures.values():
+            future.cancel()
+        self._futures.clear()
+        self._pending.clear()
+
+    def release(self, textures: TexturePool):
+        self.cancel()
+        for tile in self._tiles.values():
+            textures.release(tile)
+        self._tiles.clear()
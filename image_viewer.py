@@ -1,86 +1,316 @@
 import os.path
+from concurrent.futures import ThreadPoolExecutor, Future
 import imgui
-import moderngl
+import numpy as np
 import pygame
-from PIL import Image
 from application import Application, Source, Viewer
+from image_catalog import ImageCatalog
+from texture_pool import PooledTexture
+from image_pyramid import ImagePyramid, TileCache, cached_preview
+from memory_budget import MemoryConsumer, LruCache
 
 
-def texture_from_file(image_file: str) -> moderngl.Texture:
-    pil_image = Image.open(image_file)
-    tex = moderngl.get_context().texture(pil_image.size, 3)
-    tex.filter = (moderngl.LINEAR, moderngl.LINEAR)
-    tex.swizzle = 'RGB'
-    tex.write(pil_image.tobytes())
-    return tex
-
 IMAGE_TOP_LEFT_OFFSET = (15, 60)
 IMAGE_BOTTOM_RIGHT_OFFSET = (15, 15)
 OUTLINE_THICKNESS = 5
+ZOOM_FACTOR = 1.2
+MAX_ZOOM = 16.
+PREFETCH_DELAY = .3
+DECODE_WORKERS = max(2, (os.cpu_count() or 2)//2)
+PREVIEW_WORKERS = 2
+PREVIEW_SIZE = 320
+# holding a navigation key for longer than this starts skimming, one image every SKIM_INTERVAL seconds
+REPEAT_DELAY = .35
+SKIM_INTERVAL = 1/40
+# key presses closer together than this also count as skimming
+RAPID_PRESS_INTERVAL = .2
+# the full resolution is only loaded after this long without navigating
+SETTLE_DELAY = .15
 
 
 class ImageViewer(Viewer):
     def __init__(self):
         self.is_shown = True
-        self.image_texture: moderngl.Texture | None = None
+        self.pyramid: ImagePyramid | None = None
+        self.texture_outdated = False
         self.current_source: Source | None = None
         self.current_image: int = 0
+        # catalog id of the current image, to find it back when the sources are rescanned
+        self.current_id: int | None = None
+        self.catalog_version = 0
+        # screen pixels per image pixel, None to fit the whole image in the window
+        self.zoom: float | None = None
+        self.view_center = np.zeros(2, dtype=float)
+        self.time_shown = 0.
+        self.executor = ThreadPoolExecutor(DECODE_WORKERS)
+        # both caches are bounded by the memory budget of the application only
+        self.tile_cache = TileCache()
+        # size of the image that is shown, known before the pyramid is when skimming
+        self.image_size: tuple[int, int] | None = None
+        # skim mode shows small previews while the navigation keys are held and skips the full resolution
+        self.skimming = False
+        self.hold_time = 0.
+        self.repeat_time = 0.
+        self.time_since_step = float("inf")
+        self.preview_executor = ThreadPoolExecutor(PREVIEW_WORKERS)
+        self.previews: LruCache[str, tuple[np.ndarray, tuple[int, int]]] = LruCache(
+            None, lambda preview: preview[0].nbytes)
+        self.preview_future: Future | None = None
+        self.preview_path: str | None = None
+        self.preview_texture: PooledTexture | None = None
+        # catalog positions that left and right step through, for following a filtered or sorted list, with the
+        # rank of every position in it (-1 when left out) and the catalog version it belongs to
+        self.navigation_order: np.ndarray | None = None
+        self.navigation_ranks = np.zeros(0, dtype=np.int64)
+        self.navigation_version = 0
 
     @property
     def name(self) -> str:
         return "Image viewer"
 
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        return {"decoded image tiles": self.tile_cache, "image previews": self.previews}
+
     def open(self):
         self.is_shown = True
 
+    @property
+    def current_path(self) -> str:
+        return os.path.join(self.current_source.relative_to_dir, self.current_source.image_paths[self.current_image])
+
     def ensure_source_exists(self, app: Application):
+        catalog = app.selection.catalog
+        if catalog.version != self.catalog_version:
+            self.catalog_version = catalog.version
+            location = None if self.current_id is None else catalog.locate(self.current_id)
+            if location is None and self.current_source in catalog.sources and self.current_source.image_paths:
+                # the image itself is gone, stay close to where it was
+                location = self.current_source, min(self.current_image, len(self.current_source.image_paths)-1)
+            if location is not None:
+                if location != (self.current_source, self.current_image):
+                    self.set_image(app, *location)
+                return
+            self.current_source = None
         if self.current_source in app.selection.sources:
             return
         self.current_image = 0
         if sum(len(source.image_paths) for source in app.selection.sources) == 0:
             self.current_source = None
-            self.image_texture = None
+            if self.pyramid is not None:
+                self.pyramid.release(app.window.textures)
+            self.pyramid = None
+            self.image_size = None
+            self.release_preview(app)
+            self.texture_outdated = False
             return
         for source in app.selection.sources:
             if source.image_paths:
-                self.current_source = source
-                self.update_texture()
+                self.set_image(app, source, 0)
                 return
 
     def handle_inputs(self, app: Application) -> None:
         if self.current_source is None or app.ui.want_capture_keyboard:
             return
-        try:
-            source_index = app.selection.sources.index(self.current_source)
-        except ValueError:
+        catalog = app.selection.catalog
+        if self.current_source not in catalog.sources or catalog.version != self.catalog_version:
             return
+        source_index = catalog.source_index(self.current_source)
         if app.window.on_key_down(pygame.K_SPACE):
-            if self.current_image in app.selection.subsets[source_index]:
-                app.selection.subsets[source_index].remove(self.current_image)
-            else:
-                app.selection.subsets[source_index].add(self.current_image)
-        if app.window.on_key_down(pygame.K_LEFT):
-            self.current_image = self.current_image-1
-            if self.current_image == -1:
-                self.current_source = app.selection.sources[(source_index-1)%len(app.selection.sources)]
-                self.current_image = len(self.current_source.image_paths)-1
-            self.update_texture()
-        elif app.window.on_key_down(pygame.K_RIGHT):
-            self.current_image = self.current_image+1
-            if self.current_image == len(self.current_source.image_paths):
-                self.current_image = 0
-                self.current_source = app.selection.sources[(source_index+1)%len(app.selection.sources)]
-            self.update_texture()
+            is_selected = self.current_image in app.selection.subsets[source_index]
+            app.selection.set_selected(source_index, [self.current_image], not is_selected)
+        step = self.navigation_step(app)
+        if step != 0:
+            self.set_image(app, *self.step_target(catalog, step))
+
+    def set_navigation_order(self, catalog: ImageCatalog, positions: np.ndarray | None):
+        # None steps through all images in catalog order again
+        self.navigation_order = positions
+        self.navigation_version = catalog.version
+        if positions is not None:
+            self.navigation_ranks = np.full(len(catalog), -1, dtype=np.int64)
+            self.navigation_ranks[positions] = np.arange(len(positions))
+
+    def step_target(self, catalog: ImageCatalog, step: int) -> tuple[Source, int]:
+        order = self.navigation_order
+        if order is None or len(order) == 0 or self.navigation_version != catalog.version:
+            return catalog.step(self.current_source, self.current_image, step)
+        rank = int(self.navigation_ranks[catalog.position(self.current_source, self.current_image)])
+        if rank < 0:
+            # from an image outside of the order, step to its first or last image
+            rank = -1 if step > 0 else 0
+        return catalog.at(int(order[(rank+step) % len(order)]))
+
+    def navigation_step(self, app: Application) -> int:
+        step = 0
+        held = -1 if app.window.is_key_down(pygame.K_LEFT) else 1 if app.window.is_key_down(pygame.K_RIGHT) else 0
+        if app.window.on_key_down(pygame.K_LEFT) or app.window.on_key_down(pygame.K_RIGHT):
+            step = held
+            self.hold_time = self.repeat_time = 0.
+        elif held != 0:
+            self.hold_time += app.window.delta_time
+            if self.hold_time >= REPEAT_DELAY:
+                self.repeat_time += app.window.delta_time
+                if self.repeat_time >= SKIM_INTERVAL:
+                    # at most one step per frame, skimming should not skip images without showing them
+                    self.repeat_time = min(self.repeat_time-SKIM_INTERVAL, SKIM_INTERVAL)
+                    step = held
+        if step != 0:
+            self.skimming = self.hold_time >= REPEAT_DELAY or self.time_since_step < RAPID_PRESS_INTERVAL
+            self.time_since_step = 0.
+        return step
+
+    def update_skimming(self, app: Application):
+        self.time_since_step += app.window.delta_time
+        held = app.window.is_key_down(pygame.K_LEFT) or app.window.is_key_down(pygame.K_RIGHT)
+        if self.skimming and not held and self.time_since_step >= SETTLE_DELAY:
+            self.skimming = False
 
     def update_texture(self):
-        self.image_texture = texture_from_file(os.path.join(self.current_source.relative_to_dir,
-                                                            self.current_source.image_paths[self.current_image]))
+        # the image is loaded in `draw_ui', where the texture pool of the window is available
+        self.texture_outdated = True
+
+    def load_texture(self, app: Application):
+        old_size = self.image_size
+        if self.pyramid is not None:
+            self.pyramid.release(app.window.textures)
+        self.pyramid = ImagePyramid(self.current_path, self.executor, self.tile_cache)
+        self.pyramid.request_level(self.pyramid.coarsest_level)
+        self.image_size = self.pyramid.size
+        # keep the zoom and position when flipping through images of the same size
+        if self.image_size != old_size:
+            self.zoom = None
+        self.time_shown = 0.
+        self.texture_outdated = False
 
-    def set_image(self, source: Source, image: int):
+    def load_preview(self, app: Application):
+        # called every frame while skimming, the full resolution stays outdated until navigation settles
+        if self.pyramid is not None:
+            # the previous image stays on screen until the first preview is ready, but its decodes are not needed
+            self.pyramid.cancel()
+        path = self.current_path
+        if path != self.preview_path:
+            if self.preview_future is not None:
+                self.preview_future.cancel()
+            self.preview_path = path
+            self.preview_future = None
+            preview = self.previews.get(path)
+            if preview is not None:
+                self.show_preview(app, *preview)
+            else:
+                self.preview_future = self.preview_executor.submit(cached_preview, app.shared_cache, path, PREVIEW_SIZE)
+        if self.preview_future is not None and self.preview_future.done():
+            future, self.preview_future = self.preview_future, None
+            if not future.cancelled() and future.exception() is None:
+                self.previews.put(path, future.result())
+                self.show_preview(app, *future.result())
+
+    def show_preview(self, app: Application, preview: np.ndarray, full_size: tuple[int, int]):
+        # the previous preview stays on screen until the next one is decoded
+        if self.pyramid is not None:
+            self.pyramid.release(app.window.textures)
+            self.pyramid = None
+        app.window.textures.release(self.preview_texture)
+        self.preview_texture = app.window.textures.acquire((preview.shape[1], preview.shape[0]), 3,
+                                                           owner="image previews")
+        # previews are small, they are uploaded right away whatever is left of the budget of this frame
+        app.window.uploads.upload(self.preview_texture, preview)
+        if full_size != self.image_size:
+            self.zoom = None
+        self.image_size = full_size
+
+    def release_preview(self, app: Application):
+        if self.preview_future is not None:
+            self.preview_future.cancel()
+        self.preview_future = None
+        self.preview_path = None
+        app.window.textures.release(self.preview_texture)
+        self.preview_texture = None
+
+    def set_image(self, app: Application, source: Source, image: int):
         self.current_source = source
         self.current_image = image
+        self.current_id = app.selection.catalog.image_id(source, image)
+        self.catalog_version = app.selection.catalog.version
         self.update_texture()
 
+    def view_transform(self, available_size: np.ndarray) -> tuple[float, np.ndarray]:
+        # returns the scale and the image pixel that is shown in the middle of the available area
+        size = np.array(self.image_size, dtype=float)
+        if self.zoom is None:
+            scale = min(available_size/size)
+            return scale, available_size/2/scale
+        self.view_center = np.clip(self.view_center, 0., size)
+        return self.zoom, self.view_center
+
+    def zoom_at(self, cursor_offset: np.ndarray, factor: float, available_size: np.ndarray):
+        # zooms while keeping the image pixel under the cursor in place
+        scale, center = self.view_transform(available_size)
+        point = center + cursor_offset/scale
+        new_scale = scale*factor
+        if new_scale <= min(available_size/np.array(self.image_size, dtype=float)):
+            self.zoom = None
+            return
+        self.zoom = min(MAX_ZOOM, new_scale)
+        self.view_center = point - cursor_offset/self.zoom
+
+    def handle_view_inputs(self, app: Application, origin: np.ndarray, available_size: np.ndarray):
+        imgui.set_cursor_screen_pos(tuple(origin))
+        imgui.invisible_button("image area", *available_size)
+        cursor_offset = app.window.cur_pos - origin - available_size/2
+        if imgui.is_item_hovered():
+            if app.window.get_scroll_wheel_y() != 0:
+                self.zoom_at(cursor_offset, ZOOM_FACTOR**app.window.get_scroll_wheel_y(), available_size)
+            if imgui.is_mouse_double_clicked(0):
+                if self.zoom is None:
+                    scale, _ = self.view_transform(available_size)
+                    self.zoom_at(cursor_offset, 1/scale, available_size)
+                else:
+                    self.zoom = None
+        if imgui.is_item_active() and self.zoom is not None:
+            self.view_center -= app.window.delta_cur/self.zoom
+
+    def draw_image(self, app: Application, origin: np.ndarray, available_size: np.ndarray) -> tuple[np.ndarray, ...]:
+        scale, center = self.view_transform(available_size)
+        image_origin = origin + available_size/2 - center*scale
+        visible_min = np.maximum(center - available_size/2/scale, 0.)
+        visible_max = np.minimum(center + available_size/2/scale, self.image_size)
+        if self.pyramid is None:
+            # skimming, the preview is stretched over the whole image
+            draw_list = imgui.get_window_draw_list()
+            draw_list.push_clip_rect(*origin, *(origin+available_size), True)
+            image_end = image_origin + np.array(self.image_size)*scale
+            draw_list.add_image(self.preview_texture.glo, tuple(image_origin), tuple(image_end),
+                                (0, 0), self.preview_texture.uv_max)
+            draw_list.pop_clip_rect()
+            return image_origin + visible_min*scale, image_origin + visible_max*scale
+
+        # the coarsest level is drawn first so there is always something on screen, then the finer levels up to the
+        # one for the current zoom, each with the tiles that are decoded already
+        target = self.pyramid.coarsest_level
+        if not self.skimming:
+            target = self.pyramid.request_view(scale, center, available_size)
+        levels = range(self.pyramid.coarsest_level, target-1, -1)
+        self.time_shown += app.window.delta_time
+        if self.time_shown >= PREFETCH_DELAY and not self.skimming:
+            # decode the full resolution around the middle of the view in the background, so zooming in to 100% there
+            # only has to upload tiles
+            self.pyramid.request_view(1., center, available_size)
+
+        draw_list = imgui.get_window_draw_list()
+        draw_list.push_clip_rect(*origin, *(origin+available_size), True)
+        # while skimming this is the previous image, only what is already uploaded is shown
+        uploads = None if self.skimming else app.window.uploads
+        for level in levels:
+            for x, y in self.pyramid.tiles_in_rect(level, *visible_min, *visible_max):
+                tile = self.pyramid.tile_texture(level, x, y, app.window.textures, uploads)
+                if tile is None:
+                    continue
+                x0, y0, x1, y1 = self.pyramid.tile_rect(level, x, y)
+                draw_list.add_image(tile.glo, tuple(image_origin + np.array([x0, y0])*scale),
+                                    tuple(image_origin + np.array([x1, y1])*scale), (0, 0), tile.uv_max)
+        draw_list.pop_clip_rect()
+        return image_origin + visible_min*scale, image_origin + visible_max*scale
+
     def draw_ui(self, app: Application) -> None:
         if not self.is_shown:
             return
@@ -88,35 +318,47 @@ class ImageViewer(Viewer):
             if not image_window.opened:
                 self.is_shown = False
             self.ensure_source_exists(app)
-            if self.image_texture is None:
+            self.update_skimming(app)
+            if self.texture_outdated and self.skimming:
+                self.load_preview(app)
+            elif self.texture_outdated:
+                self.load_texture(app)
+                self.release_preview(app)
+            if self.pyramid is None and self.preview_texture is None:
                 imgui.text("No image to show")
                 return
             # draw info text
-            width, height = self.image_texture.size
+            width, height = self.image_size
             file_name = os.path.split(self.current_source.image_paths[self.current_image])[1]
             imgui.text(f"{self.current_source.name} - {file_name}"
                        f" ({self.current_image+1}/{len(self.current_source.image_paths)}) - {width}x{height}")
-            # determine image size
+            copies = app.identical_files(self.current_source, self.current_image)
+            if copies > 0:
+                imgui.same_line()
+                imgui.text_colored(f"identical to {copies} other file{'s' if copies > 1 else ''}", 1., .7, 0.)
+            imgui.same_line()
+            if imgui.small_button("fit"):
+                self.zoom = None
+            imgui.same_line()
+            if imgui.small_button("100%"):
+                if self.zoom is None:
+                    self.view_center = np.array(self.image_size, dtype=float)/2
+                self.zoom = 1.
+            # determine image area
             window_size = imgui.get_window_size()
             window_pos = imgui.get_window_position()
-            available_size = tuple(max(100, window_size[i]-IMAGE_TOP_LEFT_OFFSET[i]-IMAGE_BOTTOM_RIGHT_OFFSET[i])
-                                   for i in (0, 1))
-            scale_factor = min(available_size[i]/self.image_texture.size[i] for i in (0, 1))
+            origin = np.array(window_pos, dtype=float) + IMAGE_TOP_LEFT_OFFSET
+            available_size = np.array([max(100, window_size[i]-IMAGE_TOP_LEFT_OFFSET[i]-IMAGE_BOTTOM_RIGHT_OFFSET[i])
+                                       for i in (0, 1)], dtype=float)
+            self.handle_view_inputs(app, origin, available_size)
 
+            # draw image
+            top_left, bottom_right = self.draw_image(app, origin, available_size)
             # draw selection outline
-            subset = app.selection.subsets[app.selection.sources.index(self.current_source)]
+            subset = app.selection.subsets[app.selection.catalog.source_index(self.current_source)]
             imgui.get_window_draw_list().add_rect(
-                window_pos[0]+IMAGE_TOP_LEFT_OFFSET[0],
-                window_pos[1]+IMAGE_TOP_LEFT_OFFSET[1],
-                round(window_pos[0]+IMAGE_TOP_LEFT_OFFSET[0]+scale_factor*self.image_texture.size[0]),
-                round(window_pos[1] + IMAGE_TOP_LEFT_OFFSET[1] + scale_factor * self.image_texture.size[1]),
+                *np.round(top_left), *np.round(bottom_right),
                 imgui.get_color_u32_rgba(0., .7, 0., 1.) if self.current_image in subset else
                 imgui.get_color_u32_rgba(.7, 0., 0., 1.),
                 thickness=OUTLINE_THICKNESS
             )
-            # draw image
-            imgui.get_window_draw_list().add_image(self.image_texture.glo, tuple(
-                window_pos[i]+IMAGE_TOP_LEFT_OFFSET[i] for i in (0, 1)
-            ), tuple(
-                round(window_pos[i]+IMAGE_TOP_LEFT_OFFSET[i]+scale_factor*self.image_texture.size[i]) for i in (0, 1)
-            ))
@@ -226,3 +226,14 @@ class ImguiUI:
         imgui.get_background_draw_list().add_triangle_filled(
             v1[0], v1[1], v2[0], v2[1], v3[0], v3[1], imgui.get_color_u32_rgba(*color)
         )
+
+    @staticmethod
+    def draw_polyline(points: list[np.ndarray], color: Iterable[SupportsFloat], thickness: float = 1.,
+                      closed: bool = False):
+        color = [float(x) for x in color]
+        if len(color) == 3:
+            color.append(1.)
+        imgui.get_background_draw_list().add_polyline(
+            [(float(p[0]), float(p[1])) for p in points], imgui.get_color_u32_rgba(*color),
+            flags=imgui.DRAW_CLOSED if closed else imgui.DRAW_NONE, thickness=thickness
+        )
@@ -0,0 +1,82 @@
+from __future__ import annotations
+import re
+import numpy as np
+from memory_budget import collection_bytes
+
+
+# names are split into trigrams in chunks of this many rows, which bounds the size of the temporary arrays
+TRIGRAM_CHUNK = 8192
+# candidates are narrowed with at most this many posting lists, the rest is checked on the names themselves
+MAX_INTERSECTED = 3
+_DIGITS = re.compile(r"(\d+)")
+
+
+def natural_key(name: str) -> list:
+    # "img_9.jpg" before "img_10.jpg"; digits and text alternate, so keys always compare like with like
+    return [int(part) if i % 2 == 1 else part for i, part in enumerate(_DIGITS.split(name.lower()))]
+
+
+def natural_order(names: list[str]) -> np.ndarray:
+    return np.array(sorted(range(len(names)), key=lambda i: natural_key(names[i])), dtype=np.int64)
+
+
+def _trigram_codes(chars: np.ndarray) -> np.ndarray:
+    # every three consecutive bytes as one integer
+    return (chars[..., :-2].astype(np.int64) << 16) | (chars[..., 1:-1].astype(np.int64) << 8) | chars[..., 2:]
+
+
+class NameIndex:
+    """
+    Substring search over the lowercase file names of all images. Every trigram of the utf-8 bytes of the names maps
+    to the sorted rows that contain it, so a query only has to look at the names that share its rarest trigrams.
+    Queries shorter than three bytes, which have no trigrams, check the names directly.
+    """
+    def __init__(self, names: list[str]):
+        self.names = [name.lower() for name in names]
+        keys = [np.zeros(0, dtype=np.int64)]
+        for start in range(0, len(self.names), TRIGRAM_CHUNK):
+            encoded = np.array([name.encode() for name in self.names[start:start+TRIGRAM_CHUNK]], dtype=bytes)
+            width = encoded.dtype.itemsize
+            if width < 3:
+                continue
+            chars = encoded.view(np.uint8).reshape(len(encoded), width)
+            codes = _trigram_codes(chars)
+            # shorter names are padded with zero bytes, which never occur in a name
+            valid = chars[:, 2:] != 0
+            rows = np.broadcast_to(np.arange(start, start+len(encoded), dtype=np.int64)[:, None], codes.shape)
+            keys.append(codes[valid]*len(self.names) + rows[valid])
+        keys = np.sort(np.concatenate(keys))
+        keys = keys[np.concatenate([keys[:1] >= 0, keys[1:] != keys[:-1]])]
+        n = max(len(self.names), 1)
+        self.codes = keys // n
+        self.rows = keys % n
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + self.rows.nbytes + collection_bytes(self.names)
+
+    def posting(self, code: int) -> np.ndarray:
+        start, end = np.searchsorted(self.codes, [code, code+1])
+        return self.rows[start:end]
+
+    def search(self, query: str, within: np.ndarray | None = None) -> np.ndarray:
+        """
+        The sorted rows whose name contains `query', ignoring case. When `within' is given only those rows are
+        considered, which makes typing one more character cheap: its results are a subset of the previous ones.
+        """
+        query = query.lower()
+        candidates = within
+        encoded = np.frombuffer(query.encode(), dtype=np.uint8)
+        if len(encoded) >= 3:
+            postings = sorted((self.posting(int(code)) for code in np.unique(_trigram_codes(encoded))), key=len)
+            for posting in postings[:MAX_INTERSECTED]:
+                candidates = posting if candidates is None else np.intersect1d(candidates, posting, assume_unique=True)
+        if candidates is None:
+            candidates = np.arange(len(self.names), dtype=np.int64)
+        if not query:
+            return candidates
+        names = self.names
+        return np.fromiter((row for row in candidates.tolist() if query in names[row]), dtype=np.int64)
@@ -1,14 +1,62 @@
 from __future__ import annotations
 import os
 import imgui
+import numpy as np
 from application import Viewer, Application
+from feature_store import FeatureExtractor
+from image_catalog import ImageCatalog
 from image_viewer import ImageViewer
+from query_viewer import MetadataQueryViewer
+from exif_reader import CaptureTimeExtractor
+from list_index import NameIndex, natural_order
+from memory_budget import MemoryConsumer, MeasuredMemory
+
+
+SHOW_ALL, SHOW_SELECTED, SHOW_UNSELECTED = range(3)
+SHOW_NAMES = ["all", "selected", "unselected"]
+SOURCE_ORDER, NAME_ORDER, TIME_ORDER, SIZE_ORDER = range(4)
+ORDER_NAMES = ["source order", "name", "capture time", "file size"]
+MAX_QUERY_LENGTH = 256
+
+
+def selected_positions(catalog: ImageCatalog, subsets: list[set[int]]) -> np.ndarray:
+    # which images are selected, by catalog position
+    mask = np.zeros(len(catalog), dtype=bool)
+    for source_index, subset in enumerate(subsets):
+        if subset:
+            indices = np.fromiter(subset, dtype=np.int64, count=len(subset))
+            mask[catalog.source_starts[source_index]+indices] = True
+    return mask
 
 
 class ListViewer(Viewer):
+    """
+    Lists the images of all sources, filtered by name and selection and sorted by source order, name, capture time or
+    file size. Only the rows that are scrolled into view are drawn, so the list stays fast for any number of images.
+    Optionally the arrow keys of the image viewer follow the listed order.
+    """
     def __init__(self):
         self.is_shown = True
         self.image_viewer: ImageViewer | None = None
+        self.query_viewer: MetadataQueryViewer | None = None
+        self.extractor = CaptureTimeExtractor()
+        self.query = ""
+        self.show = SHOW_ALL
+        self.order = SOURCE_ORDER
+        self.reverse = False
+        self.follow_list = False
+        # name index of the catalog version it was built for
+        self.name_index: NameIndex | None = None
+        self.index_version = 0
+        # catalog positions matching `result_query', kept to narrow down the next query
+        self.results: np.ndarray | None = None
+        self.result_query = ""
+        # sorted catalog positions per sort order, with what they were computed from
+        self.orders: dict[int, tuple[tuple, np.ndarray]] = {}
+        # the listed catalog positions and what they were computed from
+        self.view = np.zeros(0, dtype=np.int64)
+        self.view_key: tuple | None = None
+        self.view_positions: np.ndarray | None = None
 
     def open(self):
         self.is_shown = True
@@ -17,13 +65,153 @@ class ListViewer(Viewer):
     def name(self) -> str:
         return "Image list"
 
+    def get_extractors(self) -> list[FeatureExtractor]:
+        return [self.extractor]
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        return {"image list name index": MeasuredMemory(
+            lambda: 0 if self.name_index is None else self.name_index.nbytes)}
+
+    @staticmethod
+    def store_matches(app: Application) -> bool:
+        # feature store ids are catalog positions when the store was opened on the current sources
+        return app.store.sources == app.selection.catalog.sources and len(app.store) == len(app.selection.catalog)
+
+    def update_index(self, catalog: ImageCatalog):
+        if catalog.version == self.index_version and self.name_index is not None:
+            return
+        names = [os.path.basename(source.image_paths[index])
+                 for source in catalog.sources for index in range(len(source.image_paths))]
+        self.name_index = NameIndex(names)
+        self.index_version = catalog.version
+        self.results = None
+        self.result_query = ""
+        self.orders = {}
+
+    def search(self) -> np.ndarray | None:
+        # None when no name filter is set
+        query = self.query.lower()
+        if not query:
+            return None
+        if self.results is None or query != self.result_query:
+            # the matches of a longer query are among the matches of any part of it
+            within = self.results if self.results is not None and self.result_query in query else None
+            self.results = self.name_index.search(query, within)
+            self.result_query = query
+        return self.results
+
+    def sorted_positions(self, app: Application, catalog: ImageCatalog) -> np.ndarray:
+        order = self.order
+        if order in (TIME_ORDER, SIZE_ORDER) and self.store_matches(app):
+            # capture times are filled in by later reloads, the count of read files tells when that happened
+            _, _, read = self.extractor.time_columns(app.store)
+            key = (catalog.version, app.store.directory, int(np.count_nonzero(read)))
+        else:
+            # without times and sizes of the current sources the images stay in source order
+            order = order if order == NAME_ORDER else SOURCE_ORDER
+            key = (catalog.version,)
+        cached = self.orders.get(order)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        if order == NAME_ORDER:
+            positions = natural_order(self.name_index.names)
+        elif order == TIME_ORDER:
+            times, valid, _ = self.extractor.time_columns(app.store)
+            # images without a capture time go last, in source order
+            positions = np.lexsort((np.asarray(times), ~np.asarray(valid)))
+        elif order == SIZE_ORDER:
+            positions = np.argsort(np.asarray(app.store.column("file_size", np.int64)), kind="stable")
+        else:
+            positions = np.arange(len(catalog), dtype=np.int64)
+        self.orders[order] = (key, positions)
+        return positions
+
+    def update_view(self, app: Application):
+        catalog = app.selection.catalog
+        self.update_index(catalog)
+        results = self.search()
+        positions = self.sorted_positions(app, catalog)
+        # metadata query matches are by feature store id, which only line up with the catalog for the same sources
+        matches = None
+        if self.query_viewer is not None and self.store_matches(app):
+            matches = self.query_viewer.list_matches(app)
+        # the sorted positions are cached, the same array means the same order
+        key = (catalog.version, self.query.lower(), self.show, self.reverse,
+               app.selection.version if self.show != SHOW_ALL else 0,
+               self.query_viewer.version if matches is not None else 0)
+        if key == self.view_key and positions is self.view_positions:
+            return
+        mask = np.ones(len(catalog), dtype=bool)
+        if results is not None:
+            mask[:] = False
+            mask[results] = True
+        if self.show != SHOW_ALL:
+            selected = selected_positions(catalog, app.selection.subsets)
+            mask &= selected if self.show == SHOW_SELECTED else ~selected
+        if matches is not None:
+            mask &= matches
+        self.view = positions[mask[positions]]
+        if self.reverse:
+            self.view = self.view[::-1]
+        self.view_key = key
+        self.view_positions = positions
+        if self.follow_list and self.image_viewer is not None:
+            self.image_viewer.set_navigation_order(catalog, self.view)
+
+    def draw_controls(self, app: Application):
+        imgui.push_item_width(200)
+        _, self.query = imgui.input_text_with_hint("##name filter", "filter by name", self.query, MAX_QUERY_LENGTH)
+        imgui.same_line()
+        _, self.show = imgui.combo("show", self.show, SHOW_NAMES)
+        imgui.same_line()
+        _, self.order = imgui.combo("sort by", self.order, ORDER_NAMES)
+        imgui.pop_item_width()
+        imgui.same_line()
+        _, self.reverse = imgui.checkbox("reverse", self.reverse)
+        changed, self.follow_list = imgui.checkbox("arrow keys follow this list", self.follow_list)
+        if changed and self.image_viewer is not None:
+            self.image_viewer.set_navigation_order(app.selection.catalog, self.view if self.follow_list else None)
+        if self.order in (TIME_ORDER, SIZE_ORDER) and not self.store_matches(app):
+            imgui.same_line()
+            if imgui.small_button("Read times and sizes"):
+                app.reload_features()
+
+    def draw_row(self, app: Application, catalog: ImageCatalog, position: int):
+        source, i = catalog.at(position)
+        # draw little arrow button
+        if self.image_viewer is not None:
+            is_pointed = self.image_viewer.current_source == source and self.image_viewer.current_image == i
+            if is_pointed:
+                imgui.push_style_color(imgui.COLOR_BUTTON, 0.7, 0.7, 0.)
+            imgui.push_id(str(catalog.position_ids[position]))
+            if imgui.small_button(">"):
+                self.image_viewer.set_image(app, source, i)
+            imgui.pop_id()
+            if is_pointed:
+                imgui.pop_style_color()
+            imgui.same_line()
+        # draw clickable file name
+        source_index = int(catalog.position_sources[position])
+        is_selected = i in app.selection.subsets[source_index]
+        copies = app.identical_files(source, i)
+        marker = f" (={copies+1})" if copies > 0 else ""
+        _, result = imgui.selectable(f"{os.path.basename(source.image_paths[i])}{marker}"
+                                     f"##{catalog.position_ids[position]}", selected=is_selected)
+        if imgui.is_item_hovered():
+            note = f"\nidentical to {copies} other file{'s' if copies > 1 else ''}" if copies > 0 else ""
+            imgui.set_tooltip(f"{source.name}: {source.image_paths[i]}{note}")
+        if result != is_selected:
+            app.selection.set_selected(source_index, [i], result)
+            app.changed = True
+
     def draw_ui(self, app: Application) -> None:
-        # find the current image viewer object
-        if self.image_viewer is None:
+        # find the current image viewer and query viewer objects
+        if self.image_viewer is None or self.query_viewer is None:
             for viewer in app.viewers:
                 if isinstance(viewer, ImageViewer):
                     self.image_viewer = viewer
-                    break
+                elif isinstance(viewer, MetadataQueryViewer):
+                    self.query_viewer = viewer
         if not self.is_shown:
             return
         with imgui.begin("Image list", closable=True) as list_window:
@@ -32,29 +220,19 @@ class ListViewer(Viewer):
             if list_window.expanded:
                 if len(app.selection.sources) == 0:
                     imgui.text("No sources to show.")
-                for source, subset in zip(app.selection.sources, app.selection.subsets):
-                    if imgui.collapsing_header(f"{source.name} - {len(source.image_paths)} files", None,
-                                               imgui.TREE_NODE_DEFAULT_OPEN)[0]:
-                        for i, image in enumerate(source.image_paths):
-                            # draw little arrow button
-                            if self.image_viewer is not None:
-                                is_pointed = (self.image_viewer.current_source == source
-                                              and self.image_viewer.current_image == i)
-                                if is_pointed:
-                                    imgui.push_style_color(imgui.COLOR_BUTTON, 0.7, 0.7, 0.)
-                                imgui.push_id(f"a button - {i} {source.absolute_path}")
-                                if imgui.small_button(">"):
-                                    self.image_viewer.set_image(source, i)
-                                imgui.pop_id()
-                                if is_pointed:
-                                    imgui.pop_style_color()
-                                imgui.same_line()
-                            # draw clickable file name
-                            is_selected = i in subset
-                            _, result = imgui.selectable(os.path.basename(image), selected=is_selected)
-                            if result and not is_selected:
-                                subset.add(i)
-                                app.changed = True
-                            if not result and is_selected:
-                                subset.remove(i)
-                                app.changed = True
+                    return
+                self.draw_controls(app)
+                self.update_view(app)
+                catalog = app.selection.catalog
+                imgui.text(f"{len(self.view)} of {len(catalog)} images")
+                with imgui.begin_child("image rows", 0., 0., False):
+                    # rows all have the same height, only the ones in view are drawn
+                    row_height = imgui.get_text_line_height_with_spacing()
+                    first = max(0, int(imgui.get_scroll_y()/row_height))
+                    last = min(len(self.view), first+int(imgui.get_window_height()/row_height)+2)
+                    top = imgui.get_cursor_pos_y()
+                    imgui.set_cursor_pos_y(top+first*row_height)
+                    for position in self.view[first:last].tolist():
+                        self.draw_row(app, catalog, position)
+                    imgui.set_cursor_pos_y(top+len(self.view)*row_height)
+                    imgui.dummy(0., 0.)
@@ -0,0 +1,155 @@
+from __future__ import annotations
+import abc
+import collections
+import os
+import sys
+import time
+from typing import Callable, Generic, Hashable, Iterable, TypeVar
+
+
+DEFAULT_MEMORY_BUDGET = 2 << 30
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class MemoryConsumer(abc.ABC):
+    """
+    Something that holds a notable amount of memory, on the cpu or on the gpu. Caches can also give up entries: they
+    report when the entry they would drop next was last used, so a `MemoryBudget' can drop the least recently used
+    entries over all caches together, instead of every cache keeping to a budget of its own.
+    """
+    on_gpu = False
+    # caches count towards the budget, other consumers are only reported
+    is_cache = False
+
+    @property
+    @abc.abstractmethod
+    def nbytes(self) -> int:
+        pass
+
+    def eviction_candidate(self) -> float | None:
+        # time of last use of the entry that would be evicted next, None when nothing can be evicted
+        return None
+
+    def evict_one(self):
+        pass
+
+
+class MeasuredMemory(MemoryConsumer):
+    """
+    Reports the size of a structure that is not a cache, measured by a function when asked for.
+    """
+    def __init__(self, measure: Callable[[], int], on_gpu: bool = False):
+        self.measure = measure
+        self.on_gpu = on_gpu
+
+    @property
+    def nbytes(self) -> int:
+        return self.measure()
+
+
+class LruCache(MemoryConsumer, Generic[K, V]):
+    """
+    Least recently used cache bounded by the number of bytes of its values, as given by `size_of'. The entry that was
+    put last is never evicted, even when it is larger than the whole cache. Without `max_bytes' the cache is only
+    bounded by the `MemoryBudget' it is reported to.
+    """
+    is_cache = True
+
+    def __init__(self, max_bytes: int | None, size_of: Callable[[V], int]):
+        self.max_bytes = max_bytes
+        self.size_of = size_of
+        self._nbytes = 0
+        # key -> (value, size, time of last use)
+        self._entries: collections.OrderedDict[K, tuple[V, int, float]] = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self._entries
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    def get(self, key: K) -> V | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries[key] = (entry[0], entry[1], time.monotonic())
+        self._entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: K, value: V):
+        if key in self._entries:
+            return
+        size = self.size_of(value)
+        self._entries[key] = (value, size, time.monotonic())
+        self._nbytes += size
+        while self.max_bytes is not None and self._nbytes > self.max_bytes and len(self._entries) > 1:
+            self.evict_one()
+
+    def remove(self, key: K):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._nbytes -= entry[1]
+
+    def clear(self):
+        self._entries.clear()
+        self._nbytes = 0
+
+    def eviction_candidate(self) -> float | None:
+        # the last entry stays, like in `put'
+        if len(self._entries) <= 1:
+            return None
+        return next(iter(self._entries.values()))[2]
+
+    def evict_one(self):
+        _, (_, size, _) = self._entries.popitem(last=False)
+        self._nbytes -= size
+
+
+class MemoryBudget:
+    """
+    Keeps track of the memory of all registered consumers and keeps the caches among them under one budget, shared
+    between cpu and gpu caches. When they use more, entries are evicted from whichever cache holds the least recently
+    used one, until the caches fit again.
+    """
+    def __init__(self, budget: int = DEFAULT_MEMORY_BUDGET):
+        self.budget = budget
+        self.evicted_bytes = 0
+
+    @staticmethod
+    def cache_bytes(consumers: Iterable[MemoryConsumer]) -> int:
+        return sum(consumer.nbytes for consumer in consumers if consumer.is_cache)
+
+    def enforce(self, consumers: Iterable[MemoryConsumer]):
+        caches = [consumer for consumer in consumers if consumer.is_cache]
+        total = sum(cache.nbytes for cache in caches)
+        while total > self.budget:
+            candidates = [(candidate, i) for i, cache in enumerate(caches)
+                          if (candidate := cache.eviction_candidate()) is not None]
+            if not candidates:
+                break
+            cache = caches[min(candidates)[1]]
+            before = cache.nbytes
+            cache.evict_one()
+            freed = before - cache.nbytes
+            self.evicted_bytes += freed
+            total -= freed
+
+
+def collection_bytes(items: list | set | dict) -> int:
+    # the container and the objects in it, for containers of strings, numbers or other flat objects
+    return sys.getsizeof(items) + sum(sys.getsizeof(item) for item in items)
+
+
+def resident_bytes() -> int | None:
+    # resident memory of this process, where the system tells
+    try:
+        with open("/proc/self/statm") as file:
+            pages = int(file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages*os.sysconf("SC_PAGE_SIZE")
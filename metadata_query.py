@@ -0,0 +1,341 @@
+from __future__ import annotations
+import abc
+import datetime
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+from application import Application
+from feature_store import FeatureStore, FeatureExtractor
+from exif_reader import CaptureTimeExtractor, read_metadata, BULK_WORKERS
+
+
+TEXT_FIELDS = ["camera", "lens"]
+NUMBER_FIELDS = ["focal", "focal35", "iso", "shutter", "aperture", "latitude", "longitude"]
+DEFAULT_FIELDS = TEXT_FIELDS + NUMBER_FIELDS
+# fields computed from the capture time: seconds since midnight and days since the epoch
+TIME_FIELDS = ["time", "date"]
+MICROSECONDS_PER_DAY = 86400*10**6
+OPERATORS = {"=", "!=", "<", "<=", ">", ">=", "~"}
+_TOKEN = re.compile(r'\s*(?:(<=|>=|!=|[()=<>~])|"([^"]*)"|([^\s()<>=!~"]+))')
+
+
+class QueryError(Exception):
+    pass
+
+
+def _read_all(paths: list[str], workers: int = BULK_WORKERS) -> list[dict[str, float | str]]:
+    if len(paths) < 2*workers:
+        return [read_metadata(path) for path in paths]
+    with ThreadPoolExecutor(workers) as executor:
+        return list(executor.map(read_metadata, paths, chunksize=64))
+
+
+class MetadataExtractor(FeatureExtractor):
+    """
+    Keeps a configurable set of EXIF fields of every image in the feature store. Numbers are float columns with nan
+    for images without the field. Text fields are int32 codes of the strings table of the shared cache, which every
+    process that writes to the same columns agrees on, code 0 is the empty string for images without the field. The
+    files are only read for their EXIF data, no image is decoded.
+    """
+    def __init__(self, fields: list[str] | None = None):
+        self.fields = list(DEFAULT_FIELDS if fields is None else fields)
+        # the strings by their code
+        self.vocabulary: list[str] = [""]
+        # changes on every reset, so derived results know to be computed again
+        self.generation = 0
+
+    @staticmethod
+    def column_name(field: str) -> str:
+        # text columns are named after the shared codes, codes of the vocabulary files of earlier versions differ
+        return f"exif_{field}_code" if field in TEXT_FIELDS else f"exif_{field}"
+
+    @staticmethod
+    def column(store: FeatureStore, field: str) -> np.ndarray:
+        if field in TEXT_FIELDS:
+            return store.column(MetadataExtractor.column_name(field), np.int32)
+        # degrees need more precision than float32 has
+        return store.column(f"exif_{field}", np.float64 if field in ("latitude", "longitude") else np.float32)
+
+    @staticmethod
+    def read_column(store: FeatureStore, field: str) -> np.ndarray:
+        return store.column(f"{MetadataExtractor.column_name(field)}_read", bool)
+
+    def reset(self, app: Application, store: FeatureStore):
+        self.generation += 1
+        missing = np.zeros(len(store), dtype=bool)
+        for field in self.fields:
+            missing |= ~self.read_column(store, field)
+        missing = np.flatnonzero(missing)
+        if len(missing) > 0:
+            print(f"Reading EXIF metadata of {len(missing)} images...")
+            metadata = _read_all(store.paths(missing))
+            text_fields = [field for field in self.fields if field in TEXT_FIELDS]
+            codes = app.shared_cache.string_codes(values[field] for values in metadata for field in text_fields
+                                                  if field in values)
+            for field in self.fields:
+                column = self.column(store, field)
+                if field in TEXT_FIELDS:
+                    column[missing] = [codes.get(values.get(field), 0) for values in metadata]
+                else:
+                    column[missing] = [values.get(field, np.nan) for values in metadata]
+            for field in self.fields:
+                self.read_column(store, field)[missing] = True
+        # with the strings of other processes that write to the same columns
+        self.vocabulary = app.shared_cache.strings()
+
+
+class Predicate(abc.ABC):
+    @abc.abstractmethod
+    def evaluate(self, context: QueryContext) -> np.ndarray:
+        pass
+
+
+@dataclass
+class Comparison(Predicate):
+    field: str
+    operator: str
+    value: float | str
+
+    def evaluate(self, context: QueryContext) -> np.ndarray:
+        if self.field in TEXT_FIELDS:
+            codes = context.text_codes(self.field)
+            # the few distinct values are compared as strings, the images only look up the result of their code
+            value = str(self.value).lower()
+            vocabulary = [text.lower() for text in context.vocabulary]
+            if self.operator == "~":
+                matches = np.array([value in text for text in vocabulary], dtype=bool)
+            elif self.operator in ("=", "!="):
+                matches = np.array([value == text for text in vocabulary], dtype=bool)
+                if self.operator == "!=":
+                    matches = ~matches
+                    matches[0] = False
+            else:
+                raise QueryError(f"{self.field} can only be compared with =, != or ~")
+            return matches[codes]
+        if self.operator == "~":
+            raise QueryError(f"~ only works on text, not on {self.field}")
+        values = context.numbers(self.field)
+        # in the type of the column, so exact values like 1/250 compare equal
+        value = values.dtype.type(self.value)
+        with np.errstate(invalid="ignore"):
+            if self.operator == "=":
+                return values == value
+            if self.operator == "!=":
+                return (values != value) & ~np.isnan(values)
+            if self.operator == "<":
+                return values < value
+            if self.operator == "<=":
+                return values <= value
+            if self.operator == ">":
+                return values > value
+            return values >= value
+
+
+@dataclass
+class Has(Predicate):
+    field: str
+
+    def evaluate(self, context: QueryContext) -> np.ndarray:
+        if self.field in TEXT_FIELDS:
+            return context.text_codes(self.field) != 0
+        return ~np.isnan(context.numbers(self.field))
+
+
+@dataclass
+class Not(Predicate):
+    operand: Predicate
+
+    def evaluate(self, context: QueryContext) -> np.ndarray:
+        return ~self.operand.evaluate(context)
+
+
+@dataclass
+class And(Predicate):
+    left: Predicate
+    right: Predicate
+
+    def evaluate(self, context: QueryContext) -> np.ndarray:
+        return self.left.evaluate(context) & self.right.evaluate(context)
+
+
+@dataclass
+class Or(Predicate):
+    left: Predicate
+    right: Predicate
+
+    def evaluate(self, context: QueryContext) -> np.ndarray:
+        return self.left.evaluate(context) | self.right.evaluate(context)
+
+
+class QueryContext:
+    """
+    The columns a query is evaluated on, read from the feature store when a query first needs them.
+    """
+    def __init__(self, store: FeatureStore, extractor: MetadataExtractor):
+        self.store = store
+        self.extractor = extractor
+        self.vocabulary = extractor.vocabulary
+        self._numbers: dict[str, np.ndarray] = {}
+
+    def check_field(self, field: str):
+        if field not in self.extractor.fields and field not in TIME_FIELDS:
+            raise QueryError(f"the field {field} is not read, the fields are {', '.join(self.extractor.fields)}")
+
+    def text_codes(self, field: str) -> np.ndarray:
+        self.check_field(field)
+        codes = np.asarray(self.extractor.column(self.store, field))
+        # codes of strings another process added since, the query sees them as missing
+        return np.where(codes < len(self.vocabulary), codes, 0)
+
+    def numbers(self, field: str) -> np.ndarray:
+        self.check_field(field)
+        if field not in self._numbers:
+            if field in TIME_FIELDS:
+                times, valid, _ = CaptureTimeExtractor.time_columns(self.store)
+                times = np.asarray(times)
+                if field == "time":
+                    values = (times % MICROSECONDS_PER_DAY) / 10**6
+                else:
+                    values = (times // MICROSECONDS_PER_DAY).astype(np.float64)
+                self._numbers[field] = np.where(valid, values, np.nan)
+            else:
+                self._numbers[field] = np.asarray(self.extractor.column(self.store, field))
+        return self._numbers[field]
+
+
+def parse_value(field: str, text: str) -> float | str:
+    """
+    Reads a value in the units people write them in: "85mm", "1/250" or "1/250s", "f/2.8", "14:30" for times of day
+    and "2024-05-01" for dates.
+    """
+    if field in TEXT_FIELDS:
+        return text
+    lowered = text.lower()
+    try:
+        if field == "time":
+            parts = [float(part) for part in lowered.split(":")]
+            if not 1 <= len(parts) <= 3:
+                raise ValueError
+            return sum(part*unit for part, unit in zip(parts, (3600, 60, 1)))
+        if field == "date":
+            return float((datetime.date.fromisoformat(lowered) - datetime.date(1970, 1, 1)).days)
+        for suffix in ("mm", "s"):
+            lowered = lowered.removesuffix(suffix)
+        if field == "aperture":
+            lowered = lowered.removeprefix("f/").removeprefix("f")
+        if "/" in lowered:
+            numerator, denominator = lowered.split("/", 1)
+            return float(numerator)/float(denominator)
+        return float(lowered)
+    except ValueError:
+        raise QueryError(f"{text} is not a valid value for {field}") from None
+
+
+class _Parser:
+    """
+    query      := or
+    or         := and ("or" and)*
+    and        := not ("and" not)*
+    not        := "not" not | "(" or ")" | "has" field | field "between" value "and" value | field operator value
+    """
+    def __init__(self, text: str):
+        self.tokens: list[tuple[str, str]] = []
+        position = 0
+        text = text.strip()
+        while position < len(text):
+            match = _TOKEN.match(text, position)
+            if match is None or match.end() == position:
+                raise QueryError(f"cannot read the query from '{text[position:]}'")
+            symbol, quoted, word = match.groups()
+            if symbol is not None:
+                self.tokens.append(("symbol", symbol))
+            elif quoted is not None:
+                self.tokens.append(("text", quoted))
+            else:
+                self.tokens.append(("word", word))
+            position = match.end()
+        self.position = 0
+
+    def peek(self) -> tuple[str, str] | None:
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def next(self, expected: str) -> tuple[str, str]:
+        token = self.peek()
+        if token is None:
+            raise QueryError(f"the query ends where {expected} was expected")
+        self.position += 1
+        return token
+
+    def keyword(self, word: str) -> bool:
+        token = self.peek()
+        if token is not None and token[0] == "word" and token[1].lower() == word:
+            self.position += 1
+            return True
+        return False
+
+    def field(self) -> str:
+        kind, field = self.next("a field")
+        field = field.lower()
+        if kind != "word" or field not in DEFAULT_FIELDS + TIME_FIELDS:
+            raise QueryError(f"unknown field {field}, the fields are {', '.join(DEFAULT_FIELDS + TIME_FIELDS)}")
+        return field
+
+    def value(self, field: str) -> float | str:
+        kind, text = self.next("a value")
+        if kind == "symbol":
+            raise QueryError(f"expected a value after {field}, not {text}")
+        return parse_value(field, text)
+
+    def parse(self) -> Predicate:
+        predicate = self.parse_or()
+        if self.peek() is not None:
+            raise QueryError(f"unexpected {self.peek()[1]}")
+        return predicate
+
+    def parse_or(self) -> Predicate:
+        predicate = self.parse_and()
+        while self.keyword("or"):
+            predicate = Or(predicate, self.parse_and())
+        return predicate
+
+    def parse_and(self) -> Predicate:
+        predicate = self.parse_not()
+        while self.keyword("and"):
+            predicate = And(predicate, self.parse_not())
+        return predicate
+
+    def parse_not(self) -> Predicate:
+        if self.keyword("not"):
+            return Not(self.parse_not())
+        if self.peek() == ("symbol", "("):
+            self.position += 1
+            predicate = self.parse_or()
+            if self.next("')'") != ("symbol", ")"):
+                raise QueryError("expected ')'")
+            return predicate
+        if self.keyword("has"):
+            return Has(self.field())
+        field = self.field()
+        if self.keyword("between"):
+            low = self.value(field)
+            if not self.keyword("and"):
+                raise QueryError("expected 'and' in between")
+            return And(Comparison(field, ">=", low), Comparison(field, "<=", self.value(field)))
+        kind, operator = self.next("an operator")
+        if kind != "symbol" or operator not in OPERATORS:
+            raise QueryError(f"expected an operator after {field}, one of {' '.join(sorted(OPERATORS))}")
+        return Comparison(field, operator, self.value(field))
+
+
+def parse_query(text: str) -> Predicate:
+    """
+    Parses queries like 'focal = 85mm', 'iso > 3200 and not lens ~ zoom', 'time between 14:00 and 15:30' or
+    'camera ~ "x100" or has latitude'. Raises a `QueryError' describing the problem for invalid queries.
+    """
+    return _Parser(text).parse()
+
+
+def evaluate_query(predicate: Predicate, store: FeatureStore, extractor: MetadataExtractor) -> np.ndarray:
+    # mask of the images that match, by feature store id
+    return predicate.evaluate(QueryContext(store, extractor))
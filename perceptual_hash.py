@@ -0,0 +1,134 @@
+from __future__ import annotations
+import numpy as np
+from PIL import Image
+from application import Application
+from feature_store import FeatureStore, FeatureExtractor
+
+
+HASH_WIDTH = 8
+HASH_HEIGHT = 8
+HASH_BITS = HASH_WIDTH*HASH_HEIGHT
+POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def dhash(pil_image: Image.Image) -> int:
+    """
+    Difference hash: one bit per horizontally adjacent pixel pair of a tiny grayscale version of the image, set when
+    the brightness increases to the right.
+    """
+    pil_image.draft("RGB", (HASH_WIDTH*8, HASH_HEIGHT*8))
+    gray = np.asarray(pil_image.convert("L").resize((HASH_WIDTH+1, HASH_HEIGHT), Image.BILINEAR), dtype=np.int16)
+    bits = np.packbits(gray[:, 1:] > gray[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+
+def hamming_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    xor = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.int64)
+
+
+def near_duplicate_pairs(hashes: np.ndarray, radius: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Finds pairs of hashes within the given Hamming distance using multi-index hashing. The hashes are split into
+    radius+1 chunks, and by the pigeonhole principle two hashes within the radius agree exactly on at least one
+    chunk. Only pairs sharing a chunk value are compared, so the cost grows with the number of near duplicates
+    rather than with n². Identical hashes, like those of black or blank frames, are compared through one
+    representative that is paired with each of its copies, so the pairs connect the same groups as all pairs within
+    the radius without listing every one of them.
+    """
+    unique_hashes, representatives, inverse = np.unique(hashes, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    n = len(unique_hashes)
+    chunk_count = min(radius+1, HASH_BITS)
+    bounds = np.linspace(0, HASH_BITS, chunk_count+1).astype(int)
+    positions = np.arange(n)
+    firsts, seconds = [], []
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        keys = (unique_hashes >> np.uint64(low)) & np.uint64((1 << int(high-low))-1)
+        order = np.argsort(keys, kind="stable")
+        sorted_keys = keys[order]
+        # for every position in the sorted order, the end of the bucket of equal keys it is in
+        starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+        ends = np.repeat(np.r_[starts[1:], n], np.diff(np.r_[starts, n]))
+        offset = 1
+        candidates = positions[ends-positions > offset]
+        while len(candidates) > 0:
+            a = order[candidates]
+            b = order[candidates+offset]
+            close = hamming_distances(unique_hashes[a], unique_hashes[b]) <= radius
+            firsts.append(a[close])
+            seconds.append(b[close])
+            offset += 1
+            candidates = candidates[ends[candidates]-candidates > offset]
+    # a pair that agrees on several chunks is found once for each of them
+    empty = np.zeros(0, dtype=np.intp)
+    a, b = np.concatenate([empty] + firsts), np.concatenate([empty] + seconds)
+    pairs = np.unique(np.minimum(a, b)*n + np.maximum(a, b))
+    copies = np.flatnonzero(representatives[inverse] != np.arange(len(hashes)))
+    return (np.r_[representatives[pairs//n], copies].astype(np.intp),
+            np.r_[representatives[pairs % n], representatives[inverse[copies]]].astype(np.intp))
+
+
+def connected_labels(n: int, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # label propagation with pointer jumping: every node ends up labeled with the smallest id in its component
+    labels = np.arange(n)
+    while True:
+        np.minimum.at(labels, a, labels[b])
+        np.minimum.at(labels, b, labels[a])
+        while True:
+            jumped = labels[labels]
+            if np.array_equal(jumped, labels):
+                break
+            labels = jumped
+        if np.array_equal(labels[a], labels[b]):
+            return labels
+
+
+class DuplicateGroups:
+    """
+    Partition of the images of the feature store into groups of near duplicates. Images without any near duplicate
+    are not part of a group.
+    """
+    def __init__(self, labels: np.ndarray):
+        self.order = np.argsort(labels, kind="stable")
+        sorted_labels = labels[self.order]
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        sizes = np.diff(np.r_[starts, len(labels)])
+        self.starts = starts[sizes > 1]
+        self.sizes = sizes[sizes > 1]
+        # the index of the group each image is in, -1 for images without duplicates
+        self.group_of = np.full(len(labels), -1, dtype=np.int64)
+        self.group_of[self.order[np.repeat(sizes > 1, sizes)]] = np.repeat(np.arange(len(self.sizes)), self.sizes)
+
+    @classmethod
+    def from_hashes(cls, hashes: np.ndarray, radius: int) -> DuplicateGroups:
+        return DuplicateGroups(connected_labels(len(hashes), *near_duplicate_pairs(hashes, radius)))
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def nbytes(self) -> int:
+        return self.order.nbytes + self.starts.nbytes + self.sizes.nbytes + self.group_of.nbytes
+
+    def members(self, group: int) -> np.ndarray:
+        start = self.starts[group]
+        return self.order[start:start+self.sizes[group]]
+
+    def members_of(self, image_id: int) -> np.ndarray:
+        group = self.group_of[image_id]
+        return np.array([image_id]) if group == -1 else self.members(group)
+
+
+class PerceptualHashExtractor(FeatureExtractor):
+    @staticmethod
+    def hash_columns(store: FeatureStore) -> tuple[np.ndarray, np.ndarray]:
+        return store.column("dhash", np.uint64), store.column("dhash_valid", bool)
+
+    def needs_image(self, store: FeatureStore) -> np.ndarray:
+        return ~self.hash_columns(store)[1]
+
+    def process(self, app: Application, store: FeatureStore, image_id: int, pil_image: Image.Image):
+        hashes, valid = self.hash_columns(store)
+        hashes[image_id] = dhash(pil_image)
+        valid[image_id] = True
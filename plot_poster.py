@@ -0,0 +1,274 @@
+from __future__ import annotations
+import contextlib
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+import moderngl
+import numpy as np
+from plot_renderer import PlotRenderer
+
+
+# a band of tiles is rendered per step, so a band of a 30000 pixel wide poster is about 23 MB
+TILE_WIDTH = 2048
+TILE_HEIGHT = 256
+# bands rendered ahead of the writer, compressing is usually slower than rendering
+QUEUED_BANDS = 2
+PNG_COMPRESSION = 6
+# classic tiff stores offsets in 32 bits, posters that could come near that use BigTIFF
+BIGTIFF_LIMIT = 1 << 31
+POSTER_FILE_TYPES = ["*.png", "*.tif", "*.tiff"]
+
+
+class PngStreamWriter:
+    """
+    Writes an RGB PNG row by row. Rows are deflated as they come in and written out as IDAT chunks, so only the
+    compressor's window is kept in memory.
+    """
+    def __init__(self, path: str, width: int, height: int):
+        self.file = open(path, "wb")
+        self.width = width
+        self.compressor = zlib.compressobj(PNG_COMPRESSION)
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bits per channel, truecolor, no interlacing
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def _chunk(self, kind: bytes, data: bytes):
+        self.file.write(struct.pack(">I", len(data)) + kind + data
+                        + struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+    def write_rows(self, rows: np.ndarray):
+        # every row starts with its filter type, 0 for none
+        filtered = np.zeros((len(rows), 1+3*self.width), dtype=np.uint8)
+        filtered[:, 1:] = rows.reshape(len(rows), 3*self.width)
+        data = self.compressor.compress(filtered.tobytes())
+        if data:
+            self._chunk(b"IDAT", data)
+
+    def close(self):
+        self._chunk(b"IDAT", self.compressor.flush())
+        self._chunk(b"IEND", b"")
+        self.file.close()
+
+
+class TiffStreamWriter:
+    """
+    Writes an RGB TIFF with one deflated strip per call to `write_rows'. The directory with the strip offsets goes
+    after the strips, the header is patched to point at it when the file is closed.
+    """
+    SHORT, LONG, LONG8 = 3, 4, 16
+    FORMATS = {SHORT: "H", LONG: "I", LONG8: "Q"}
+
+    def __init__(self, path: str, width: int, height: int, rows_per_strip: int):
+        self.file = open(path, "wb")
+        self.width = width
+        self.height = height
+        self.rows_per_strip = rows_per_strip
+        self.big = width*height*3 >= BIGTIFF_LIMIT
+        self.strip_offsets: list[int] = []
+        self.strip_sizes: list[int] = []
+        if self.big:
+            self.file.write(b"II+\x00" + struct.pack("<HHQ", 8, 0, 0))
+        else:
+            self.file.write(b"II*\x00" + struct.pack("<I", 0))
+
+    def write_rows(self, rows: np.ndarray):
+        data = zlib.compress(np.ascontiguousarray(rows).tobytes(), PNG_COMPRESSION)
+        self.strip_offsets.append(self.file.tell())
+        self.strip_sizes.append(len(data))
+        self.file.write(data)
+
+    def _pack(self, kind: int, values: list[int]) -> bytes:
+        return struct.pack(f"<{len(values)}{self.FORMATS[kind]}", *values)
+
+    def close(self):
+        offset_kind = self.LONG8 if self.big else self.LONG
+        entries = [
+            (256, self.LONG, [self.width]),
+            (257, self.LONG, [self.height]),
+            (258, self.SHORT, [8, 8, 8]),
+            # adobe deflate
+            (259, self.SHORT, [8]),
+            # rgb
+            (262, self.SHORT, [2]),
+            (273, offset_kind, self.strip_offsets),
+            (277, self.SHORT, [3]),
+            (278, self.LONG, [self.rows_per_strip]),
+            (279, offset_kind, self.strip_sizes),
+            # contiguous channels
+            (284, self.SHORT, [1]),
+        ]
+        # the directory starts on a word boundary, values that do not fit in their entry go right after it
+        if self.file.tell() % 2:
+            self.file.write(b"\x00")
+        directory = self.file.tell()
+        count_format, entry_format, inline = ("<Q", "<HHQ", 8) if self.big else ("<H", "<HHI", 4)
+        entry_size = struct.calcsize(entry_format)+inline
+        extra_offset = directory + struct.calcsize(count_format) + len(entries)*entry_size + inline
+        table, extra = [struct.pack(count_format, len(entries))], []
+        for tag, kind, values in entries:
+            data = self._pack(kind, values)
+            table.append(struct.pack(entry_format, tag, kind, len(values)))
+            if len(data) <= inline:
+                table.append(data.ljust(inline, b"\x00"))
+            else:
+                table.append(self._pack(offset_kind, [extra_offset]))
+                extra.append(data)
+                extra_offset += len(data)
+        # no next directory
+        table.append(bytes(inline))
+        self.file.write(b"".join(table + extra))
+        self.file.seek(8 if self.big else 4)
+        self.file.write(self._pack(offset_kind, [directory]))
+        self.file.close()
+
+
+def open_poster_writer(path: str, width: int, height: int) -> PngStreamWriter | TiffStreamWriter:
+    if os.path.splitext(path)[1].lower() in (".tif", ".tiff"):
+        return TiffStreamWriter(path, width, height, TILE_HEIGHT)
+    return PngStreamWriter(path, width, height)
+
+
+def create_headless_context() -> moderngl.Context:
+    # egl needs no display server, and mesa falls back to its software rasterizer on machines without a gpu
+    try:
+        return moderngl.create_standalone_context(backend="egl")
+    except Exception:
+        return moderngl.create_standalone_context()
+
+
+def fit_view(centers: np.ndarray, radii: np.ndarray, width: int,
+             margin: float = .02) -> tuple[np.ndarray, float, int]:
+    # camera position, world units per pixel and height of a poster showing all the given circles
+    low = (centers-radii[:, None]).min(axis=0)
+    high = (centers+radii[:, None]).max(axis=0)
+    extent = np.maximum(high-low, 1e-9)*(1+2*margin)
+    scale = float(extent[0]/width)
+    return (low+high)/2, scale, max(1, int(np.ceil(extent[1]/scale)))
+
+
+class PosterJob:
+    """
+    Renders a plot layout into an image of any size, tile by tile in an offscreen framebuffer. Every step renders one
+    band of tiles and hands it to a writer thread that streams it into a PNG or TIFF file, so neither the gpu nor
+    memory ever holds the whole image. The layout and flags are uploaded to buffers of the job's own, so the plot can
+    keep changing while the job runs.
+    """
+    def __init__(self, mgl: moderngl.Context, centers: np.ndarray, radii: np.ndarray, colors: np.ndarray,
+                 flags: np.ndarray, camera_position: np.ndarray, camera_scale: float, size: tuple[int, int],
+                 path: str, selection_color: tuple[float, float, float], selection_thickness: float,
+                 background_color: tuple[int, int, int] = (0, 0, 0)):
+        self.mgl = mgl
+        self.width, self.height = size
+        self.camera_position = np.asarray(camera_position, dtype=float)
+        self.camera_scale = camera_scale
+        self.path = path
+        self.selection_color = selection_color
+        self.selection_thickness = selection_thickness
+        self.background_color = background_color
+        self.renderer = PlotRenderer(mgl)
+        self.renderer.update_layout(centers, radii, colors)
+        self.renderer.update_flags(flags)
+        self.tile_size = (min(TILE_WIDTH, self.width), min(TILE_HEIGHT, self.height))
+        self.framebuffer: moderngl.Framebuffer | None = mgl.simple_framebuffer(self.tile_size, components=4)
+        self.next_row = 0
+        self.rows_written = 0
+        self.error: str | None = None
+        self._cancelled = threading.Event()
+        # one more place than bands rendered ahead for the end marker, so putting never blocks
+        self._bands: queue.Queue[np.ndarray | None] = queue.Queue(QUEUED_BANDS+1)
+        self._writer = open_poster_writer(path, self.width, self.height)
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    @property
+    def progress(self) -> float:
+        return self.rows_written/self.height
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread.is_alive()
+
+    @property
+    def is_finished(self) -> bool:
+        return self.next_row >= self.height and not self.is_running
+
+    def cancel(self):
+        self._cancelled.set()
+        with contextlib.suppress(queue.Full):
+            self._bands.put_nowait(None)
+        self.release()
+
+    def render_tile(self, x: int, y: int, width: int, height: int) -> np.ndarray:
+        # the tile is a small screen whose center is the world position of its center pixel
+        offset = np.array([x+width/2-self.width/2, y+height/2-self.height/2])
+        center = self.camera_position + offset*self.camera_scale
+        self.framebuffer.viewport = (0, 0, width, height)
+        self.framebuffer.use()
+        self.framebuffer.clear(*(channel/255 for channel in self.background_color), 1.)
+        self.renderer.render(center, self.camera_scale, np.array([width, height]), self.selection_color,
+                             self.selection_thickness)
+        data = self.framebuffer.read(viewport=(0, 0, width, height), components=3)
+        # gl rows go from the bottom up
+        return np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)[::-1]
+
+    def step(self) -> bool:
+        """
+        Renders the next band unless the writer is still behind, returns whether one was rendered. The screen is bound
+        again afterwards, so this can run in the middle of drawing a frame.
+        """
+        if self.next_row >= self.height or self._cancelled.is_set() or not self.is_running:
+            self.release()
+            return False
+        if self._bands.qsize() >= QUEUED_BANDS:
+            return False
+        height = min(self.tile_size[1], self.height-self.next_row)
+        band = np.empty((height, self.width, 3), dtype=np.uint8)
+        # the window draws everything else to the screen, standalone contexts have no framebuffer of their own
+        screen = self.mgl.screen
+        try:
+            for x in range(0, self.width, self.tile_size[0]):
+                width = min(self.tile_size[0], self.width-x)
+                band[:, x:x+width] = self.render_tile(x, self.next_row, width, height)
+        finally:
+            if screen is not None:
+                screen.use()
+        self.next_row += height
+        self._bands.put(band)
+        if self.next_row >= self.height:
+            self._bands.put(None)
+            self.release()
+        return True
+
+    def run(self):
+        # renders the whole poster, for use without a window
+        while self.next_row < self.height and self.is_running:
+            if not self.step():
+                time.sleep(.005)
+        self.release()
+        self._thread.join()
+
+    def _write(self):
+        try:
+            while (band := self._bands.get()) is not None and not self._cancelled.is_set():
+                self._writer.write_rows(band)
+                self.rows_written += len(band)
+            self._writer.close()
+        except OSError as e:
+            self.error = str(e)
+        if self._cancelled.is_set() or self.error is not None:
+            # a partial poster would look complete in most viewers
+            with contextlib.suppress(OSError):
+                self._writer.file.close()
+                os.remove(self.path)
+
+    def release(self):
+        if self.framebuffer is None:
+            return
+        self.framebuffer.release()
+        self.renderer.release_buffers()
+        self.renderer.program.release()
+        self.renderer.corners.release()
+        self.framebuffer = None
@@ -0,0 +1,198 @@
+from __future__ import annotations
+import moderngl
+import numpy as np
+
+
+VISIBLE_FLAG = 1
+SELECTED_FLAG = 2
+# images that do not match the metadata query are drawn faded
+DIMMED_FLAG = 4
+DIMMED_ALPHA = .15
+# above this fraction of changed circles the flags are uploaded in one piece
+PARTIAL_UPDATE_LIMIT = 1/8
+
+_CORNERS = np.array([[-1., -1.], [1., -1.], [-1., 1.], [1., 1.]], dtype="f4")
+
+_CIRCLE_VERT_SHADER = '''
+#version 330 core
+
+uniform vec2 camera_position;
+uniform float camera_scale;
+uniform vec2 screen_size;
+uniform float selection_thickness;
+uniform float dimmed_alpha;
+uniform float blend;
+
+in vec2 corner;
+in vec2 start_center;
+in float start_radius;
+in vec4 start_color;
+in vec2 end_center;
+in float end_radius;
+in vec4 end_color;
+in uint flags;
+
+out vec2 offset;
+out float fill_radius;
+out float ring_radius;
+out vec4 fill_color;
+
+void main() {
+    // animations move every circle from its start to its end, both stay on the gpu while they run
+    vec2 center = mix(start_center, end_center, blend);
+    vec4 color = mix(start_color, end_color, blend);
+    fill_radius = mix(start_radius, end_radius, blend)/camera_scale;
+    ring_radius = (flags & 2u) != 0u ? fill_radius+selection_thickness : 0.;
+    // one extra pixel for the anti-aliased edge, hidden circles collapse to a point
+    float extent = (flags & 1u) != 0u ? max(fill_radius, ring_radius)+1. : 0.;
+    offset = corner*extent;
+    vec2 screen = (center-camera_position)/camera_scale + screen_size/2. + offset;
+    gl_Position = vec4(screen.x/screen_size.x*2.-1., 1.-screen.y/screen_size.y*2., 0., 1.);
+    fill_color = (flags & 4u) != 0u ? vec4(color.rgb, color.a*dimmed_alpha) : color;
+}
+'''
+
+_CIRCLE_FRAG_SHADER = '''
+#version 330 core
+
+uniform vec3 selection_color;
+
+in vec2 offset;
+in float fill_radius;
+in float ring_radius;
+in vec4 fill_color;
+out vec4 f_color;
+
+void main() {
+    float distance = length(offset);
+    float fill = clamp(fill_radius-distance+.5, 0., 1.)*fill_color.a;
+    float ring = clamp(ring_radius-distance+.5, 0., 1.);
+    float alpha = fill + ring*(1.-fill);
+    if (alpha <= 0.) {
+        discard;
+    }
+    f_color = vec4((fill_color.rgb*fill + selection_color*ring*(1.-fill))/alpha, alpha);
+}
+'''
+
+
+def pack_colors(colors: np.ndarray) -> np.ndarray:
+    # float rgba in [0, 1] to one u32 per circle, in the byte order the shader reads them
+    return np.round(np.clip(colors, 0., 1.)*255).astype(np.uint8).view(np.uint32).reshape(len(colors))
+
+
+def changed_runs(changed: np.ndarray) -> list[tuple[int, int]]:
+    # sorted indices to (start, end) ranges of consecutive indices
+    if len(changed) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(changed) != 1)+1
+    starts = changed[np.concatenate([[0], breaks])]
+    ends = changed[np.concatenate([breaks-1, [len(changed)-1]])]+1
+    return list(zip(starts.tolist(), ends.tolist()))
+
+
+class PlotRenderer:
+    """
+    Draws the circles of the image plotter as one instanced draw call. The per-circle data is kept in gpu buffers
+    in world coordinates and is only uploaded again when the layout or the flags change, the camera is applied in
+    the vertex shader. Every circle has a start and an end, which the vertex shader mixes, so an animation between
+    two layouts uploads them once and then only changes a uniform. Changes to a few flags, like toggling the
+    selection of some images, only upload those.
+    """
+    def __init__(self, mgl: moderngl.Context):
+        self.mgl = mgl
+        self.program = mgl.program(vertex_shader=_CIRCLE_VERT_SHADER, fragment_shader=_CIRCLE_FRAG_SHADER)
+        self.corners = mgl.buffer(_CORNERS.tobytes())
+        self.size = 0
+        self.centers: moderngl.Buffer | None = None
+        self.radii: moderngl.Buffer | None = None
+        self.colors: moderngl.Buffer | None = None
+        self.end_centers: moderngl.Buffer | None = None
+        self.end_radii: moderngl.Buffer | None = None
+        self.end_colors: moderngl.Buffer | None = None
+        self.flags: moderngl.Buffer | None = None
+        self.vertex_array: moderngl.VertexArray | None = None
+        self.flag_values = np.zeros(0, dtype=np.uint32)
+
+    def _allocate(self, size: int):
+        self.release_buffers()
+        self.size = size
+        if size == 0:
+            return
+        self.centers = self.mgl.buffer(reserve=8*size)
+        self.radii = self.mgl.buffer(reserve=4*size)
+        self.colors = self.mgl.buffer(reserve=4*size)
+        self.end_centers = self.mgl.buffer(reserve=8*size)
+        self.end_radii = self.mgl.buffer(reserve=4*size)
+        self.end_colors = self.mgl.buffer(reserve=4*size)
+        self.flags = self.mgl.buffer(reserve=4*size)
+        self.flag_values = np.zeros(size, dtype=np.uint32)
+        self.flags.write(self.flag_values.tobytes())
+        self.vertex_array = self.mgl.vertex_array(self.program, [
+            (self.corners, "2f4", "corner"),
+            (self.centers, "2f4/i", "start_center"),
+            (self.radii, "f4/i", "start_radius"),
+            (self.colors, "4f1/i", "start_color"),
+            (self.end_centers, "2f4/i", "end_center"),
+            (self.end_radii, "f4/i", "end_radius"),
+            (self.end_colors, "4f1/i", "end_color"),
+            (self.flags, "u4/i", "flags"),
+        ])
+
+    def update_layout(self, centers: np.ndarray, radii: np.ndarray, colors: np.ndarray,
+                      target: tuple[np.ndarray, np.ndarray, np.ndarray] | None = None):
+        # `target' is the centers, radii and colors the circles move to, the layout itself when not given
+        if len(radii) != self.size:
+            self._allocate(len(radii))
+        if self.size == 0:
+            return
+        data = [centers.astype("f4").tobytes(), radii.astype("f4").tobytes(), pack_colors(colors).tobytes()]
+        if target is not None:
+            target_centers, target_radii, target_colors = target
+            end_data = [target_centers.astype("f4").tobytes(), target_radii.astype("f4").tobytes(),
+                        pack_colors(target_colors).tobytes()]
+        else:
+            end_data = data
+        for buffer, values in zip((self.centers, self.radii, self.colors, self.end_centers, self.end_radii,
+                                   self.end_colors), data+end_data):
+            buffer.write(values)
+
+    def update_flags(self, flags: np.ndarray):
+        if self.size == 0:
+            return
+        flags = flags.astype(np.uint32)
+        changed = np.flatnonzero(flags != self.flag_values)
+        if len(changed) > PARTIAL_UPDATE_LIMIT*self.size:
+            self.flags.write(flags.tobytes())
+        else:
+            for start, end in changed_runs(changed):
+                self.flags.write(flags[start:end].tobytes(), offset=4*start)
+        self.flag_values = flags
+
+    def render(self, camera_position: np.ndarray, camera_scale: float, screen_size: np.ndarray,
+               selection_color: tuple[float, float, float], selection_thickness: float, blend: float = 0.):
+        if self.size == 0:
+            return
+        self.program["blend"] = float(blend)
+        self.program["camera_position"] = tuple(float(x) for x in camera_position)
+        self.program["camera_scale"] = float(camera_scale)
+        self.program["screen_size"] = tuple(float(x) for x in screen_size)
+        self.program["selection_color"] = tuple(float(x) for x in selection_color)
+        self.program["selection_thickness"] = float(selection_thickness)
+        self.program["dimmed_alpha"] = DIMMED_ALPHA
+        self.mgl.enable(moderngl.BLEND)
+        self.vertex_array.render(moderngl.TRIANGLE_STRIP, instances=self.size)
+
+    @property
+    def nbytes(self) -> int:
+        # gpu memory of the per-circle buffers
+        return 36*self.size
+
+    def release_buffers(self):
+        for resource in (self.vertex_array, self.centers, self.radii, self.colors, self.end_centers, self.end_radii,
+                         self.end_colors, self.flags):
+            if resource is not None:
+                resource.release()
+        self.vertex_array = self.centers = self.radii = self.colors = self.flags = None
+        self.end_centers = self.end_radii = self.end_colors = None
+        self.size = 0
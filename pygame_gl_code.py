@@ -1,10 +1,12 @@
 from __future__ import annotations
+import json
 import numpy as np
 import pygame
 import pygame.gfxdraw
 import moderngl
 import OpenGL.GL as GL
 from pygame._sdl2 import Window as SDL2Window
+from texture_pool import TexturePool, PooledTexture, TextureUploader
 
 
 PYGAME_DIGITS = [pygame.K_0, pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4,
@@ -13,7 +15,9 @@ PYGAME_DIGITS = [pygame.K_0, pygame.K_1, pygame.K_2, pygame.K_3, pygame.K_4,
 class PygameGLWindow:
     def __init__(self, size: tuple[int, int], caption: str, frame_rate: float, background_color,
                  resizable=False, tracked_keys=None, track_digits=False, check_for_close=True, open_maximized=False,
-                 double_click_time: float = 0.4):
+                 double_click_time: float = 0.4, texture_budget: int | None = None,
+                 record_file: str | None = None, replay_file: str | None = None,
+                 replay_delta_time: float = 1/60):
         self._start_screen_size = size
         self._caption = caption
         self.frame_rate = frame_rate
@@ -24,6 +28,9 @@ class PygameGLWindow:
         self._int_size: tuple[int, int] = size
         self._do_quit = False
         self.mgl: moderngl.Context | None = None
+        self.textures: TexturePool | None = None
+        self.uploads: TextureUploader | None = None
+        self._texture_budget = texture_budget
         self.clock = None
         self._screen2cam: np.ndarray = np.zeros((4, 3), dtype=float)
         if size != (0, 0):
@@ -45,19 +52,36 @@ class PygameGLWindow:
         self._on_window_close = False
         self._time_since_left_click = 0
         self._on_double_left_click = False
+        self._delta_time = 0.
+        # recording writes the inputs of every frame to a file, replaying reads them back instead of asking pygame
+        self.record_file = record_file
+        self.replay_file = replay_file
+        self.replay_delta_time = replay_delta_time
+        self._recording = None
+        self._replay = None
         if tracked_keys is not None:
             for key in tracked_keys:
                 self._key_tracking[key] = False
 
     def open(self):
+        replay_header = None
+        if self.replay_file is not None:
+            self._replay = open(self.replay_file)
+            replay_header = json.loads(self._replay.readline())
+            # the recorded session starts from the same window size, the window itself stays hidden
+            self._start_screen_size = tuple(replay_header["size"])
+            self._update_size(self._start_screen_size)
+            self._open_maximized = False
         # initialize pygame
         pygame.init()
+        hidden = pygame.HIDDEN if self._replay is not None else 0
         if self._resizable:
-            pygame.display.set_mode(self._start_screen_size, pygame.OPENGL | pygame.DOUBLEBUF | pygame.RESIZABLE)
+            pygame.display.set_mode(self._start_screen_size,
+                                    pygame.OPENGL | pygame.DOUBLEBUF | pygame.RESIZABLE | hidden)
             if self._open_maximized:
                 SDL2Window.from_display_module().maximize()
         else:
-            pygame.display.set_mode(self._start_screen_size, pygame.OPENGL | pygame.DOUBLEBUF)
+            pygame.display.set_mode(self._start_screen_size, pygame.OPENGL | pygame.DOUBLEBUF | hidden)
         if self._start_screen_size == (0, 0):
             info_object = pygame.display.Info()
             self._update_size((info_object.current_w, info_object.current_h))
@@ -66,14 +90,20 @@ class PygameGLWindow:
         # initialise moderngl
         self.mgl = moderngl.create_context()
         self.mgl.gc_mode = 'auto'
+        self.textures = TexturePool(self.mgl, self._texture_budget)
+        self.uploads = TextureUploader(self.mgl)
         self.mgl.clear(*(x / 255.0 for x in self.background_color), 1.0)
 
         # handle timing and input things
         self.clock = pygame.time.Clock()
-        self._cur_pos = self._screen_to_np(pygame.mouse.get_pos())
+        mouse_position = pygame.mouse.get_pos() if replay_header is None else tuple(replay_header["mouse"])
+        self._cur_pos = self._screen_to_np(mouse_position)
         self._cur_click = pygame.mouse.get_pressed(num_buttons=5)
         self._delta_cur = np.zeros(2, dtype=float)
-        self.events = pygame.event.get()
+        self.events = pygame.event.get() if self._replay is None else []
+        if self.record_file is not None:
+            self._recording = open(self.record_file, "w")
+            self._recording.write(json.dumps({"size": list(self.int_size), "mouse": list(mouse_position)}) + "\n")
         for key in self._key_tracking.keys():
             self._key_tracking[key] = False
             self._key_down_tracking[key] = False
@@ -81,18 +111,29 @@ class PygameGLWindow:
     def next_frame(self):
         # reset for next frame
         pygame.display.flip()
-        self.clock.tick(self.frame_rate)
+        if self._replay is None:
+            self.clock.tick(self.frame_rate)
+            self._delta_time = self.clock.get_time()/1000
+            mouse_position, mouse_buttons = pygame.mouse.get_pos(), pygame.mouse.get_pressed()
+            self.events = pygame.event.get()
+        else:
+            # as fast as possible, with the same time step every frame
+            self.clock.tick()
+            self._delta_time = self.replay_delta_time
+            mouse_position, mouse_buttons, self.events = self._next_replay_frame()
+        if self._recording is not None:
+            self._record_frame(mouse_position, mouse_buttons)
         self.mgl.clear(*(x / 255.0 for x in self.background_color), 1.0)
+        self.uploads.next_frame()
 
         # handle mouse values
         last_cur_pos = self._cur_pos
-        self._cur_pos = self._screen_to_np(pygame.mouse.get_pos())
+        self._cur_pos = self._screen_to_np(mouse_position)
         self._delta_cur = self._cur_pos-last_cur_pos
-        self._cur_click = pygame.mouse.get_pressed()
+        self._cur_click = mouse_buttons
         self._time_since_left_click += self.delta_time
 
         # handle events
-        self.events = pygame.event.get()
         for key in self._key_tracking.keys():
             self._key_down_tracking[key] = False
         self.digit_presses.clear()
@@ -131,7 +172,43 @@ class PygameGLWindow:
             if self.track_digits and event.type == pygame.KEYDOWN and event.key in PYGAME_DIGITS:
                 self.digit_presses.append(PYGAME_DIGITS.index(event.key))
 
+    def _record_frame(self, mouse_position: tuple[int, int], mouse_buttons: tuple[bool, ...]):
+        events = []
+        for event in self.events:
+            # attributes like the sdl window object cannot be stored and are not needed
+            data = {key: list(value) if isinstance(value, tuple) else value for key, value in event.dict.items()
+                    if isinstance(value, (int, float, str, tuple))}
+            events.append({"type": event.type, "data": data})
+        self._recording.write(json.dumps({"delta_time": self._delta_time, "mouse": list(mouse_position),
+                                          "buttons": list(mouse_buttons), "events": events}) + "\n")
+
+    def _next_replay_frame(self) -> tuple[tuple[int, int], tuple[bool, ...], list[pygame.event.Event]]:
+        # the real events of the hidden window are drained and ignored
+        pygame.event.pump()
+        pygame.event.clear()
+        line = self._replay.readline()
+        if not line:
+            self.quit()
+            return self.np_to_screen(self._cur_pos), tuple(self._cur_click), []
+        frame = json.loads(line)
+        events = [pygame.event.Event(event["type"], {key: tuple(value) if isinstance(value, list) else value
+                                                     for key, value in event["data"].items()})
+                  for event in frame["events"]]
+        return tuple(frame["mouse"]), tuple(frame["buttons"]), events
+
+    @property
+    def is_replaying(self) -> bool:
+        return self._replay is not None
+
     def close(self):
+        if self._recording is not None:
+            self._recording.close()
+            self._recording = None
+        if self._replay is not None:
+            self._replay.close()
+            self._replay = None
+        self.uploads.release()
+        self.textures.release_all()
         self.mgl.release()
         pygame.quit()
         self._do_quit = False
@@ -158,7 +235,7 @@ class PygameGLWindow:
 
     @property
     def delta_time(self):
-        return self.clock.get_time()/1000
+        return self._delta_time
 
     def enable_blend(self):
         self.mgl.enable(moderngl.BLEND)
@@ -286,11 +363,11 @@ class PygameGLWindow:
         p = self.np_to_screen(x)
         return 0 <= p[0] <= self.width and 0 <= p[1] <= self.height
 
-    def texture_from_surface(self, surface) -> moderngl.Texture:
+    def texture_from_surface(self, surface, owner: str = "surfaces") -> PooledTexture:
         # see https://www.youtube.com/watch?v=LFbePt8i0DI
-        tex = self.mgl.texture(surface.get_size(), 4)
-        tex.filter = (moderngl.NEAREST, moderngl.NEAREST)
-        tex.swizzle = 'BGRA'
+        tex = self.textures.acquire(surface.get_size(), 4, owner=owner, exact=True)
+        tex.texture.filter = (moderngl.NEAREST, moderngl.NEAREST)
+        tex.texture.swizzle = 'BGRA'
         tex.write(surface.get_view('1'))
         return tex
 
@@ -321,7 +398,7 @@ class ProgramWrapper:
     def __setitem__(self, key, value):
         try:
             if isinstance(value, moderngl.Texture):
-                if key in self._textures:
+                if key in self._texture_uniforms:
                     self._textures[self._texture_uniforms.index(key)] = value
                 else:
                     self.program[key] = len(self._textures)
@@ -389,7 +466,7 @@ class PygameUISurface:
 
         quad_buffer = self.window.mgl.buffer(_SINGLE_QUAD_DATA)
         self.program = ProgramWrapper(window.mgl.program(_SINGLE_QUAD_VERT_SHADER, _SINGLE_QUAD_FRAG_SHADER))
-        self.program["tex"] = self.texture
+        self.program["tex"] = self.texture.texture
         self.vertex_array = self.window.quick_vertex_array(self.program, {
             ("vert", "texcoord"): quad_buffer
         }, mode=moderngl.TRIANGLE_STRIP)
@@ -399,8 +476,9 @@ class PygameUISurface:
     def reset_surface(self):
         if self.surface.get_size() != self.window.int_size:
             self.surface = pygame.transform.scale(self.surface, self.window.int_size)
+            self.window.textures.release(self.texture)
             self.texture = self.window.texture_from_surface(self.surface)
-            self.program["tex"] = self.texture
+            self.program["tex"] = self.texture.texture
         self.surface.fill((0, 0, 0, 0))
 
     def update_texture(self):
@@ -0,0 +1,148 @@
+from __future__ import annotations
+import itertools
+import imgui
+import numpy as np
+from application import Application, Viewer
+from feature_store import FeatureExtractor
+from exif_reader import CaptureTimeExtractor
+from metadata_query import MetadataExtractor, Predicate, QueryError, parse_query, evaluate_query, TIME_FIELDS
+from memory_budget import MemoryConsumer, MeasuredMemory
+
+
+MAX_QUERY_LENGTH = 512
+QUERY_HELP = """Fields: {fields}
+Compare with = != < <= > >=, text also with ~ (contains), ignoring case.
+Combine with and, or, not and parentheses.
+Examples:
+    focal = 85mm
+    iso > 3200 and not lens ~ zoom
+    shutter <= 1/250 and aperture < f/2.8
+    time between 14:00 and 15:30
+    camera ~ "x100" or has latitude
+    date >= 2024-05-01"""
+_match_versions = itertools.count(1)
+
+
+class MetadataQueryViewer(Viewer):
+    """
+    Finds images by their EXIF metadata with small queries like 'iso > 3200 and lens ~ 56'. The fields are read once
+    into columns of the feature store, after which every query is a handful of vectorized comparisons over all images.
+    The matches can be selected or deselected, filter the image list and dim the other images in the plotter.
+    """
+    def __init__(self):
+        self.is_shown = False
+        self.extractor = MetadataExtractor()
+        self.time_extractor = CaptureTimeExtractor()
+        self.text = ""
+        self.predicate: Predicate | None = None
+        self.error = ""
+        self.filter_list = True
+        self.dim_plot = True
+        self.show_help = False
+        # matches by feature store id, with what they were computed from
+        self.mask: np.ndarray | None = None
+        self.mask_key: tuple | None = None
+        # changes whenever the matches do, for the viewers that use them
+        self.version = 0
+
+    @property
+    def name(self) -> str:
+        return "Metadata query"
+
+    def open(self):
+        self.is_shown = True
+
+    def get_extractors(self) -> list[FeatureExtractor]:
+        return [self.extractor, self.time_extractor]
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        return {"metadata query matches": MeasuredMemory(lambda: 0 if self.mask is None else self.mask.nbytes)}
+
+    def set_query(self, text: str):
+        self.text = text
+        self.predicate = None
+        self.error = ""
+        if not text.strip():
+            return
+        try:
+            self.predicate = parse_query(text)
+        except QueryError as error:
+            self.error = str(error)
+
+    def is_read(self, app: Application) -> bool:
+        # the metadata columns were filled in for the images of the current feature store
+        return self.extractor.generation > 0 and bool(app.store.sources)
+
+    def matches(self, app: Application) -> np.ndarray | None:
+        # mask of the matching images by feature store id, None when there is no query to apply
+        if self.predicate is None or not self.is_read(app):
+            return None
+        key = (self.text, self.extractor.generation, app.store.directory, len(app.store))
+        if key != self.mask_key:
+            self.mask_key = key
+            try:
+                mask = evaluate_query(self.predicate, app.store, self.extractor)
+            except QueryError as error:
+                self.error = str(error)
+                self.predicate = None
+                self.mask = None
+                self.version = next(_match_versions)
+                return None
+            # images whose files changed since the last reload have no metadata yet
+            for field in self.extractor.fields:
+                mask &= self.extractor.read_column(app.store, field)
+            self.mask = mask
+            self.version = next(_match_versions)
+        return self.mask
+
+    def list_matches(self, app: Application) -> np.ndarray | None:
+        return self.matches(app) if self.filter_list else None
+
+    def plot_matches(self, app: Application) -> np.ndarray | None:
+        return self.matches(app) if self.dim_plot else None
+
+    def draw_ui(self, app: Application) -> None:
+        if not self.is_shown:
+            return
+        with imgui.begin("Metadata query", True) as window:
+            if not window.opened:
+                self.is_shown = False
+            if not window.expanded:
+                return
+            if imgui.button("Reload"):
+                app.reload_features()
+            imgui.same_line()
+            _, self.show_help = imgui.checkbox("help", self.show_help)
+            imgui.same_line()
+            _, self.filter_list = imgui.checkbox("filter image list", self.filter_list)
+            imgui.same_line()
+            _, self.dim_plot = imgui.checkbox("dim others in plotter", self.dim_plot)
+            if self.show_help:
+                imgui.text(QUERY_HELP.format(fields=", ".join(self.extractor.fields + TIME_FIELDS)))
+            imgui.push_item_width(-1)
+            changed, text = imgui.input_text_with_hint("##query", "e.g. iso > 3200 and lens ~ 56", self.text,
+                                                       MAX_QUERY_LENGTH)
+            imgui.pop_item_width()
+            if changed:
+                self.set_query(text)
+            if self.error:
+                imgui.text_colored(self.error, 1., .4, .4)
+                return
+            if not self.is_read(app):
+                imgui.text("Press 'Reload' to read the metadata of the current sources.")
+                return
+            mask = self.matches(app)
+            if mask is None:
+                imgui.text("Type a query to find images by their metadata.")
+                return
+            image_ids = np.flatnonzero(mask)
+            imgui.text(f"{len(image_ids)} of {len(mask)} images match")
+            if imgui.button("Select matches"):
+                app.set_selected_ids(image_ids, True)
+            imgui.same_line()
+            if imgui.button("Deselect matches"):
+                app.set_selected_ids(image_ids, False)
+            imgui.same_line()
+            if imgui.button("Select only matches"):
+                app.set_selected_ids(np.flatnonzero(~mask & app.selected_mask()), False)
+                app.set_selected_ids(image_ids, True)
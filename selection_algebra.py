@@ -0,0 +1,167 @@
+from __future__ import annotations
+import itertools
+import json
+import os
+import numpy as np
+
+
+UNION, INTERSECTION, DIFFERENCE, SYMMETRIC_DIFFERENCE = range(4)
+OPERATION_NAMES = ["union", "intersection", "difference", "symmetric difference"]
+OPERATION_SYMBOLS = ["+", "&", "-", "^"]
+# file names only need normalizing on systems that ignore their case
+CASE_SENSITIVE = os.path.normcase("A") == "A"
+
+
+def normalize_path(path: str) -> str:
+    return os.path.normcase(os.path.normpath(os.path.abspath(path)))
+
+
+class PathTable:
+    """
+    Interns image paths to integer ids, in the order they are first seen, so a set of images becomes a boolean
+    mask over the ids and combining sets is a linear pass over arrays. Paths are normalized, so the same file
+    reached through two selection files in different folders gets one id. Images are looked up by file name in a
+    table per folder, which keeps the lookups in C for the common case of plain file names. For every id the table
+    remembers the source it was first seen in and its path relative to that source, to write the result as a
+    selection file.
+    """
+    def __init__(self):
+        # normalized folder -> file name -> id
+        self.folders: dict[str, dict[str, int]] = {}
+        # (absolute path, type) of every source, as in the "sources" of a selection file
+        self.sources: list[tuple[str, str]] = []
+        self.source_indices: dict[tuple[str, str], int] = {}
+        # per id, in batches of new ids: the source, the path relative to it, the folder and the file name
+        self.source_of: list[np.ndarray] = []
+        self.names: list[str] = []
+        self.folder_names: list[str] = []
+        self.file_names: list[str] = []
+
+    def __len__(self):
+        return len(self.names)
+
+    def intern(self, source_path: str, source_type: str, names: list[str]) -> np.ndarray:
+        # the ids of images of one source, adding the ones that were not seen before
+        source = (normalize_path(source_path), source_type)
+        source_index = self.source_indices.setdefault(source, len(self.sources))
+        if source_index == len(self.sources):
+            self.sources.append(source)
+        # images of a selection source are relative to the folder of its file
+        directory = source[0] if source_type == "folder" else os.path.dirname(source[0])
+        joined = "\n".join(names)
+        if not ("/" in joined or os.sep in joined or "\n." in joined or joined.startswith(".")):
+            keys = names if CASE_SENSITIVE else list(map(os.path.normcase, names))
+            return self._intern_names(directory, keys, names, source_index)
+        # names with folders in them are split up by the folder they end up in
+        groups: dict[str, tuple[list[int], list[str], list[str]]] = {}
+        for position, name in enumerate(names):
+            folder, key = os.path.split(normalize_path(os.path.join(directory, name)))
+            positions, keys, originals = groups.setdefault(folder, ([], [], []))
+            positions.append(position)
+            keys.append(key)
+            originals.append(name)
+        ids = np.empty(len(names), dtype=np.int64)
+        for folder, (positions, keys, originals) in groups.items():
+            ids[positions] = self._intern_names(folder, keys, originals, source_index)
+        return ids
+
+    def _intern_names(self, folder: str, keys: list[str], originals: list[str], source_index: int) -> np.ndarray:
+        table = self.folders.setdefault(folder, {})
+        all_keys = keys
+        known, new_positions = None, None
+        if table:
+            known = np.array(list(map(table.get, keys)), dtype=object)
+            new_positions = np.flatnonzero(np.equal(known, None))
+            if len(new_positions) == 0:
+                return known.astype(np.int64)
+            keys = [keys[i] for i in new_positions.tolist()]
+            originals = [originals[i] for i in new_positions.tolist()]
+        first_new = len(self.names)
+        size = len(table)
+        # written back to front, so a repeated name keeps the id of its first occurrence and the ids of the repeats
+        # stay unused, which saves a pass to remove them
+        table.update(zip(reversed(keys), range(first_new+len(keys)-1, first_new-1, -1)))
+        self.names.extend(originals)
+        self.file_names.extend(keys)
+        self.folder_names.extend(itertools.repeat(folder, len(keys)))
+        self.source_of.append(np.full(len(keys), source_index, dtype=np.int32))
+        if len(table)-size < len(keys):
+            return np.fromiter(map(table.__getitem__, all_keys), dtype=np.int64, count=len(all_keys))
+        if known is None:
+            return np.arange(first_new, first_new+len(keys), dtype=np.int64)
+        known[new_positions] = np.arange(first_new, first_new+len(keys))
+        return known.astype(np.int64)
+
+    def intern_file(self, path: str) -> np.ndarray:
+        # the ids of the selected images of a selection file
+        base_dir = os.path.dirname(os.path.abspath(path))
+        with open(path) as file:
+            data = json.load(file)
+        ids = [self.intern(os.path.join(base_dir, source_path), source_data["type"], source_data["selection"])
+               for source_path, source_data in data["sources"].items()]
+        return np.concatenate([np.zeros(0, dtype=np.int64)] + ids)
+
+    def paths(self, ids: np.ndarray) -> list[str]:
+        # normalized absolute paths
+        return [os.path.join(self.folder_names[i], self.file_names[i]) for i in ids.tolist()]
+
+    def mask(self, ids: np.ndarray) -> np.ndarray:
+        result = np.zeros(len(self), dtype=bool)
+        result[ids] = True
+        return result
+
+    def save(self, ids: np.ndarray, path: str):
+        """
+        Writes the images with the given ids as a new selection file, every image under the source it was first seen
+        in. Folders and selection files are referenced relative to the new file, like the application saves them.
+        """
+        base_dir = os.path.dirname(os.path.abspath(path))
+        ids = np.sort(ids)
+        source_of = np.concatenate([np.zeros(0, dtype=np.int32)] + self.source_of)[ids]
+        # stable, so the images of every source stay in the order they were first seen
+        order = np.argsort(source_of, kind="stable")
+        source_indices, starts = np.unique(source_of[order], return_index=True)
+        sources = {}
+        for source_index, source_ids in zip(source_indices.tolist(), np.split(ids[order], starts[1:])):
+            source_path, source_type = self.sources[source_index]
+            sources[os.path.relpath(source_path, base_dir)] = {
+                "type": source_type,
+                "selection": [self.names[i] for i in source_ids.tolist()]
+            }
+        with open(path, "w") as file:
+            json.dump({"sources": sources}, file, indent=2)
+
+
+def combine_masks(masks: list[np.ndarray], operations: list[int]) -> np.ndarray:
+    # folds the masks from left to right, `operations[i]' combines the result so far with `masks[i+1]'
+    result = masks[0].copy()
+    for operation, mask in zip(operations, masks[1:]):
+        if operation == UNION:
+            result |= mask
+        elif operation == INTERSECTION:
+            result &= mask
+        elif operation == DIFFERENCE:
+            result &= ~mask
+        elif operation == SYMMETRIC_DIFFERENCE:
+            result ^= mask
+        else:
+            raise ValueError(f"unknown set operation {operation}")
+    return result
+
+
+def combine_selection_files(paths: list[str], operations: list[int],
+                            output: str | None = None) -> tuple[PathTable, np.ndarray]:
+    """
+    Combines the selections of selection files from left to right with set operations, for example client picks
+    union own picks, difference rejects. Returns the table the images were interned in with the ids of the result,
+    and writes the result to `output' as a new selection file when given.
+    """
+    if len(operations) != len(paths)-1:
+        raise ValueError("there should be one operation between every two selection files")
+    table = PathTable()
+    # the masks only get their final length once every file is interned
+    file_ids = [table.intern_file(path) for path in paths]
+    result = np.flatnonzero(combine_masks([table.mask(ids) for ids in file_ids], operations))
+    if output is not None:
+        table.save(result, output)
+    return table, result
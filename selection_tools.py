@@ -0,0 +1,86 @@
+from __future__ import annotations
+import numpy as np
+
+
+MIN_LASSO_STEP = 4.
+
+
+class GridIndex:
+    """
+    Uniform grid over a set of 2d points, with the point ids sorted by cell so the points in a rectangle of cells
+    are found with one binary search per row of cells.
+    """
+    def __init__(self, points: np.ndarray):
+        self.points = points
+        n = len(points)
+        if n == 0:
+            self.low = np.zeros(2)
+            self.cell_size = 1.
+            self.columns = self.rows = 1
+            self.order = np.zeros(0, dtype=np.int64)
+            self.keys = np.zeros(0, dtype=np.int64)
+            return
+        self.low = points.min(axis=0)
+        extent = np.maximum(points.max(axis=0)-self.low, 1e-12)
+        # about one point per cell on average, the second term bounds the grid when the points lie on a line
+        self.cell_size = float(max(np.sqrt(extent.prod()/n), extent.max()/n))
+        self.columns, self.rows = (np.floor(extent/self.cell_size).astype(int)+1).tolist()
+        cells = np.floor((points-self.low)/self.cell_size).astype(np.int64)
+        keys = cells[:, 1]*self.columns+cells[:, 0]
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    @property
+    def nbytes(self) -> int:
+        # the points belong to the layout
+        return self.order.nbytes + self.keys.nbytes
+
+    def query_rect(self, low: np.ndarray, high: np.ndarray) -> np.ndarray:
+        # ids of the points in the cells that overlap the rectangle, a superset of the points inside it
+        x0, y0 = np.clip(np.floor((low-self.low)/self.cell_size), 0, [self.columns-1, self.rows-1]).astype(int)
+        x1, y1 = np.clip(np.floor((high-self.low)/self.cell_size), -1, [self.columns-1, self.rows-1]).astype(int)
+        if x1 < x0 or y1 < y0 or (high < low).any():
+            return np.zeros(0, dtype=np.int64)
+        rows = np.arange(y0, y1+1, dtype=np.int64)*self.columns
+        starts = np.searchsorted(self.keys, rows+x0, side="left")
+        ends = np.searchsorted(self.keys, rows+x1, side="right")
+        if len(rows) == 1:
+            return self.order[starts[0]:ends[0]]
+        return np.concatenate([self.order[start:end] for start, end in zip(starts, ends)])
+
+
+def points_in_rect(points: np.ndarray, corner_a: np.ndarray, corner_b: np.ndarray) -> np.ndarray:
+    low, high = np.minimum(corner_a, corner_b), np.maximum(corner_a, corner_b)
+    return ((points >= low) & (points <= high)).all(axis=1)
+
+
+def points_in_polygon(points: np.ndarray, polygon: np.ndarray) -> np.ndarray:
+    """
+    Even-odd test for many points against one polygon. The points are sorted by y once, so every edge only touches
+    the points in its own horizontal band and the total work is proportional to the number of edge crossings rather
+    than points times edges.
+    """
+    inside = np.zeros(len(points), dtype=bool)
+    if len(points) == 0 or len(polygon) < 3:
+        return inside
+    order = np.argsort(points[:, 1])
+    xs, ys = points[order, 0], points[order, 1]
+    parity = np.zeros(len(points), dtype=bool)
+    for (ax, ay), (bx, by) in zip(polygon, np.roll(polygon, -1, axis=0)):
+        if ay == by:
+            continue
+        # half open band, so a point level with a vertex is counted for exactly one of its two edges
+        start = np.searchsorted(ys, min(ay, by), side="left")
+        end = np.searchsorted(ys, max(ay, by), side="left")
+        if start == end:
+            continue
+        crossing_x = ax + (ys[start:end]-ay)*(bx-ax)/(by-ay)
+        parity[start:end] ^= xs[start:end] < crossing_x
+    inside[order] = parity
+    return inside
+
+
+def extend_lasso(points: list[np.ndarray], point: np.ndarray):
+    # skips points that are very close to the previous one, which keeps the number of edges down
+    if not points or np.linalg.norm(point-points[-1]) >= MIN_LASSO_STEP:
+        points.append(point)
@@ -0,0 +1,221 @@
+from __future__ import annotations
+import atexit
+import contextlib
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Iterable, Iterator, TypeVar
+import numpy as np
+from PIL import Image
+from feature_store import CACHE_DIR
+
+
+SHARED_DATABASE_FILE = "shared.sqlite"
+THUMBNAILS_DIR = "thumbnails"
+# a claim this old belongs to a process that died or hangs, and is taken over
+CLAIM_TIMEOUT = 15.
+CLAIM_POLL_INTERVAL = .05
+# how often a claim that is held for long work is renewed, well within the timeout
+CLAIM_REFRESH_INTERVAL = CLAIM_TIMEOUT/3
+# strings looked up per query, below the limit on the number of parameters of old sqlite versions
+STRING_BATCH = 500
+# seconds a connection waits for another process that is writing, which only takes a moment
+BUSY_TIMEOUT = 10.
+THUMBNAIL_QUALITY = 90
+DEFAULT_THUMBNAIL_BYTES = 1 << 30
+# tells apart the processes that share the cache, also when a process id is reused later
+PROCESS_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+T = TypeVar("T")
+
+
+def file_key(path: str, *parts) -> str | None:
+    # identifies a file by its path, modification time and size, so a changed file never hits an old entry
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    text = "\0".join([os.path.abspath(path), str(stat.st_mtime_ns), str(stat.st_size)] + [str(part) for part in parts])
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+
+def publish_file(path: str, data: bytes):
+    # written under a name of this process and thread and renamed into place, so readers see all of it or nothing
+    temporary_path = f"{path}.{PROCESS_ID}-{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(data)
+    os.replace(temporary_path, path)
+
+
+class SharedCache:
+    """
+    Per-file cache that is shared by all picsel processes on this machine, keyed by path, modification time and size.
+    The index is a SQLite database in WAL mode, in which readers never wait for a writer and a process that dies
+    halfway through a write leaves nothing behind. Thumbnails are files that are published by renaming them into
+    place. Claims in the database make sure one process at a time decodes a file: the others wait for its result
+    instead of doing the same work. The database also numbers strings for columns of text, so codes mean the same
+    in every process and every feature store. The cache directory should be on a local disk, SQLite cannot share a
+    WAL database over a network file system.
+    """
+    def __init__(self, cache_dir: str = CACHE_DIR, max_thumbnail_bytes: int = DEFAULT_THUMBNAIL_BYTES):
+        self.directory = os.path.join(cache_dir, THUMBNAILS_DIR)
+        os.makedirs(self.directory, exist_ok=True)
+        self.database_path = os.path.join(cache_dir, SHARED_DATABASE_FILE)
+        self.max_thumbnail_bytes = max_thumbnail_bytes
+        # sqlite connections belong to the thread that opened them
+        self._local = threading.local()
+        connection = self.connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS thumbnails "
+                           "(key TEXT PRIMARY KEY, width INTEGER, height INTEGER, bytes INTEGER, created REAL)")
+        connection.execute("CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, owner TEXT, time REAL)")
+        # the first string gets code 1, code 0 stays free for missing values
+        connection.execute("CREATE TABLE IF NOT EXISTS strings (code INTEGER PRIMARY KEY, text TEXT UNIQUE NOT NULL)")
+        self.prune()
+        atexit.register(self.release_all)
+
+    def connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # in autocommit mode every statement is its own transaction, none of them holds a lock for long
+            connection = sqlite3.connect(self.database_path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            # in WAL mode this loses at most the last commits on a power loss, never the consistency of the database
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def claim(self, key: str) -> bool:
+        # whether this process may compute the entry, false while another process is computing it
+        now = time.time()
+        connection = self.connection()
+        connection.execute("DELETE FROM claims WHERE key = ? AND time < ?", (key, now-CLAIM_TIMEOUT))
+        return connection.execute("INSERT OR IGNORE INTO claims VALUES (?, ?, ?)",
+                                  (key, PROCESS_ID, now)).rowcount == 1
+
+    def release(self, key: str):
+        self.connection().execute("DELETE FROM claims WHERE key = ? AND owner = ?", (key, PROCESS_ID))
+
+    def release_all(self):
+        self.connection().execute("DELETE FROM claims WHERE owner = ?", (PROCESS_ID,))
+
+    def is_claimed(self, key: str) -> bool:
+        return self.connection().execute("SELECT 1 FROM claims WHERE key = ? AND time >= ?",
+                                         (key, time.time()-CLAIM_TIMEOUT)).fetchone() is not None
+
+    @contextlib.contextmanager
+    def claimed(self, key: str) -> Iterator[None]:
+        """
+        Waits until no other process holds the claim and holds it for the duration of the block. A thread renews it,
+        so work that takes longer than the timeout is not taken over.
+        """
+        while not self.claim(key):
+            time.sleep(CLAIM_POLL_INTERVAL)
+        stop = threading.Event()
+
+        def refresh():
+            while not stop.wait(CLAIM_REFRESH_INTERVAL):
+                self.connection().execute("UPDATE claims SET time = ? WHERE key = ? AND owner = ?",
+                                          (time.time(), key, PROCESS_ID))
+        thread = threading.Thread(target=refresh, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self.release(key)
+
+    def string_codes(self, texts: Iterable[str]) -> dict[str, int]:
+        # the codes of the given strings, strings that no process has seen before get the next free code
+        texts = list(set(texts))
+        connection = self.connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            connection.executemany("INSERT OR IGNORE INTO strings (text) VALUES (?)", [(text,) for text in texts])
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        codes = {}
+        for start in range(0, len(texts), STRING_BATCH):
+            batch = texts[start:start+STRING_BATCH]
+            codes.update(connection.execute(
+                f"SELECT text, code FROM strings WHERE text IN ({', '.join('?'*len(batch))})", batch))
+        return codes
+
+    def strings(self) -> list[str]:
+        # every string by its code, codes without a string are the empty string
+        rows = self.connection().execute("SELECT code, text FROM strings").fetchall()
+        result = [""]*(max((code for code, _ in rows), default=0)+1)
+        for code, text in rows:
+            result[code] = text
+        return result
+
+    def single_flight(self, key: str, load: Callable[[], T | None], compute: Callable[[], T],
+                      publish: Callable[[T], None]) -> T:
+        """
+        Returns the cached value, or computes and publishes it when no other process is doing so already. When one is,
+        this waits for it to publish, or computes the value itself once the claim of the other process times out.
+        """
+        while True:
+            value = load()
+            if value is not None:
+                return value
+            if self.claim(key):
+                try:
+                    # another process may have published it between the lookup and the claim
+                    value = load()
+                    if value is None:
+                        value = compute()
+                        publish(value)
+                    return value
+                finally:
+                    self.release(key)
+            time.sleep(CLAIM_POLL_INTERVAL)
+
+    def thumbnail_path(self, key: str) -> str:
+        # spread over subfolders, so no folder gets too many files
+        return os.path.join(self.directory, key[:2], f"{key}.jpg")
+
+    def load_thumbnail(self, key: str) -> tuple[np.ndarray, tuple[int, int]] | None:
+        # the pixels of the thumbnail and the size of the full image
+        row = self.connection().execute("SELECT width, height FROM thumbnails WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with Image.open(self.thumbnail_path(key)) as thumbnail:
+                return np.asarray(thumbnail.convert("RGB")), (row[0], row[1])
+        except OSError:
+            # pruned by another process in the meantime
+            return None
+
+    def publish_thumbnail(self, key: str, pixels: np.ndarray, full_size: tuple[int, int]):
+        data = io.BytesIO()
+        Image.fromarray(pixels).save(data, format="JPEG", quality=THUMBNAIL_QUALITY)
+        path = self.thumbnail_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        publish_file(path, data.getvalue())
+        # the row goes in after the file, so a thumbnail that is in the index can always be read
+        self.connection().execute("INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?)",
+                                  (key, full_size[0], full_size[1], len(data.getvalue()), time.time()))
+
+    def prune(self):
+        # drops the oldest thumbnails until they fit in the budget, rows first so nobody looks for the removed files
+        connection = self.connection()
+        total = connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM thumbnails").fetchone()[0]
+        if total <= self.max_thumbnail_bytes:
+            return
+        removed = []
+        for key, size in connection.execute("SELECT key, bytes FROM thumbnails ORDER BY created"):
+            if total <= self.max_thumbnail_bytes*3//4:
+                break
+            removed.append(key)
+            total -= size
+        connection.executemany("DELETE FROM thumbnails WHERE key = ?", [(key,) for key in removed])
+        for key in removed:
+            with contextlib.suppress(OSError):
+                os.remove(self.thumbnail_path(key))
@@ -0,0 +1,129 @@
+import imgui
+import numpy as np
+from PIL import Image
+from application import Application
+from image_plotter import PositionGenerator, Layout
+from feature_store import FeatureStore
+
+
+THUMBNAIL_SIZE = 16
+HISTOGRAM_LEVELS = 4
+HISTOGRAM_BINS = HISTOGRAM_LEVELS**3
+FEATURE_SIZE = HISTOGRAM_BINS + (THUMBNAIL_SIZE//2)**2
+CHUNK_SIZE = 8192
+GRAY_WEIGHTS = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def thumbnail_column(store: FeatureStore) -> tuple[np.ndarray, np.ndarray]:
+    return (store.column("thumbnail", np.uint8, (THUMBNAIL_SIZE, THUMBNAIL_SIZE, 3)),
+            store.column("thumbnail_valid", bool))
+
+
+def feature_column(store: FeatureStore) -> tuple[np.ndarray, np.ndarray]:
+    return store.column("similarity_features", np.float16, (FEATURE_SIZE,)), store.column("similarity_valid", bool)
+
+
+def small_thumbnail(pil_image: Image.Image) -> np.ndarray:
+    # let the jpeg decoder skip most of the work when the image has not been decoded yet
+    pil_image.draft("RGB", (THUMBNAIL_SIZE*4, THUMBNAIL_SIZE*4))
+    return np.asarray(pil_image.convert("RGB").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.BILINEAR))
+
+
+def image_features(thumbnails: np.ndarray) -> np.ndarray:
+    """
+    Turns a batch of thumbnails of shape (n, size, size, 3) into feature vectors: a coarse RGB histogram followed by a
+    downsampled, mean-centered grayscale version of the image.
+    """
+    n = len(thumbnails)
+    pixels = thumbnails.reshape(n, -1, 3) // (256 // HISTOGRAM_LEVELS)
+    bins = ((pixels[:, :, 0]*HISTOGRAM_LEVELS + pixels[:, :, 1])*HISTOGRAM_LEVELS + pixels[:, :, 2]).astype(np.intp)
+    bins += np.arange(n)[:, None]*HISTOGRAM_BINS
+    histograms = np.bincount(bins.ravel(), minlength=n*HISTOGRAM_BINS).reshape(n, HISTOGRAM_BINS).astype(np.float32)
+    histograms /= pixels.shape[1]
+
+    gray = thumbnails.astype(np.float32) @ GRAY_WEIGHTS / 255
+    half = THUMBNAIL_SIZE//2
+    gray = gray.reshape(n, half, 2, half, 2).mean(axis=(2, 4)).reshape(n, -1)
+    gray -= gray.mean(axis=1, keepdims=True)
+    return np.concatenate([histograms, gray], axis=1)
+
+
+class SimilarityPlotter(PositionGenerator):
+    """
+    Places visually similar images close together by projecting small feature vectors onto their two principal
+    components. The features are cached in the feature store and the projection is computed out of core: the
+    covariance matrix is accumulated chunk by chunk, so only one chunk of features is ever held in memory.
+    """
+    def __init__(self):
+        self.log_point_radius = -7
+        self.alpha = 1.
+        self.color_weight = .5
+
+    @property
+    def name(self) -> str:
+        return "Similarity plot"
+
+    def draw_ui(self) -> bool:
+        radius_changed, self.log_point_radius = imgui.slider_float("point radius", self.log_point_radius, -15, -4)
+        alpha_changed, self.alpha = imgui.slider_float("point alpha", self.alpha, 0., 1.)
+        weight_changed, self.color_weight = imgui.slider_float("color weight", self.color_weight, 0., 1.)
+        return radius_changed or alpha_changed or weight_changed
+
+    def needs_image(self, store: FeatureStore) -> np.ndarray:
+        return ~thumbnail_column(store)[1]
+
+    def process(self, app: Application, store: FeatureStore, image_id: int, pil_image: Image.Image):
+        thumbnails, valid = thumbnail_column(store)
+        if not valid[image_id]:
+            thumbnails[image_id] = small_thumbnail(pil_image)
+            valid[image_id] = True
+
+    def update_features(self, store: FeatureStore):
+        thumbnails, thumbnail_valid = thumbnail_column(store)
+        features, valid = feature_column(store)
+        missing = np.flatnonzero(thumbnail_valid & ~valid)
+        for start in range(0, len(missing), CHUNK_SIZE):
+            chunk = missing[start:start+CHUNK_SIZE]
+            features[chunk] = image_features(thumbnails[chunk])
+            valid[chunk] = True
+
+    def project(self, features: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        total = np.zeros(FEATURE_SIZE)
+        scatter = np.zeros((FEATURE_SIZE, FEATURE_SIZE))
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = features[ids[start:start+CHUNK_SIZE]].astype(np.float32)
+            total += chunk.sum(axis=0)
+            scatter += chunk.T @ chunk
+        mean = total/len(ids)
+        # weighting the features only rescales the covariance, so the cached features can be used as they are
+        weights = np.repeat([self.color_weight, 1-self.color_weight], [HISTOGRAM_BINS, FEATURE_SIZE-HISTOGRAM_BINS])
+        covariance = (scatter/len(ids) - np.outer(mean, mean)) * np.outer(weights, weights)
+        _, vectors = np.linalg.eigh(covariance)
+        components = (weights[:, None]*vectors[:, [-1, -2]]).astype(np.float32)
+
+        result = np.empty((len(ids), 2), dtype=float)
+        offset = mean.astype(np.float32) @ components
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = features[ids[start:start+CHUNK_SIZE]].astype(np.float32)
+            result[start:start+CHUNK_SIZE] = chunk @ components - offset
+        # fit the bulk of the points in [-1, 1] without letting a few outliers squash everything else
+        scale = np.percentile(np.abs(result), 99, axis=0)
+        result /= np.where(scale > 0, scale, 1.)
+        return np.clip(result, -1., 1.)
+
+    def get_layout(self, store: FeatureStore) -> Layout:
+        self.update_features(store)
+        thumbnails, _ = thumbnail_column(store)
+        features, valid = feature_column(store)
+        result = Layout(np.zeros((len(store), 2), dtype=float), np.ones(len(store), dtype=float),
+                        np.tile(np.array([1., 0., 0., 0.]), (len(store), 1)))
+        ids = np.flatnonzero(valid)
+        if len(ids) == 0:
+            return result
+        result.centers[ids] = self.project(features, ids)
+        result.radii[ids] = 2**self.log_point_radius
+        for start in range(0, len(ids), CHUNK_SIZE):
+            chunk = ids[start:start+CHUNK_SIZE]
+            result.colors[chunk, :3] = thumbnails[chunk].reshape(len(chunk), -1, 3).mean(axis=1)/255
+        result.colors[ids, 3] = self.alpha
+        return result
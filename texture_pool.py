@@ -0,0 +1,215 @@
+from __future__ import annotations
+import collections
+import time
+import moderngl
+from typing import Callable
+from memory_budget import MemoryConsumer
+
+
+MIN_SIZE_STEP = 64
+# bytes uploaded to textures per frame, about five tiles of the image viewer
+DEFAULT_UPLOAD_BUDGET = 4 << 20
+STAGING_BUFFER_COUNT = 4
+
+
+def size_class(n: int) -> int:
+    # round up to a multiple of an eighth of the next power of two, which wastes at most 12.5% per dimension
+    step = max(MIN_SIZE_STEP, (1 << max(0, n-1).bit_length()) // 8)
+    return -(-n // step) * step
+
+
+class PooledTexture:
+    """
+    A texture handed out by a `TexturePool'. Only the top left `size' pixels of the underlying texture are used, the
+    uv coordinates of that region are given by `uv_max'.
+    """
+    def __init__(self, texture: moderngl.Texture, size: tuple[int, int], owner: str,
+                 evict: Callable[[], None] | None):
+        self.texture = texture
+        self.size = size
+        self.owner = owner
+        self.evict = evict
+        self.last_used = time.monotonic()
+
+    @property
+    def glo(self) -> int:
+        return self.texture.glo
+
+    @property
+    def uv_max(self) -> tuple[float, float]:
+        return self.size[0]/self.texture.width, self.size[1]/self.texture.height
+
+    @property
+    def nbytes(self) -> int:
+        return texture_bytes(self.texture)
+
+    def write(self, data):
+        self.texture.write(data, viewport=(0, 0, *self.size))
+
+    def use(self, location: int = 0):
+        self.texture.use(location)
+
+
+class TexturePool(MemoryConsumer):
+    """
+    Hands out textures from pools of size classes and releases them deterministically, instead of leaving dead
+    textures to the garbage collector. The textures are evicted when a `MemoryBudget' asks for room: free pooled
+    textures are released first, then textures that were acquired with an `evict' callback are taken back from their
+    owners, least recently used first. With a budget of its own, the pool also keeps all textures under it in the
+    same order when a new texture does not fit.
+    """
+    on_gpu = True
+    is_cache = True
+
+    def __init__(self, mgl: moderngl.Context, budget: int | None = None):
+        self.mgl = mgl
+        self.budget = budget
+        self.used_bytes = 0
+        self.free_bytes = 0
+        self._free: collections.OrderedDict[int, moderngl.Texture] = collections.OrderedDict()
+        self._in_use: collections.OrderedDict[int, PooledTexture] = collections.OrderedDict()
+
+    def acquire(self, size: tuple[int, int], components: int = 3, owner: str = "", exact: bool = False,
+                evict: Callable[[], None] | None = None) -> PooledTexture:
+        texture_size = tuple(size) if exact else (size_class(size[0]), size_class(size[1]))
+        texture = None
+        for glo, candidate in self._free.items():
+            if candidate.size == texture_size and candidate.components == components:
+                texture = self._free.pop(glo)
+                self.free_bytes -= texture_bytes(texture)
+                break
+        if texture is None:
+            self.make_room(texture_size[0]*texture_size[1]*components)
+            texture = self.mgl.texture(texture_size, components)
+        # reused textures may have been configured differently by their previous owner
+        texture.filter = (moderngl.LINEAR, moderngl.LINEAR)
+        texture.swizzle = "RGBA"
+        result = PooledTexture(texture, (int(size[0]), int(size[1])), owner, evict)
+        self._in_use[texture.glo] = result
+        self.used_bytes += result.nbytes
+        return result
+
+    def release(self, pooled: PooledTexture | None):
+        if pooled is None or self._in_use.pop(pooled.glo, None) is None:
+            return
+        self.used_bytes -= pooled.nbytes
+        self._free[pooled.glo] = pooled.texture
+        self.free_bytes += pooled.nbytes
+        self.make_room(0)
+
+    def touch(self, pooled: PooledTexture):
+        # mark as recently used, so it is evicted last
+        if pooled.glo in self._in_use:
+            self._in_use.move_to_end(pooled.glo)
+            pooled.last_used = time.monotonic()
+
+    def make_room(self, nbytes: int):
+        if self.budget is None:
+            return
+        while self.total_bytes + nbytes > self.budget and self.eviction_candidate() is not None:
+            self.evict_one()
+
+    @property
+    def nbytes(self) -> int:
+        return self.total_bytes
+
+    def _next_evicted(self) -> PooledTexture | None:
+        for pooled in self._in_use.values():
+            if pooled.evict is not None:
+                return pooled
+        return None
+
+    def eviction_candidate(self) -> float | None:
+        # unused textures are worth nothing
+        if self._free:
+            return 0.
+        pooled = self._next_evicted()
+        return None if pooled is None else pooled.last_used
+
+    def evict_one(self):
+        if self._free:
+            _, texture = self._free.popitem(last=False)
+            self.free_bytes -= texture_bytes(texture)
+            texture.release()
+            return
+        pooled = self._next_evicted()
+        del self._in_use[pooled.glo]
+        self.used_bytes -= pooled.nbytes
+        pooled.evict()
+        pooled.texture.release()
+
+    def trim(self):
+        # release every texture that is not in use
+        while self._free:
+            self._free.popitem()[1].release()
+        self.free_bytes = 0
+
+    def release_all(self):
+        self.trim()
+        for pooled in self._in_use.values():
+            pooled.texture.release()
+        self._in_use.clear()
+        self.used_bytes = 0
+
+    @property
+    def total_bytes(self) -> int:
+        return self.used_bytes + self.free_bytes
+
+    def usage_by_owner(self) -> dict[str, int]:
+        result = collections.defaultdict(int)
+        for pooled in self._in_use.values():
+            result[pooled.owner] += pooled.nbytes
+        return dict(result)
+
+
+class TextureUploader:
+    """
+    Uploads pixel data to pooled textures through a ring of staging buffers (pixel buffer objects). The data is
+    copied into a staging buffer straight from any object with the buffer protocol, such as a contiguous numpy array,
+    and the driver fills the texture from there without the render thread waiting for the transfer. The bytes uploaded
+    per frame are limited, so the tiles of a new image are spread over a few frames instead of making one long frame.
+    """
+    def __init__(self, mgl: moderngl.Context, frame_budget: int = DEFAULT_UPLOAD_BUDGET,
+                 buffer_count: int = STAGING_BUFFER_COUNT):
+        self.mgl = mgl
+        self.frame_budget = frame_budget
+        self.spent = 0
+        self._buffers: list[moderngl.Buffer | None] = [None]*buffer_count
+        self._next_buffer = 0
+
+    def next_frame(self):
+        self.spent = 0
+
+    def can_upload(self, nbytes: int) -> bool:
+        # the first upload of a frame is always allowed, also when it is larger than the whole budget
+        return self.spent == 0 or self.spent+nbytes <= self.frame_budget
+
+    def upload(self, pooled: PooledTexture, data):
+        nbytes = memoryview(data).nbytes
+        index = self._next_buffer
+        self._next_buffer = (index+1) % len(self._buffers)
+        buffer = self._buffers[index]
+        if buffer is None or buffer.size < nbytes:
+            if buffer is not None:
+                buffer.release()
+            buffer = self._buffers[index] = self.mgl.buffer(reserve=nbytes, dynamic=True)
+        else:
+            # new storage, so the write does not wait for a transfer from the old one that may still be running
+            buffer.orphan(buffer.size)
+        buffer.write(data)
+        pooled.write(buffer)
+        self.spent += nbytes
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.size for buffer in self._buffers if buffer is not None)
+
+    def release(self):
+        for buffer in self._buffers:
+            if buffer is not None:
+                buffer.release()
+        self._buffers = [None]*len(self._buffers)
+
+
+def texture_bytes(texture: moderngl.Texture) -> int:
+    return texture.width*texture.height*texture.components*int(texture.dtype[1:])
@@ -0,0 +1,266 @@
+from __future__ import annotations
+import imgui
+import numpy as np
+from application import Application, Viewer
+from feature_store import FeatureExtractor
+from image_viewer import ImageViewer
+from exif_reader import CaptureTimeExtractor, from_microseconds
+from memory_budget import MemoryConsumer, MeasuredMemory
+
+
+# numpy datetime units from fine to coarse, with their approximate length in microseconds
+TIME_UNITS = [("s", 10**6), ("m", 60*10**6), ("h", 3600*10**6), ("D", 86400*10**6),
+              ("M", 2629746*10**6), ("Y", 31556952*10**6)]
+UNIT_FORMATS = {"s": "%Y-%m-%d %H:%M:%S", "m": "%Y-%m-%d %H:%M", "h": "%Y-%m-%d %H:00", "D": "%Y-%m-%d",
+                "M": "%Y-%m", "Y": "%Y"}
+UNIT_NAMES = {"s": "second", "m": "minute", "h": "hour", "D": "day", "M": "month", "Y": "year"}
+MIN_BAR_WIDTH = 4.
+ZOOM_FACTOR = 1.25
+# limits of the visible time range in microseconds, from ten seconds to a thousand years
+MIN_VIEW_LENGTH = 10*10**6
+MAX_VIEW_LENGTH = 1000*31556952*10**6
+CLICK_DISTANCE = 3.
+HISTOGRAM_BOTTOM_MARGIN = 20.
+SELECTED_BAR_COLOR = (0., .7, 0., 1.)
+UNSELECTED_BAR_COLOR = (.5, .5, .5, 1.)
+DRAG_SELECT_COLOR = (0., .7, 0., .25)
+DRAG_DESELECT_COLOR = (.7, 0., 0., .25)
+SELECT_DRAG, JUMP_DRAG = range(2)
+
+
+def bin_edges(start: int, end: int, unit: str) -> np.ndarray:
+    # edges of the calendar aligned bins of `unit' that cover [start, end], in microseconds
+    first = np.datetime64(int(start), "us").astype(f"datetime64[{unit}]")
+    last = np.datetime64(int(end), "us").astype(f"datetime64[{unit}]")
+    return np.arange(first, last+2).astype("datetime64[us]").astype(np.int64)
+
+
+def bar_unit(start: int, end: int, max_bars: float) -> str:
+    # the finest unit that does not need more than `max_bars' bars
+    for unit, length in TIME_UNITS:
+        if (end-start)/length <= max_bars:
+            return unit
+    return TIME_UNITS[-1][0]
+
+
+class Timeline:
+    """
+    The capture times of all images with a time stamp, sorted. The number of images in any time range is found with
+    two binary searches, so a histogram at any resolution, from years down to seconds, costs O(log n) per bar and
+    never has to touch the individual images. The same holds for the selected images, which are kept as a second
+    sorted array.
+    """
+    def __init__(self, times: np.ndarray, valid: np.ndarray):
+        ids = np.flatnonzero(valid)
+        order = np.argsort(times[ids], kind="stable")
+        self.image_ids = ids[order]
+        self.times = np.asarray(times[ids][order], dtype=np.int64)
+        self.selected_times = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.times)
+
+    @property
+    def nbytes(self) -> int:
+        return self.image_ids.nbytes + self.times.nbytes + self.selected_times.nbytes
+
+    def set_selected(self, selected: np.ndarray):
+        # boolean indexing keeps the order, so no sort is needed
+        self.selected_times = self.times[selected[self.image_ids]]
+
+    def counts(self, edges: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # images and selected images in every bin between consecutive edges
+        return (np.diff(np.searchsorted(self.times, edges)),
+                np.diff(np.searchsorted(self.selected_times, edges)))
+
+    def range_ids(self, start: int, end: int) -> np.ndarray:
+        # the images taken in [start, end), ordered by time
+        low, high = np.searchsorted(self.times, [start, end])
+        return self.image_ids[low:high]
+
+
+class TimelineViewer(Viewer):
+    """
+    Histogram of the capture times of all images, with the selected images stacked below the rest. Scroll to zoom,
+    drag with the middle mouse button to pan. Dragging over a time range with the left button selects those images
+    or jumps to the first of them in the image viewer, dragging with the right button deselects them.
+    """
+    def __init__(self):
+        self.is_shown = False
+        self.image_viewer: ImageViewer | None = None
+        self.extractor = CaptureTimeExtractor()
+        self.timeline: Timeline | None = None
+        # the version of the feature store the timeline was read from, image ids change when the store is reopened
+        self.store_version = 0
+        self.selection_version = 0
+        self.view_start = 0
+        self.view_end = 1
+        self.drag_action = SELECT_DRAG
+        self.log_scale = False
+        # (button, x position) where the current drag started
+        self.drag: tuple[int, float] | None = None
+
+    @property
+    def name(self) -> str:
+        return "Timeline"
+
+    def open(self):
+        self.is_shown = True
+
+    def get_extractors(self) -> list[FeatureExtractor]:
+        return [self.extractor]
+
+    def get_memory_consumers(self) -> dict[str, MemoryConsumer]:
+        return {"timeline": MeasuredMemory(lambda: 0 if self.timeline is None else self.timeline.nbytes)}
+
+    def reload(self, app: Application):
+        app.reload_features()
+        self.read_timeline(app)
+        self.reset_view()
+
+    def read_timeline(self, app: Application):
+        times, valid, _ = self.extractor.time_columns(app.store)
+        self.timeline = Timeline(times, valid)
+        self.store_version = app.store.version
+        self.selection_version = 0
+
+    def reset_view(self):
+        if len(self.timeline) == 0:
+            return
+        start, end = int(self.timeline.times[0]), int(self.timeline.times[-1])
+        margin = max((end-start)//50, TIME_UNITS[0][1])
+        self.view_start, self.view_end = start-margin, end+margin
+
+    def time_at(self, x: float, origin: float, width: float) -> int:
+        return int(self.view_start + (x-origin)/width*(self.view_end-self.view_start))
+
+    def x_at(self, time: int, origin: float, width: float) -> float:
+        return origin + (time-self.view_start)/(self.view_end-self.view_start)*width
+
+    def handle_view_inputs(self, app: Application, origin: np.ndarray, size: np.ndarray):
+        if not imgui.is_item_hovered():
+            return
+        cursor_time = self.time_at(app.window.cur_pos[0], origin[0], size[0])
+        wheel = app.window.get_scroll_wheel_y()
+        if wheel != 0:
+            factor = ZOOM_FACTOR**-wheel
+            length = min(max((self.view_end-self.view_start)*factor, MIN_VIEW_LENGTH), MAX_VIEW_LENGTH)
+            fraction = (cursor_time-self.view_start)/(self.view_end-self.view_start)
+            self.view_start = int(cursor_time-fraction*length)
+            self.view_end = int(self.view_start+length)
+        if imgui.is_mouse_down(1):
+            shift = app.window.delta_cur[0]/size[0]*(self.view_end-self.view_start)
+            self.view_start, self.view_end = int(self.view_start-shift), int(self.view_end-shift)
+        for button in (0, 2):
+            if imgui.is_mouse_clicked(button) and self.drag is None:
+                self.drag = (button, app.window.cur_pos[0])
+
+    def finish_drag(self, app: Application, origin: np.ndarray, size: np.ndarray, edges: np.ndarray):
+        button, start_x = self.drag
+        self.drag = None
+        end_x = app.window.cur_pos[0]
+        if abs(end_x-start_x) < CLICK_DISTANCE:
+            # a click takes the whole bar under the cursor
+            time = self.time_at(end_x, origin[0], size[0])
+            bar = np.searchsorted(edges, time, side="right")-1
+            if bar < 0 or bar >= len(edges)-1:
+                return
+            start, end = int(edges[bar]), int(edges[bar+1])
+        else:
+            start, end = sorted((self.time_at(start_x, origin[0], size[0]), self.time_at(end_x, origin[0], size[0])))
+        image_ids = self.timeline.range_ids(start, end)
+        if len(image_ids) == 0:
+            return
+        if button == 2:
+            app.set_selected_ids(image_ids, False)
+        elif self.drag_action == JUMP_DRAG:
+            if self.image_viewer is not None:
+                self.image_viewer.set_image(app, *app.store.image_from_id(int(image_ids[0])))
+        else:
+            app.set_selected_ids(image_ids, True)
+
+    def draw_histogram(self, app: Application, origin: np.ndarray, size: np.ndarray):
+        unit = bar_unit(self.view_start, self.view_end, size[0]/MIN_BAR_WIDTH)
+        edges = bin_edges(self.view_start, self.view_end, unit)
+        counts, selected_counts = self.timeline.counts(edges)
+        if self.drag is not None and not imgui.is_mouse_down(self.drag[0]):
+            self.finish_drag(app, origin, size, edges)
+
+        draw_list = imgui.get_window_draw_list()
+        draw_list.push_clip_rect(*origin, *(origin+size), True)
+        bar_height = size[1]-HISTOGRAM_BOTTOM_MARGIN
+        bottom = origin[1]+bar_height
+        scale_counts = np.log1p if self.log_scale else (lambda x: x)
+        max_height = max(1., float(scale_counts(counts.max(initial=0))))
+        xs = self.x_at(edges, origin[0], size[0])
+        selected_color = imgui.get_color_u32_rgba(*SELECTED_BAR_COLOR)
+        unselected_color = imgui.get_color_u32_rgba(*UNSELECTED_BAR_COLOR)
+        for i in np.flatnonzero(counts):
+            total_height = float(scale_counts(counts[i]))/max_height*bar_height
+            selected_height = total_height*selected_counts[i]/counts[i]
+            x0, x1 = xs[i], max(xs[i]+1, xs[i+1]-1)
+            draw_list.add_rect_filled(x0, bottom-total_height, x1, bottom-selected_height, unselected_color)
+            if selected_height > 0:
+                draw_list.add_rect_filled(x0, bottom-selected_height, x1, bottom, selected_color)
+        if self.drag is not None:
+            color = DRAG_DESELECT_COLOR if self.drag[0] == 2 else DRAG_SELECT_COLOR
+            draw_list.add_rect_filled(min(self.drag[1], app.window.cur_pos[0]), origin[1],
+                                      max(self.drag[1], app.window.cur_pos[0]), bottom,
+                                      imgui.get_color_u32_rgba(*color))
+        text_color = imgui.get_color_u32_rgba(1., 1., 1., 1.)
+        unit_format = UNIT_FORMATS[unit]
+        draw_list.add_text(origin[0], bottom+2, text_color, from_microseconds(self.view_start).strftime(unit_format))
+        end_label = from_microseconds(self.view_end).strftime(unit_format)
+        draw_list.add_text(origin[0]+size[0]-imgui.calc_text_size(end_label)[0], bottom+2, text_color, end_label)
+        draw_list.pop_clip_rect()
+
+        if imgui.is_item_hovered():
+            bar = np.searchsorted(edges, self.time_at(app.window.cur_pos[0], origin[0], size[0]), side="right")-1
+            if 0 <= bar < len(counts):
+                imgui.set_tooltip(f"{from_microseconds(edges[bar]).strftime(unit_format)}: {counts[bar]} images, "
+                                  f"{selected_counts[bar]} selected")
+        return unit
+
+    def draw_ui(self, app: Application) -> None:
+        if self.image_viewer is None:
+            for viewer in app.viewers:
+                if isinstance(viewer, ImageViewer):
+                    self.image_viewer = viewer
+                    break
+        if not self.is_shown:
+            return
+        with imgui.begin("Timeline", True, imgui.WINDOW_NO_COLLAPSE) as window:
+            if not window.opened:
+                self.is_shown = False
+            if imgui.button("Reload"):
+                self.reload(app)
+            imgui.same_line()
+            if imgui.button("Show all") and self.timeline is not None:
+                self.reset_view()
+            imgui.same_line()
+            imgui.text("left drag:")
+            for action, action_name in enumerate(["select", "jump"]):
+                imgui.same_line()
+                if imgui.radio_button(action_name, self.drag_action == action):
+                    self.drag_action = action
+            imgui.same_line()
+            _, self.log_scale = imgui.checkbox("log scale", self.log_scale)
+            if self.timeline is not None and app.store.version != self.store_version:
+                # the store was reloaded, which reads the capture times of every image again and can change the ids
+                self.read_timeline(app)
+            if self.timeline is None:
+                imgui.text("Press 'Reload' to read the capture times of the current sources.")
+                return
+            if len(self.timeline) == 0:
+                imgui.text("None of the images has a capture time.")
+                return
+            if app.selection.version != self.selection_version:
+                self.timeline.set_selected(app.selected_mask())
+                self.selection_version = app.selection.version
+
+            origin = np.array(imgui.get_cursor_screen_pos(), dtype=float)
+            size = np.maximum(np.array(imgui.get_content_region_available(), dtype=float), [100., 60.])
+            imgui.invisible_button("timeline area", *size)
+            self.handle_view_inputs(app, origin, size)
+            unit = self.draw_histogram(app, origin, size)
+            imgui.text(f"{len(self.timeline)} images with a capture time, one bar per {UNIT_NAMES[unit]}")